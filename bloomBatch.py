@@ -0,0 +1,267 @@
+"""
+autor: Valentina Garrido
+
+Batch processing of many images with the bloom effect. Images are given as files, glob patterns or directories,
+and are spread among a pool of worker processes.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import glob
+import json
+import time
+import os
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff", ".npz", ".npy", ".pfm")
+
+# environment variables read by the BLAS/OpenMP libraries used by numpy and scipy to size their thread pools
+BLAS_THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "BLIS_NUM_THREADS",
+                         "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+DEFAULT_OUTPUT_TEMPLATE = "{stem}{suffix}{ext}"
+
+# extension added to the name of an output file to get the file with the parameters it was bloomed with
+PARAMETERS_EXTENSION = ".bloom.json"
+
+
+def expand_image_paths(paths, suffix: str = "_out") -> list:
+    """
+    Expands files, glob patterns and directories into the list of image files they refer to.
+    Files found through patterns or directories whose name ends with suffix are skipped, as they are most likely
+    outputs of previous runs. Explicitly given files are always kept.
+
+    The order of paths is kept, as it is the order of the frames of a sequence. Only the files of each pattern or
+    directory are sorted.
+
+    :param paths: iterable of files, glob patterns or directories
+    :param suffix: suffix of the output files
+    :return: list of image files, without duplicates (the first occurrence of each is kept)
+    """
+    def is_input_image(path):
+        stem, ext = os.path.splitext(os.path.basename(path))
+        return ext.lower() in IMAGE_EXTENSIONS and not (suffix and stem.endswith(suffix))
+
+    image_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = [os.path.join(path, name) for name in os.listdir(path)]
+            image_paths.extend(sorted(p for p in found if os.path.isfile(p) and is_input_image(p)))
+        elif glob.has_magic(path):
+            image_paths.extend(sorted(p for p in glob.glob(path) if os.path.isfile(p) and is_input_image(p)))
+        else:
+            image_paths.append(path)
+    return list(dict.fromkeys(image_paths))
+
+
+def output_path(in_filename: str, output_dir: str = None, suffix: str = "_out",
+                template: str = DEFAULT_OUTPUT_TEMPLATE) -> str:
+    """
+    Builds the name of the output file of an image.
+
+    :param in_filename: path of the input image
+    :param output_dir: directory of the output file. Defaults to the directory of the input image
+    :param suffix: value of {suffix} in the template
+    :param template: format of the output filename. It may use {stem} (input filename without extension),
+                     {ext} (extension, with its dot), {name} (input filename) and {suffix}
+    :return: path of the output file
+    """
+    # os.path.split divides the filename in the head, which contains the parent folders of the file and tail, which
+    # contains the filename with it's extension
+    (dir, filename) = os.path.split(in_filename)
+
+    # os.path.splittext divides once more the filename into its name without extension and the extension.
+    (short_name, extension) = os.path.splitext(filename)
+
+    out_name = template.format(stem=short_name, ext=extension, name=filename, suffix=suffix)
+    return os.path.join(output_dir if output_dir is not None else dir, out_name)
+
+
+def is_up_to_date(in_filename: str, out_filename: str, parameters: dict) -> bool:
+    """
+    :param parameters: JSON serializable dictionary with the parameters the image is bloomed with
+    :return: whether out_filename exists, is newer than in_filename and was bloomed with the same parameters,
+             @see save_parameters
+    """
+    if not os.path.exists(out_filename) or os.path.getmtime(out_filename) < os.path.getmtime(in_filename):
+        return False
+    try:
+        with open(out_filename + PARAMETERS_EXTENSION) as parameters_file:
+            saved_parameters = json.load(parameters_file)
+    except (OSError, ValueError):
+        return False
+    # tuples are saved as lists
+    return saved_parameters == json.loads(json.dumps(parameters))
+
+
+def save_parameters(out_filename: str, parameters: dict):
+    """
+    Saves the parameters an image was bloomed with next to its output file, so is_up_to_date may compare them
+
+    :param out_filename: path of the output image
+    :param parameters: JSON serializable dictionary with the parameters
+    """
+    with open(out_filename + PARAMETERS_EXTENSION, "w") as parameters_file:
+        json.dump(parameters, parameters_file, sort_keys=True)
+
+
+def has_parameters(out_filename: str) -> bool:
+    """
+    :return: whether the parameters of an output image were saved, @see save_parameters
+    """
+    return os.path.exists(out_filename + PARAMETERS_EXTENSION)
+
+
+def limit_blas_threads(blas_threads: int):
+    """
+    Caps the threads used by BLAS libraries. The environment variables only affect libraries loaded afterwards
+    (like those of worker processes started later), so threadpoolctl, when installed, is used to also cap the
+    libraries already loaded.
+
+    :param blas_threads: maximum number of threads, or None to leave the defaults
+    """
+    if blas_threads is None:
+        return
+    for variable in BLAS_THREAD_VARIABLES:
+        os.environ[variable] = str(blas_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=blas_threads)
+
+
+def bloom_file(in_filename: str, out_filename: str, bloom_options: dict, profile_memory: bool = False):
+    """
+    Reads an image, blooms it and saves the result. Runs in the worker processes.
+
+    :param in_filename: path of the input image
+    :param out_filename: path of the output image
+    :param bloom_options: keyword arguments of bloom_effect.bloom, radius and colors included
+    :param profile_memory: whether the profile measures the peak memory of each stage
+    :return: a tuple with the input filename, the bloomProfile.PipelineProfile of the image, the reports of the
+             solver and a dictionary with the hits and misses of the system cache, if any
+    """
+    from bloom_effect import bloom, read_image, save_image
+    from bloomProfile import PipelineProfile, record_stage_time
+    from images import convert_to_float_img
+
+    profile = PipelineProfile(profile_memory)
+    solver_reports = []
+    cb_masks = []
+    cache = bloom_options.get("cache")
+    counts_before = cache.counts() if cache is not None else {}
+    try:
+        start = time.perf_counter()
+        # converted to the type of the pipeline once here, so that it can be bloomed in place
+        np_img = convert_to_float_img(read_image(in_filename), bloom_options.get("dtype"))
+        record_stage_time(profile, "read", start)
+
+        # the image read is not needed anymore, so it is bloomed in place
+        out_image = bloom(np_img, out=np_img, profile=profile, solver_reports=solver_reports, cb_masks=cb_masks,
+                          **bloom_options)
+
+        start = time.perf_counter()
+        save_image(out_filename, out_image, cb_mask=cb_masks[0])
+        record_stage_time(profile, "save", start)
+    finally:
+        profile.finish()
+    # the cache of a worker process is a copy, so only the counts of this image are sent back
+    cache_counts = {name: count - counts_before[name] for name, count in cache.counts().items()} \
+        if cache is not None else {}
+    return in_filename, profile, solver_reports, cache_counts
+
+
+class BatchSummary:
+    """
+    Simple object accumulating the statistics of a batch run
+    """
+    def __init__(self):
+        from bloomProfile import PipelineProfile
+
+        self.processed = 0
+        self.skipped = 0
+        self.failed = []
+        self.profile = PipelineProfile()
+        self.cache_counts = {}
+        self.start = time.perf_counter()
+        self.elapsed = 0.
+
+    def add(self, profile, cache_counts: dict = None):
+        """
+        Adds the profile and system cache counts of a processed image
+        """
+        self.processed += 1
+        self.profile.merge(profile)
+        for name, count in (cache_counts or {}).items():
+            self.cache_counts[name] = self.cache_counts.get(name, 0) + count
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.start
+
+    def __str__(self):
+        throughput = self.processed / self.elapsed if self.elapsed > 0 else 0.
+        lines = ["{} images processed, {} skipped (up to date), {} failed in {:.2f} s: {:.2f} images/s".format(
+            self.processed, self.skipped, len(self.failed), self.elapsed, throughput)]
+        total = self.profile.total_seconds()
+        for stage, stage_profile in self.profile.stages.items():
+            seconds = stage_profile.seconds
+            lines.append("  {:<14}{:>10.3f} s{:>8.1f} %{:>10.4f} s/image".format(
+                stage, seconds, 100 * seconds / total if total > 0 else 0., seconds / max(self.processed, 1)))
+        if self.cache_counts:
+            lines.append("  system cache: {hits} hits, {misses} misses, {stores} stored, {evictions} evicted".format(
+                **self.cache_counts))
+        for in_filename, error in self.failed:
+            lines.append("  failed {}: {}".format(in_filename, error))
+        return "\n".join(lines)
+
+
+def run_batch(jobs_list, bloom_options: dict, jobs: int = 1, blas_threads: int = None, report_callback=None,
+              bloom_function=bloom_file, profile_memory: bool = False):
+    """
+    Blooms a list of images, spread among a pool of worker processes.
+
+    :param jobs_list: list of (input filename, output filename) tuples
+    :param bloom_options: keyword arguments of bloom_effect.bloom, radius and colors included
+    :param jobs: number of worker processes. 1 processes the images in this process, 0 uses one per CPU
+    :param blas_threads: maximum number of BLAS threads of each worker, or None to leave the defaults
+    :param report_callback: optional function called with the input filename, solver reports and
+                            bloomProfile.PipelineProfile of each image
+    :param bloom_function: function blooming each image, with the arguments and result of bloom_file. It must be
+                           importable by the worker processes
+    :param profile_memory: whether the profiles measure the peak memory of each stage
+    :return: the BatchSummary of the run
+    """
+    summary = BatchSummary()
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+
+    def collect(result):
+        in_filename, profile, solver_reports, cache_counts = result
+        summary.add(profile, cache_counts)
+        if report_callback is not None:
+            report_callback(in_filename, solver_reports, profile)
+
+    if jobs == 1:
+        limit_blas_threads(blas_threads)
+        for in_filename, out_filename in jobs_list:
+            try:
+                collect(bloom_function(in_filename, out_filename, bloom_options, profile_memory))
+            except Exception as error:
+                summary.failed.append((in_filename, error))
+    else:
+        # workers are spawned, not forked, so they load BLAS again and read the thread limits from the environment
+        limit_blas_threads(blas_threads)
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=limit_blas_threads,
+                                 initargs=(blas_threads,)) as executor:
+            futures = {executor.submit(bloom_function, in_filename, out_filename, bloom_options,
+                                       profile_memory): in_filename
+                       for in_filename, out_filename in jobs_list}
+            for future, in_filename in futures.items():
+                try:
+                    collect(future.result())
+                except Exception as error:
+                    summary.failed.append((in_filename, error))
+    summary.finish()
+    return summary
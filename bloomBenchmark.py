@@ -0,0 +1,376 @@
+"""
+autor: Valentina Garrido
+
+Benchmarks of the bloom pipeline on synthetic images.
+Images are generated with a given resolution, density of bloomed pixels, number of clusters of them and radius, so
+that the size of the equation system can be controlled. Each case is bloomed with the default pipeline and with the
+other modes (iterative solvers, float32, components), timing each stage and the whole bloom, measuring the peak
+memory and checking that the result matches the one of the default pipeline.
+
+Results may be stored as a baseline, and later runs compared against it: a case that got slower than the threshold,
+or that is missing from the baseline, fails the run. Times are stored relative to a calibration workload timed on
+the same machine, so that a baseline recorded on another machine is still a sensible reference. Scaling curves (time
+and memory against the number of unknowns and against N) are printed, and may be saved as csv or plotted.
+
+    python bloomBenchmark.py --quick                  # compares against benchmark_baseline.json
+    python bloomBenchmark.py --save-baseline          # records a new baseline
+    python bloomBenchmark.py --curves curves.csv --plot curves.png
+"""
+
+from bloom_effect import bloom, quantize_image, IMPORT_TIME_BUDGET
+from bloomProfile import PipelineProfile
+import numpy as np
+import argparse
+import subprocess
+import json
+import time
+import sys
+import os
+
+
+BENCHMARK_COLOR = (250, 220, 60)
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+DEFAULT_THRESHOLD = 1.3
+# cases faster than this are not reported as regressions, as their times are mostly noise
+MIN_REGRESSION_SECONDS = 0.02
+
+# options of bloom_effect.bloom of each mode, and the maximum difference (in uint8 levels) its result may have with
+# the one of the default pipeline
+BENCHMARK_MODES = {
+    "direct": ({}, 0),
+    "cg": ({"solver": "cg"}, 1),
+    "multigrid": ({"solver": "multigrid"}, 1),
+    "matrix-free": ({"solver": "matrix-free"}, 1),
+    "float32": ({"dtype": "float32"}, 1),
+    "components": ({"split_components": True}, 0),
+}
+
+QUICK_CASES = [
+    {"img_dims": (240, 320), "density": 0.002, "clusters": 4, "radius": 8},
+    {"img_dims": (480, 640), "density": 0.001, "clusters": 16, "radius": 8},
+    {"img_dims": (480, 640), "density": 0.0005, "clusters": 2, "radius": 24},
+]
+
+FULL_CASES = QUICK_CASES + [
+    {"img_dims": (1080, 1920), "density": 0.001, "clusters": 32, "radius": 10},
+    {"img_dims": (1080, 1920), "density": 0.0002, "clusters": 4, "radius": 40},
+    {"img_dims": (2160, 3840), "density": 0.0005, "clusters": 64, "radius": 16},
+]
+
+CURVE_SIZES = ((256, 256), (512, 512), (1024, 1024), (2048, 2048))
+CURVE_RADII = (2, 4, 8, 16, 32, 64)
+
+
+def synthetic_frame(img_dims: tuple, density: float = 0.001, clusters: int = 8, color=BENCHMARK_COLOR,
+                    seed: int = 0) -> np.ndarray:
+    """
+    Generates an image with square clusters of pixels of a color over a noisy background, which never matches it.
+
+    :param img_dims: a tuple representing the number of rows and number of columns of the image
+    :param density: fraction of the pixels of the image that have the color
+    :param clusters: number of clusters the pixels of the color are grouped in
+    :param color: the color of the clusters, in int range [0, 255]
+    :param seed: seed of the random positions and background
+    :return: uint8 array (rows, columns, 3) with the image
+    """
+    rng = np.random.default_rng(seed)
+    # the background channels stay under 200, and the color is kept with at least one channel above it
+    img = rng.integers(0, 200, size=img_dims + (3,), dtype=np.uint8)
+    side = max(1, int(round(np.sqrt(density * img_dims[0] * img_dims[1] / clusters))))
+    rows = rng.integers(0, max(img_dims[0] - side, 0) + 1, size=clusters)
+    cols = rng.integers(0, max(img_dims[1] - side, 0) + 1, size=clusters)
+    for row, col in zip(rows, cols):
+        img[row:row + side, col:col + side] = color
+    return img
+
+
+def case_name(case: dict) -> str:
+    return "{}x{}-d{}-c{}-n{}".format(case["img_dims"][1], case["img_dims"][0], case["density"], case["clusters"],
+                                      case["radius"])
+
+
+def calibration_seconds(repeats: int = 5) -> float:
+    """
+    Times a fixed workload, similar to the bloom (a sparse LU factorization and solve of a Laplace system), so that
+    the times of different machines may be compared
+
+    :param repeats: number of runs, the fastest is kept
+    :return: seconds of the fastest run
+    """
+    import scipy.sparse
+    import scipy.sparse.linalg
+    n = 200
+    laplacian_1d = scipy.sparse.diags([-1., 2., -1.], [-1, 0, 1], shape=(n, n))
+    identity = scipy.sparse.identity(n)
+    matrix = (scipy.sparse.kron(laplacian_1d, identity) + scipy.sparse.kron(identity, laplacian_1d)).tocsc()
+    right_hand_side = np.ones(n * n)
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        scipy.sparse.linalg.splu(matrix).solve(right_hand_side)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def measure_import_time(repeats: int = 3):
+    """
+    Measures the time of importing bloom_effect on a new interpreter
+
+    :param repeats: number of interpreters started, the fastest is kept
+    :return: a tuple with the seconds of the fastest import and whether matplotlib was imported along
+    """
+    code = ("import time, sys; start = time.perf_counter(); import bloom_effect; "
+            "print(time.perf_counter() - start, 'matplotlib' in sys.modules)")
+    best, matplotlib_imported = float("inf"), False
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+        best = min(best, float(output[0]))
+        matplotlib_imported = matplotlib_imported or output[1] == "True"
+    return best, matplotlib_imported
+
+
+def run_case(img: np.ndarray, radius: int, mode: str, repeats: int = 3, reference: np.ndarray = None) -> dict:
+    """
+    Blooms an image with a mode several times, and measures it
+
+    :param img: uint8 image to bloom, @see synthetic_frame
+    :param radius: controls how far the bloom is spread (in pixels)
+    :param mode: one of the keys of BENCHMARK_MODES
+    :param repeats: number of timed runs. The fastest one is kept, along with its stages
+    :param reference: optional uint8 result of the default pipeline, to compare the result with
+    :return: dictionary with the seconds of the whole bloom and of each stage, the peak memory in bytes, the sizes
+             of the system and the maximum difference with the reference, in uint8 levels
+    """
+    options, _ = BENCHMARK_MODES[mode]
+    best_seconds, best_profile, out = float("inf"), None, None
+    for _ in range(repeats):
+        profile = PipelineProfile()
+        start = time.perf_counter()
+        out = bloom(img, radius, BENCHMARK_COLOR, profile=profile, **options)
+        seconds = time.perf_counter() - start
+        if seconds < best_seconds:
+            best_seconds, best_profile = seconds, profile
+
+    # memory is measured on a separate run, as tracing allocations slows the program down
+    memory_profile = PipelineProfile(track_memory=True)
+    solver_reports = []
+    try:
+        bloom(img, radius, BENCHMARK_COLOR, profile=memory_profile, solver_reports=solver_reports,
+              track_memory=True, **options)
+    finally:
+        memory_profile.finish()
+    peak_memory = max([stage.peak_memory for stage in memory_profile.stages.values()] +
+                      [report.peak_memory for report in solver_reports])
+
+    result = {"mode": mode, "seconds": best_seconds,
+              "stages": {stage: stage_profile.seconds for stage, stage_profile in best_profile.stages.items()},
+              "peak_memory": int(peak_memory)}
+    result.update(best_profile.sizes)
+    if reference is not None:
+        result["deviation"] = int(np.abs(quantize_image(out).astype(np.int16) - reference).max(initial=0))
+    return result
+
+
+def run_suite(cases, modes=tuple(BENCHMARK_MODES), repeats: int = 3, log=None) -> list:
+    """
+    Runs every mode on every case
+
+    :param cases: list of dictionaries with the img_dims, density, clusters and radius of each case
+    :param modes: names of the modes to run, @see BENCHMARK_MODES
+    :param repeats: number of timed runs of each mode
+    :param log: optional function called with each result as it is measured
+    :return: list with the result of each case and mode, @see run_case
+    """
+    results = []
+    for case in cases:
+        img = synthetic_frame(case["img_dims"], case["density"], case["clusters"])
+        reference = quantize_image(bloom(img, case["radius"], BENCHMARK_COLOR))
+        for mode in modes:
+            result = run_case(img, case["radius"], mode, repeats, reference)
+            result["case"] = case_name(case)
+            results.append(result)
+            if log is not None:
+                log(result)
+    return results
+
+
+def scaling_curves(sizes=CURVE_SIZES, radii=CURVE_RADII, density: float = 0.001, clusters: int = 16,
+                   base_radius: int = 8, base_size: tuple = (1024, 1024), mode: str = "direct", repeats: int = 1,
+                   log=None) -> list:
+    """
+    Measures how the time and memory of a mode grow with the size of the system: first over images of growing
+    size, with clusters in proportion to their area (so the unknowns grow with it), then over growing radii on a
+    fixed image
+
+    :param sizes: image dimensions of the first curve
+    :param radii: radii of the second curve
+    :param density: fraction of bloomed pixels of the images
+    :param clusters: number of clusters of bloomed pixels of an image of base_size
+    :param base_radius: radius of the first curve
+    :param base_size: image dimensions of the second curve
+    :param mode: one of the keys of BENCHMARK_MODES
+    :param repeats: number of timed runs of each point
+    :param log: optional function called with each result as it is measured
+    :return: list of results, @see run_case, with the curve (size or radius) and the radius of each point
+    """
+    points = [("size", img_dims, base_radius) for img_dims in sizes] + \
+             [("radius", base_size, radius) for radius in radii]
+    results = []
+    for curve, img_dims, radius in points:
+        img_clusters = max(1, int(round(clusters * img_dims[0] * img_dims[1] / (base_size[0] * base_size[1]))))
+        img = synthetic_frame(img_dims, density, img_clusters)
+        result = run_case(img, radius, mode, repeats)
+        result.update(curve=curve, case=case_name({"img_dims": img_dims, "density": density,
+                                                   "clusters": img_clusters, "radius": radius}), radius=radius)
+        results.append(result)
+        if log is not None:
+            log(result)
+    return results
+
+
+def compare_with_baseline(results: list, calibration: float, baseline: dict,
+                          threshold: float = DEFAULT_THRESHOLD) -> list:
+    """
+    Finds the results that got slower than the baseline, that are missing from it, or whose result differs too much
+    from the default pipeline
+
+    :param results: results of run_suite
+    :param calibration: seconds of calibration_seconds on this machine
+    :param baseline: dictionary with the calibration and results of a previous run, @see make_baseline
+    :param threshold: maximum ratio between the time of a case and the one of the baseline, both relative to the
+                      calibration of their machine
+    :return: list of messages describing each failure, empty if there are none
+    """
+    scale = calibration / baseline["calibration"]
+    baseline_results = {(result["case"], result["mode"]): result for result in baseline["results"]}
+    failures = []
+    for result in results:
+        allowed_deviation = BENCHMARK_MODES[result["mode"]][1]
+        if result.get("deviation", 0) > allowed_deviation:
+            failures.append("{case} {mode}: result differs from the direct solve by {deviation} levels".format(
+                **result))
+        previous = baseline_results.get((result["case"], result["mode"]))
+        if previous is None:
+            # a new or renamed case or mode would otherwise never be compared
+            failures.append("{case} {mode}: not in the baseline, save it again with --save-baseline".format(**result))
+            continue
+        expected = previous["seconds"] * scale
+        if result["seconds"] > threshold * expected and result["seconds"] - expected > MIN_REGRESSION_SECONDS:
+            failures.append("{} {}: {:.4f} s, {:.2f} times the baseline ({:.4f} s on this machine)".format(
+                result["case"], result["mode"], result["seconds"], result["seconds"] / expected, expected))
+    return failures
+
+
+def make_baseline(results: list, calibration: float) -> dict:
+    return {"calibration": calibration, "results": [{"case": result["case"], "mode": result["mode"],
+                                                     "seconds": result["seconds"]} for result in results]}
+
+
+def format_result(result: dict) -> str:
+    stages = ", ".join("{} {:.4f}".format(stage, seconds) for stage, seconds in result["stages"].items())
+    deviation = " dev {}".format(result["deviation"]) if "deviation" in result else ""
+    return "{:<28}{:<12}{:>10.4f} s{:>10.1f} MiB{:>10} unknowns{}\n    {}".format(
+        result["case"], result["mode"], result["seconds"], result["peak_memory"] / 2**20, result.get("unknowns", 0),
+        deviation, stages)
+
+
+def save_curves_csv(filename: str, curves: list):
+    with open(filename, "w") as csv_file:
+        csv_file.write("curve,case,radius,unknowns,nnz,seconds,peak_memory\n")
+        for result in curves:
+            csv_file.write("{curve},{case},{radius},{unknowns},{nnz},{seconds},{peak_memory}\n".format(
+                **dict({"unknowns": 0, "nnz": 0}, **result)))
+
+
+def plot_curves(filename: str, curves: list):
+    """
+    Plots the time and memory of the scaling curves against the unknowns and against N (matplotlib is imported
+    here)
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(2, 2, figsize=(10, 8))
+    for column, (curve, x_name) in enumerate((("size", "unknowns"), ("radius", "radius"))):
+        points = [result for result in curves if result["curve"] == curve]
+        x = [result.get(x_name, 0) for result in points]
+        axes[0][column].loglog(x, [result["seconds"] for result in points], "o-")
+        axes[0][column].set_ylabel("time (s)")
+        axes[1][column].loglog(x, [result["peak_memory"] / 2**20 for result in points], "o-")
+        axes[1][column].set_ylabel("peak memory (MiB)")
+        axes[1][column].set_xlabel(x_name if x_name == "unknowns" else "N")
+    fig.tight_layout()
+    fig.savefig(filename)
+
+
+parser = argparse.ArgumentParser(description="Benchmarks the bloom pipeline on synthetic images")
+parser.add_argument("--quick", help="Runs only the small cases", action="store_true")
+parser.add_argument("--modes", help="Modes to run", nargs="+", choices=list(BENCHMARK_MODES),
+                    default=list(BENCHMARK_MODES))
+parser.add_argument("--repeats", help="Timed runs of each case, the fastest is kept", type=int, default=3)
+parser.add_argument("--baseline", help="File of the baseline the results are compared with", default=DEFAULT_BASELINE)
+parser.add_argument("--save-baseline", help="Stores the results as the new baseline, instead of comparing them",
+                    action="store_true")
+parser.add_argument("--threshold", help="Maximum ratio between the time of a case and the one of the baseline",
+                    type=float, default=DEFAULT_THRESHOLD)
+parser.add_argument("--json", help="File where the results are written as json", default=None)
+parser.add_argument("--curves", help="Measures the scaling curves and saves them to this csv file", default=None,
+                    metavar="CSV")
+parser.add_argument("--plot", help="Plots the scaling curves to this image file", default=None)
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    failures = []
+
+    import_seconds, matplotlib_imported = measure_import_time()
+    print("import bloom_effect: {:.3f} s (budget {:.2f} s)".format(import_seconds, IMPORT_TIME_BUDGET))
+    if import_seconds > IMPORT_TIME_BUDGET:
+        failures.append("importing bloom_effect takes {:.3f} s, over the budget of {:.2f} s".format(
+            import_seconds, IMPORT_TIME_BUDGET))
+    if matplotlib_imported:
+        failures.append("importing bloom_effect imports matplotlib")
+
+    calibration = calibration_seconds()
+    print("calibration: {:.4f} s".format(calibration))
+    results = run_suite(QUICK_CASES if args.quick else FULL_CASES, args.modes, args.repeats,
+                        lambda result: print(format_result(result)))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(make_baseline(results, calibration), baseline_file, indent=1)
+            baseline_file.write("\n")
+        print("baseline saved to {}".format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            failures += compare_with_baseline(results, calibration, json.load(baseline_file), args.threshold)
+    else:
+        print("no baseline found at {}".format(args.baseline))
+
+    curves = []
+    if args.curves is not None or args.plot is not None:
+        print("scaling curves:")
+        curves = scaling_curves(log=lambda result: print(format_result(result)))
+        if args.curves is not None:
+            save_curves_csv(args.curves, curves)
+        if args.plot is not None:
+            plot_curves(args.plot, curves)
+
+    if args.json is not None:
+        with open(args.json, "w") as json_file:
+            json.dump({"calibration": calibration, "import_seconds": import_seconds, "results": results,
+                       "curves": curves}, json_file, indent=1)
+            json_file.write("\n")
+
+    if failures:
+        print("BENCHMARK FAILED:", file=sys.stderr)
+        for failure in failures:
+            print("  " + failure, file=sys.stderr)
+        raise SystemExit(1)
+    print("benchmark passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""
+autor: Valentina Garrido
+
+Bloom effect for very large images (like texture atlases), which don't fit in memory as float arrays.
+The image is decoded once into a uint8 buffer memory mapped to a temporary file and is then processed in strips
+of rows. Only the bands of rows covered by the bloom are converted to float and bloomed, stacked as a smaller image,
+the rest of the image is tone mapped and written strip by strip. So the memory used grows with the height of the
+bloomed bands instead of with the whole image, however far apart they are.
+The result is the same as the one of bloom_effect.bloom (and of the command line program) for the same image.
+"""
+
+from bloom_effect import bloom_color, bloom_colors, quantize_image, TONE_MAPPINGS
+from bloomProfile import PipelineProfile, record_stage_time
+from colors import color_int_to_float
+from images import get_img_max_luminance, reinhard_image_mapping, clamp_image_colors
+from imgFiles import is_hdr_format, png_bit_depth
+from imgIndices import get_matching_pixel_mask
+import numpy as np
+import tempfile
+import time
+import os
+
+
+DEFAULT_STRIP_ROWS = 256
+
+
+def read_image_memmap(filename: str, scratch_dir: str = None, strip_rows: int = DEFAULT_STRIP_ROWS):
+    """
+    Decodes an image into a uint8 array memory mapped to a temporary file, which is deleted once the array is
+    released. The decoder (Pillow) still holds the whole uint8 image while the file is read, but no float copy of
+    it is ever made.
+    Colors are converted as matplotlib.image.imread does, and the float type imread would have returned is given
+    along, so that the result matches the one of the images read with it.
+
+    :param filename: path to the image
+    :param scratch_dir: directory of the temporary file. Defaults to the temporary directory of the system
+    :param strip_rows: number of rows copied at a time
+    :return: a tuple with the memory mapped array (rows, columns, channels) and the float type of the pixel data
+    """
+    from PIL import Image, PngImagePlugin
+    if is_hdr_format(filename):
+        raise ValueError("HDR images are not supported for large images: {}".format(filename))
+    with Image.open(filename) as pil_img:
+        if isinstance(pil_img, PngImagePlugin.PngImageFile):
+            if png_bit_depth(filename) == 16:
+                # they are held as uint8, which would lose the precision read_image keeps
+                raise ValueError("16-bit png images are not supported for large images: {}".format(filename))
+            # imread returns png images as float32 and the rest as uint8, which are converted to float64
+            float_type = np.float32
+            if pil_img.mode in ("P", "LA"):
+                pil_img = pil_img.convert("RGBA")
+            elif pil_img.mode == "L":
+                # imread returns gray levels, which bloom_effect.bloom repeats into the color channels
+                pil_img = pil_img.convert("RGB")
+        else:
+            float_type = np.float64
+            if pil_img.mode not in ("RGB", "RGBA"):
+                pil_img = pil_img.convert("RGBA")
+        if pil_img.mode not in ("RGB", "RGBA"):
+            raise ValueError("Unsupported image mode: {}".format(pil_img.mode))
+
+        width, height = pil_img.size
+        img_memmap = np.memmap(tempfile.TemporaryFile(dir=scratch_dir), dtype=np.uint8, mode="w+",
+                               shape=(height, width, len(pil_img.mode)))
+        for row in range(0, height, strip_rows):
+            end = min(row + strip_rows, height)
+            img_memmap[row:end] = np.asarray(pil_img.crop((0, row, width, end)))
+    return img_memmap, float_type
+
+
+def write_image_memmap(filename: str, rgba_img: np.ndarray):
+    """
+    Saves a uint8 RGBA image as matplotlib.image.imsave would save it, without copying it. Pillow reads the pixels
+    straight from rgba_img, which may be memory mapped
+
+    :param filename: path of the saved image
+    :param rgba_img: uint8 array (rows, columns, 4)
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in (".jpg", ".jpeg"):
+        # imsave pastes the image over an opaque background first. The alpha of bloomed images is always opaque,
+        # so the alpha channel is just skipped instead
+        from PIL import Image
+        pil_img = Image.frombuffer("RGBX", (rgba_img.shape[1], rgba_img.shape[0]), rgba_img, "raw", "RGBX", 0, 1)
+        pil_img.save(filename, format="jpeg", dpi=(100, 100))
+    else:
+        import matplotlib.image as mpimg
+        mpimg.imsave(filename, rgba_img)
+
+
+def to_float_rows(img_rows: np.ndarray, float_type) -> np.ndarray:
+    """
+    Converts uint8 rows of an image to float in range [0, 1], as read by read_image and convert_to_float_img
+
+    :param img_rows: uint8 array with some rows of an image
+    :param float_type: np.float32 or np.float64, @see read_image_memmap
+    :return: float array with the pixel data of the rows
+    """
+    if float_type == np.float32:
+        return np.divide(img_rows, 255, dtype=np.float32)
+    return img_rows.astype(np.float64) / 255
+
+
+def quantize_rows(float_rows: np.ndarray, out_rows: np.ndarray):
+    """
+    Converts float rows, in range [0, 1], to uint8 RGBA as matplotlib.image.imsave does
+
+    :param float_rows: float array with some rows of an image
+    :param out_rows: uint8 array (rows, columns, 4) where the result is stored
+    """
+    if float_rows.max(initial=0.) > 1 or float_rows.min(initial=0.) < 0:
+        raise ValueError("Floating point image RGB values must be in the [0,1] range")
+    n_channels = float_rows.shape[2]
+    out_rows[..., 0:n_channels] = quantize_image(float_rows)
+    if n_channels == 3:
+        out_rows[..., 3] = 255
+
+
+def find_bloom_bands(img_memmap: np.ndarray, float_type, cb_colors, radius, delta=0.001,
+                     strip_rows: int = DEFAULT_STRIP_ROWS) -> list:
+    """
+    Finds the bands of rows an image has to be bloomed in, reading it in strips.
+    Each row with cb pixels of any color is widened by radius + 1 rows for each color: each bloom reaches radius rows
+    further, and may create cb pixels of the next colors. The extra row keeps the bloom away from the cut edges, so
+    the equation systems are the same as the ones of the whole image. Overlapping rows are joined in a single band,
+    so the blooms of different bands never meet. Stacking the bands then gives a smaller image with the same
+    equation systems (and unknowns in the same order) as the whole image.
+
+    :param img_memmap: uint8 array with the image
+    :param float_type: float type of the pixel data, @see read_image_memmap
+    :param cb_colors: list of colors to bloom, in float range [0, 1]
+    :param radius: controls how far the bloom is spread (in pixels), or a sequence with the radius of each color
+    :param delta: tolerance used to match the colors, or a sequence with the tolerance of each color
+    :param strip_rows: number of rows read at a time
+    :return: list with the first row and the end of each band, in order. It is empty if no pixel matches
+    """
+    height = img_memmap.shape[0]
+    matched = np.zeros(height, dtype=bool)
+    for row in range(0, height, strip_rows):
+        strip = to_float_rows(img_memmap[row:row + strip_rows], float_type)
+        matched[row:row + strip_rows] = get_matching_pixel_mask(strip, cb_colors, delta).any(axis=1)
+    matched_rows = np.flatnonzero(matched)
+    if len(matched_rows) == 0:
+        return []
+    margin = int(np.sum(np.broadcast_to(radius, (len(cb_colors),)) + 1))
+    # a new band starts where the rows widened from two consecutive matched rows don't overlap
+    band_rows = np.split(matched_rows, np.flatnonzero(np.diff(matched_rows) > 2 * margin) + 1)
+    return [(max(int(rows[0]) - margin, 0), min(int(rows[-1]) + 1 + margin, height)) for rows in band_rows]
+
+
+def bloom_large_image(in_filename: str, out_filename: str, radius, colors, tone_map: str = "clamp", delta=0.001,
+                      strip_rows: int = DEFAULT_STRIP_ROWS, scratch_dir: str = None, solver: str = "direct",
+                      solver_reports: list = None, profile: PipelineProfile = None, dtype=None,
+                      single_pass: bool = False, alpha: str = "straight", **system_options):
+    """
+    Applies the bloom effect to an image file, processing it in strips, and saves the result.
+
+    :param in_filename: path to the image
+    :param out_filename: path of the saved image
+    :param radius: controls how far the bloom is spread (in pixels), or a sequence with the radius of each color
+    :param colors: color to bloom, given in int range [0, 255], or a sequence of them
+    :param tone_map: clamp or reinhard. The result is saved as LDR, so it can't be none
+    :param delta: tolerance used to match the colors, or a sequence with the tolerance of each color
+    :param strip_rows: number of rows processed at a time
+    :param scratch_dir: directory of the temporary files holding the image and the result
+    :param solver: backend used to solve the equation system, @see imgSolverBackends.make_solver
+    :param solver_reports: optional list where the report of each solve is appended
+    :param profile: optional bloomProfile.PipelineProfile recording each stage
+    :param dtype: float type used through the pipeline, @see bloom_effect.bloom
+    :param single_pass: whether to bloom every color with a single system, @see bloom_effect.bloom_colors
+    :param alpha: how the alpha is handled, @see bloom_effect.bloom. Strips are only bloomed with straight alpha
+    :param system_options: options of bloom_effect.BloomSystem (norm and cache) and of the solver backend
+    """
+    if tone_map not in TONE_MAPPINGS or tone_map == "none":
+        raise ValueError("Unsupported tone mapping for large images: {}".format(tone_map))
+    if alpha != "straight":
+        raise ValueError("Unsupported alpha mode for large images: {}".format(alpha))
+    start = time.perf_counter()
+    img_memmap, float_type = read_image_memmap(in_filename, scratch_dir, strip_rows)
+    if dtype is not None:
+        float_type = np.dtype(dtype).type
+    height, width = img_memmap.shape[0:2]
+    start = record_stage_time(profile, "read", start)
+
+    cb_colors = [color_int_to_float(color) for color in np.atleast_2d(colors)]
+    radii = np.broadcast_to(radius, (len(cb_colors),))
+    deltas = np.broadcast_to(delta, (len(cb_colors),))
+    bands = find_bloom_bands(img_memmap, float_type, cb_colors, radii, deltas, strip_rows)
+    record_stage_time(profile, "detection", start)
+
+    # only the rows reached by the bloom are kept as float, and bloomed as a smaller image stacking the bands. The
+    # rows of each band start at its offset
+    band_offsets = np.cumsum([0] + [end - first for first, end in bands])
+    bloomed_rows = np.empty((int(band_offsets[-1]), width, img_memmap.shape[2]), dtype=float_type)
+    for (first, end), offset in zip(bands, band_offsets):
+        bloomed_rows[offset:offset + end - first] = to_float_rows(img_memmap[first:end], float_type)
+    cb_mask = np.zeros(bloomed_rows.shape[0:2], dtype=bool)
+    system_dtype = dtype if dtype is not None else np.float64
+    if len(bands) > 0 and single_pass:
+        cb_mask = bloom_colors(bloomed_rows, cb_colors, radii, deltas, solver, solver_reports, profile,
+                               dtype=system_dtype, **system_options)
+    elif len(bands) > 0:
+        for cb_color, color_radius, color_delta in zip(cb_colors, radii, deltas):
+            cb_mask |= bloom_color(bloomed_rows, cb_color, int(color_radius), float(color_delta), solver,
+                                   solver_reports, profile, dtype=system_dtype, **system_options)
+
+    def iter_strips():
+        """
+        Yields the (first row, end row, bloomed row) of each strip. Strips are cut at the limits of the bands, and
+        bloomed row is the first row of the strip in bloomed_rows, or None if it is out of the bands
+        """
+        row = 0
+        for (first, end), offset in zip(bands, band_offsets):
+            for strip_start in range(row, first, strip_rows):
+                yield strip_start, min(strip_start + strip_rows, first), None
+            for strip_start in range(first, end, strip_rows):
+                yield strip_start, min(strip_start + strip_rows, end), offset + strip_start - first
+            row = end
+        for strip_start in range(row, height, strip_rows):
+            yield strip_start, min(strip_start + strip_rows, height), None
+
+    def get_strip(row, end, bloomed_row):
+        """
+        Returns the float rows of a strip of the bloomed image, along with their cb mask if they were bloomed
+        """
+        if bloomed_row is None:
+            return to_float_rows(img_memmap[row:end], float_type), None
+        rows = slice(bloomed_row, bloomed_row + end - row)
+        return bloomed_rows[rows], cb_mask[rows]
+
+    # Reinhard mapping needs the max luminance of the whole bloomed image first
+    start = time.perf_counter()
+    max_lum = 0.
+    if tone_map == "reinhard":
+        for row, end, bloomed_row in iter_strips():
+            strip, _ = get_strip(row, end, bloomed_row)
+            max_lum = max(max_lum, get_img_max_luminance(strip, strip.shape[0:2]))
+
+    out_memmap = np.memmap(tempfile.TemporaryFile(dir=scratch_dir), dtype=np.uint8, mode="w+",
+                           shape=(height, width, 4))
+    for row, end, bloomed_row in iter_strips():
+        strip, strip_mask = get_strip(row, end, bloomed_row)
+        if tone_map == "reinhard":
+            reinhard_image_mapping(strip, strip.shape[0:2], max_lum, strip_mask)
+        else:
+            clamp_image_colors(strip, strip.shape[0:2])
+        quantize_rows(strip, out_memmap[row:end])
+    start = record_stage_time(profile, "tone_mapping", start)
+
+    write_image_memmap(out_filename, out_memmap)
+    record_stage_time(profile, "save", start)
+    if profile is not None:
+        profile.images += 1
+
+
+def bloom_large_file(in_filename: str, out_filename: str, bloom_options: dict, profile_memory: bool = False):
+    """
+    Same as bloomBatch.bloom_file, but blooms the image with bloom_large_image. Runs in the worker processes.
+
+    :param in_filename: path of the input image
+    :param out_filename: path of the output image
+    :param bloom_options: keyword arguments of bloom_large_image, radius and colors included
+    :param profile_memory: whether the profile measures the peak memory of each stage
+    :return: a tuple with the input filename, the bloomProfile.PipelineProfile of the image, the reports of the
+             solver and a dictionary with the hits and misses of the system cache, if any
+    """
+    profile = PipelineProfile(profile_memory)
+    solver_reports = []
+    cache = bloom_options.get("cache")
+    counts_before = cache.counts() if cache is not None else {}
+    try:
+        bloom_large_image(in_filename, out_filename, profile=profile, solver_reports=solver_reports,
+                          **bloom_options)
+    finally:
+        profile.finish()
+    cache_counts = {name: count - counts_before[name] for name, count in cache.counts().items()} \
+        if cache is not None else {}
+    return in_filename, profile, solver_reports, cache_counts
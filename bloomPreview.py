@@ -0,0 +1,227 @@
+"""
+autor: Valentina Garrido
+
+Multiresolution preview of the bloom effect, for thumbnails and quick looks at a result.
+The cb pixels are pooled into a coarser grid, where a pixel is a cb pixel if any of the pixels it covers is one, and
+the bloom is solved there with the radius scaled to match. The much smaller solution is then interpolated back to
+the pixels within the radius at full resolution, and may be refined with a few jacobi sweeps of the full resolution
+system. preview_deviation measures how far the result is from the full solve.
+
+The deviation of single pixels has no useful bound: next to bright features only a few pixels wide, which pooling
+widens to whole blocks, a pixel may differ from the full solve by most of the range (up to 250 uint8 levels on the
+images in examples/). The mean deviation over the bloomed pixels is what stays bounded, as long as the radius is
+at least BOUND_MIN_RADIUS times the factor (smaller radii are barely a pixel or two on the coarse grid): on
+examples/, with radii up to 40, it is under MEAN_DEVIATION_BOUNDS levels for factors 2 and 4, which the tests
+check. Smoothing only lowers it slightly.
+"""
+
+from bloom_effect import BloomSystem, bloom, quantize_image
+from bloomProfile import PipelineProfile, record_stage_time
+from images import add_to_pixels
+from imgIndices import get_neighbor_pixel_mask, pixel_label_image
+from imgLaplaceSolver import StencilOperator
+import numpy as np
+import time
+
+
+SMOOTHING_WEIGHT = 2 / 3  # weight of the jacobi sweeps, @see imgSolverBackends.GridMultigrid
+MEAN_DEVIATION_BOUNDS = {2: 20., 4: 35.}  # known bound of the mean deviation of each factor, in uint8 levels
+BOUND_MIN_RADIUS = 2  # the bounds hold for radii of at least this many times the factor
+
+
+def pool_labels(color_labels: np.ndarray, factor: int) -> np.ndarray:
+    """
+    Max pooling of a cb mask or of color labels, by blocks of factor x factor pixels. The image is padded with
+    background pixels up to a multiple of factor
+
+    :param color_labels: boolean cb mask, or int color labels with -1 for the pixels that are not cb pixels
+    :param factor: side of the blocks
+    :return: array of the same type, with one pixel per block, which is a cb pixel if any pixel of the block is one
+             (of the last color among them, for color labels)
+    """
+    rows, cols = color_labels.shape
+    coarse_dims = (-(-rows // factor), -(-cols // factor))
+    background = False if color_labels.dtype == bool else -1
+    padded = np.full((coarse_dims[0] * factor, coarse_dims[1] * factor), background, dtype=color_labels.dtype)
+    padded[0:rows, 0:cols] = color_labels
+    return padded.reshape(coarse_dims[0], factor, coarse_dims[1], factor).max(axis=(1, 3))
+
+
+def upsample_bilinear(coarse_field: np.ndarray, factor: int, pixel_indices: np.ndarray, img_dims: tuple) -> np.ndarray:
+    """
+    Interpolates a field given on a coarse grid at some pixels of the full resolution grid. Pixel centers are
+    aligned, so each coarse pixel covers factor x factor full resolution pixels, and the field is extended as
+    constant past the border
+
+    :param coarse_field: array (coarse rows, coarse columns, n_fields) with the field on the coarse grid
+    :param factor: ratio between both resolutions
+    :param pixel_indices: flat indices of the full resolution pixels where the field is interpolated
+    :param img_dims: dimensions of the full resolution image
+    :return: array (len(pixel_indices), n_fields) with the interpolated field
+    """
+    rows, cols = np.divmod(pixel_indices, img_dims[1])
+
+    def axis_weights(positions, size):
+        coarse_positions = np.clip((positions + 0.5) / factor - 0.5, 0, size - 1)
+        first = np.floor(coarse_positions).astype(np.intp)
+        return first, np.minimum(first + 1, size - 1), (coarse_positions - first)[:, None]
+
+    top, bottom, row_weights = axis_weights(rows, coarse_field.shape[0])
+    left, right, col_weights = axis_weights(cols, coarse_field.shape[1])
+    upper = coarse_field[top, left] * (1 - col_weights) + coarse_field[top, right] * col_weights
+    lower = coarse_field[bottom, left] * (1 - col_weights) + coarse_field[bottom, right] * col_weights
+    return upper * (1 - row_weights) + lower * row_weights
+
+
+class PreviewSystem:
+    """
+    Approximate BloomSystem, solved on a grid factor times coarser, @see BloomSystem. The variables at full
+    resolution are the pixels covered by the variables and the cb pixels of the coarse grid (so the bloom reaches as
+    far as the exact one, give or take factor pixels), and their values are interpolated from the coarse solution.
+    Neither the neighbors nor the system are computed at full resolution, and smoothing the result applies the full
+    resolution system without assembling it, @see imgLaplaceSolver.StencilOperator.
+    It's used in the same way as a BloomSystem: solve and apply.
+    """
+    def __init__(self, cb_mask: np.ndarray, radius, solver: str = "direct", profile: PipelineProfile = None,
+                 factor: int = 2, smoothing: int = 0, norm: str = "1", cache=None, dtype=np.float64,
+                 **solver_options):
+        """
+        Constructor. Assembles the coarse system and finds the variables at full resolution
+
+        :param cb_mask: boolean cb mask, or int color labels to bloom several colors, @see BloomSystem
+        :param radius: controls how far the bloom is spread (in full resolution pixels), or a sequence with the
+                       radius of each color
+        :param solver: backend used to solve the coarse system, @see imgSolverBackends.make_solver
+        :param profile: optional bloomProfile.PipelineProfile recording each stage
+        :param factor: ratio between the full and the coarse resolution
+        :param smoothing: number of jacobi sweeps of the full resolution system applied to the interpolated solution
+        :param norm: norm of the distance within which pixels are bloomed, @see BloomSystem
+        :param cache: optional imgSystemCache.SystemCache where the coarse system is looked for
+        :param dtype: float type of the systems and their solution, float64 or float32
+        :param solver_options: options of BloomSystem and of the solver backend
+        """
+        self.color_labels = None if cb_mask.dtype == bool else cb_mask
+        self.cb_mask = cb_mask if self.color_labels is None else cb_mask >= 0
+        n_colors = 1 if self.color_labels is None else len(radius)
+        radii = np.broadcast_to(radius, (n_colors,))
+        self.factor = factor
+        self.smoothing = smoothing
+        self.dtype = dtype
+        self.unit_solution = None
+
+        coarse_radius = [max(int(round(color_radius / factor)), 1) for color_radius in radii]
+        self.coarse_labels = pool_labels(cb_mask, factor)
+        self.coarse_system = BloomSystem(self.coarse_labels, coarse_radius if n_colors > 1 else coarse_radius[0],
+                                         solver, profile, norm=norm, cache=cache, dtype=dtype, **solver_options)
+
+        start = time.perf_counter()
+        coarse_mask = (self.coarse_system.label_img >= 0) | self.coarse_system.cb_mask
+        img_dims = self.cb_mask.shape
+        variable_mask = np.repeat(np.repeat(coarse_mask, factor, axis=0), factor, axis=1)[0:img_dims[0], 0:img_dims[1]]
+        variable_mask &= ~self.cb_mask
+        self.label_img = pixel_label_image(variable_mask)
+        self.var_pixel_indices = np.flatnonzero(self.label_img >= 0)
+        self.n_vars = len(self.var_pixel_indices)
+        record_stage_time(profile, "mapping", start)
+
+    def solve(self, cb_color: np.ndarray, solver_reports: list = None,
+              profile: PipelineProfile = None) -> np.ndarray:
+        """
+        Solves the coarse system, interpolates its solution and multiplies it by the color, @see BloomSystem.solve
+
+        :param cb_color: the color to bloom, in float range [0, 1]. For systems of several colors, an array with
+                         one row per color
+        :param solver_reports: optional list where the report of the coarse solver is appended
+        :param profile: optional bloomProfile.PipelineProfile recording each stage
+        :return: array of shape (n_vars, n_components) with the solution of each color component
+        """
+        cb_colors = np.atleast_2d(cb_color)
+        if self.unit_solution is None and self.n_vars > 0:
+            self.unit_solution = self.interpolate_unit_solution(len(cb_colors), solver_reports, profile)
+            if self.smoothing > 0:
+                self.smooth(profile)
+        if self.n_vars == 0:
+            return np.zeros((0, cb_colors.shape[1]), dtype=self.dtype)
+        return self.unit_solution @ cb_colors.astype(self.unit_solution.dtype)
+
+    def interpolate_unit_solution(self, n_colors: int, solver_reports: list = None,
+                                  profile: PipelineProfile = None) -> np.ndarray:
+        """
+        Solves the coarse system for a unit color (one per color, with several colors) and interpolates the
+        solution at the variables of the full resolution
+
+        :param n_colors: number of colors of the system
+        :param solver_reports: optional list where the report of the coarse solver is appended
+        :param profile: optional bloomProfile.PipelineProfile recording each stage
+        :return: array (n_vars, n_colors) with the interpolated solution
+        """
+        coarse_dims = self.coarse_labels.shape
+        coarse_field = np.zeros((coarse_dims[0] * coarse_dims[1], n_colors), dtype=self.dtype)
+        coarse_field[self.coarse_system.var_pixel_indices] = self.coarse_system.solve(
+            np.eye(n_colors, dtype=self.dtype), solver_reports, profile)
+
+        start = time.perf_counter()
+        # cb pixels are the border condition, where the bloom of their own color is 1
+        cb_indices = np.flatnonzero(self.coarse_system.cb_mask)
+        cb_colors = 0 if self.color_labels is None else self.coarse_labels.ravel()[cb_indices]
+        coarse_field[cb_indices, cb_colors] = 1
+        unit_solution = upsample_bilinear(coarse_field.reshape(coarse_dims + (n_colors,)), self.factor,
+                                          self.var_pixel_indices, self.label_img.shape)
+        record_stage_time(profile, "upsample", start)
+        return unit_solution
+
+    def smooth(self, profile: PipelineProfile = None):
+        """
+        Refines the interpolated solution with weighted jacobi sweeps of the full resolution system, which damp the
+        error of the interpolation between neighboring pixels. Each color is kept where its interpolated bloom reached
+        """
+        start = time.perf_counter()
+        variable_colors = self.unit_solution > 0
+        stencil = StencilOperator(self.label_img, self.dtype)
+        right_hand_side = stencil.right_hand_side(self.cb_mask, self.color_labels,
+                                                  None if self.color_labels is None else self.unit_solution.shape[1])
+        right_hand_side = right_hand_side.reshape(self.unit_solution.shape)
+        start = record_stage_time(profile, "assembly", start)
+        scaled_inverse_diagonal = (SMOOTHING_WEIGHT / stencil.diagonal())[:, None].astype(self.dtype)
+        for _ in range(self.smoothing):
+            self.unit_solution += scaled_inverse_diagonal * (right_hand_side - stencil @ self.unit_solution)
+        self.unit_solution *= variable_colors
+        record_stage_time(profile, "smoothing", start)
+
+    def apply(self, img_mtrx: np.ndarray, cb_color: np.ndarray, solver_reports: list = None,
+              profile: PipelineProfile = None) -> np.ndarray:
+        """
+        Adds, in place, the approximate bloom of a color to an image, @see BloomSystem.apply
+        """
+        color_solutions = self.solve(cb_color, solver_reports, profile)
+        start = time.perf_counter()
+        add_to_pixels(img_mtrx, self.var_pixel_indices, color_solutions)
+        record_stage_time(profile, "scatter", start)
+        return img_mtrx
+
+
+def preview_deviation(image: np.ndarray, radius, colors, factor: int = 2, smoothing: int = 0,
+                      **bloom_options) -> tuple:
+    """
+    Blooms an image exactly and as a preview, and compares both results once quantized to uint8, which is what is
+    finally saved. @see bloom_effect.dtype_deviation and MEAN_DEVIATION_BOUNDS
+    The mean is taken over the pixels either bloom may reach: those within the largest radius, plus factor, of the
+    bloomed pixels. The rest of the image is the same in both, and would only dilute it.
+
+    :param image: matrix with pixel data (rows, columns, channels), either uint8 or float in range [0, 1]
+    :param radius: controls how far the bloom is spread (in pixels), or a sequence with the radius of each color
+    :param colors: color to bloom, given in int range [0, 255], or a sequence of them
+    :param factor: ratio between the full and the coarse resolution of the preview
+    :param smoothing: number of jacobi sweeps of the preview
+    :param bloom_options: other arguments of bloom
+    :return: a tuple with the maximum and the mean absolute difference of each channel, in uint8 levels, over the
+             pixels reached by the bloom
+    """
+    cb_masks = []
+    reference = quantize_image(bloom(image, radius, colors, cb_masks=cb_masks, **bloom_options)).astype(np.int16)
+    preview = quantize_image(bloom(image, radius, colors, preview=factor, smoothing=smoothing, **bloom_options))
+    difference = np.abs(reference - preview)
+    reached_mask = get_neighbor_pixel_mask(cb_masks[0], int(np.max(radius)) + factor, bloom_options.get("norm", "1"))
+    if not reached_mask.any():
+        return difference.max(axis=(0, 1)), np.zeros(difference.shape[2])
+    return difference.max(axis=(0, 1)), difference[reached_mask].mean(axis=0)
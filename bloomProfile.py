@@ -0,0 +1,157 @@
+"""
+autor: Valentina Garrido
+
+Instrumentation of the bloom pipeline. A PipelineProfile records, for each stage (detection, neighbors, mapping,
+assembly, solve, scatter, tone mapping...), the wall time spent in it, how many times it ran and, optionally, the
+peak of memory allocated while it ran, along with the sizes of the problem (bloomed pixels, unknowns, non zeros).
+Stages are closed with record_stage_time, which only reads the clock when no profile is given, so instrumentation
+costs nothing noticeable when disabled.
+"""
+
+import tracemalloc
+import json
+import time
+
+
+class StageProfile:
+    """
+    Simple object with the statistics of a stage of the pipeline
+    """
+    def __init__(self):
+        self.seconds = 0.
+        self.calls = 0
+        self.peak_memory = 0
+
+    def as_dict(self) -> dict:
+        return {"seconds": self.seconds, "calls": self.calls, "peak_memory": self.peak_memory}
+
+
+class PipelineProfile:
+    """
+    Statistics of every stage of the pipeline, for one image or accumulated over several of them.
+    Memory is measured with tracemalloc, which sees numpy arrays but not memory allocated by C libraries (like the
+    factors of SuperLU, which the solver reports account for).
+    """
+    def __init__(self, track_memory: bool = False):
+        """
+        Constructor
+
+        :param track_memory: whether to measure the peak memory of each stage. Tracing allocations slows the
+                             program down, so it's off by default
+        """
+        self.stages = {}
+        self.sizes = {}
+        self.images = 0
+        self.track_memory = track_memory
+        self.memory_measured = track_memory
+        self.started_tracing = False
+        self.memory_baseline = 0
+        if track_memory:
+            self.started_tracing = not tracemalloc.is_tracing()
+            if self.started_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            self.memory_baseline = tracemalloc.get_traced_memory()[0]
+
+    def add_time(self, stage: str, seconds: float):
+        """
+        Adds the time of a run of a stage. With memory tracking, the peak of memory allocated since the last stage
+        is attributed to this one
+
+        :param stage: name of the stage
+        :param seconds: wall time spent in the stage
+        """
+        stage_profile = self.stages.get(stage)
+        if stage_profile is None:
+            stage_profile = self.stages[stage] = StageProfile()
+        stage_profile.seconds += seconds
+        stage_profile.calls += 1
+        if self.track_memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            stage_profile.peak_memory = max(stage_profile.peak_memory, peak - self.memory_baseline)
+            tracemalloc.reset_peak()
+            self.memory_baseline = current
+
+    def add_sizes(self, **sizes):
+        """
+        Adds up sizes of the problem, like add_sizes(bloom_pixels=12, unknowns=340)
+        """
+        for name, value in sizes.items():
+            self.sizes[name] = self.sizes.get(name, 0) + int(value)
+
+    def merge(self, other: "PipelineProfile"):
+        """
+        Accumulates the statistics of another profile, like the one of another image, into this one
+        """
+        for stage, other_stage in other.stages.items():
+            stage_profile = self.stages.get(stage)
+            if stage_profile is None:
+                stage_profile = self.stages[stage] = StageProfile()
+            stage_profile.seconds += other_stage.seconds
+            stage_profile.calls += other_stage.calls
+            stage_profile.peak_memory = max(stage_profile.peak_memory, other_stage.peak_memory)
+        self.add_sizes(**other.sizes)
+        self.images += other.images
+        self.memory_measured = self.memory_measured or other.memory_measured
+
+    def finish(self):
+        """
+        Stops tracing allocations, if this profile started it
+        """
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def total_seconds(self) -> float:
+        return sum(stage_profile.seconds for stage_profile in self.stages.values())
+
+    def as_dict(self) -> dict:
+        """
+        :return: the statistics in a dictionary, which may be dumped as json
+        """
+        return {"images": self.images, "stages": {stage: stage_profile.as_dict()
+                                                  for stage, stage_profile in self.stages.items()},
+                "sizes": dict(self.sizes)}
+
+    def json_line(self, **fields) -> str:
+        """
+        :param fields: extra fields of the line, like the name of the image
+        :return: the statistics as a single line of json, @see as_dict
+        """
+        line = dict(fields)
+        line.update(self.as_dict())
+        return json.dumps(line)
+
+    def table(self) -> str:
+        """
+        :return: a table with the statistics of each stage, followed by the sizes
+        """
+        total = self.total_seconds()
+        lines = ["  {:<14}{:>12}{:>8}{:>8}{:>14}".format("stage", "time (s)", "%", "calls", "peak (MiB)")]
+        for stage, stage_profile in self.stages.items():
+            lines.append("  {:<14}{:>12.4f}{:>8.1f}{:>8}{:>14}".format(
+                stage, stage_profile.seconds, 100 * stage_profile.seconds / total if total > 0 else 0.,
+                stage_profile.calls,
+                "{:.1f}".format(stage_profile.peak_memory / 2**20) if self.memory_measured else "-"))
+        if self.sizes:
+            lines.append("  " + ", ".join("{} {}".format(name.replace("_", " "), value)
+                                          for name, value in self.sizes.items()))
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.table()
+
+
+def record_stage_time(profile: PipelineProfile, stage: str, start: float) -> float:
+    """
+    Adds the time elapsed since start to the time of a stage of the pipeline
+
+    :param profile: PipelineProfile recording each stage, or None to record nothing
+    :param stage: name of the stage
+    :param start: value of time.perf_counter() when the stage started
+    :return: the current value of time.perf_counter(), to be used as start of the next stage
+    """
+    now = time.perf_counter()
+    if profile is not None:
+        profile.add_time(stage, now - start)
+    return now
@@ -0,0 +1,573 @@
+"""
+autor: Valentina Garrido
+
+Local HTTP service applying the bloom effect, so that programs don't have to start the command line program (and
+import numpy, scipy and matplotlib, and write the images to disk) for every image.
+
+    POST /bloom?radius=N&color=R,G,B[&color=R,G,B...][&tone_map=clamp|reinhard][&delta=TOL][&norm=1|2|inf]
+               [&preview=FACTOR][&smoothing=SWEEPS][&alpha=straight|premultiplied|blend]
+
+takes the bytes of an image file as body and answers with the bloomed image, in the same format. Several colors
+are bloomed in a single pass, @see bloom_effect.bloom_colors. GET /metrics answers with the counters and the
+latency histograms of the service, in the Prometheus text format, and GET /health with ok.
+
+Images are decoded, their cb pixels found and the result tone mapped and encoded by a pool of threads, and the
+equation systems, which take most of the time, are assembled and solved by a bounded pool of worker processes that
+are started once. Concurrent requests with the same system (same cb pixels, radius and options, any color or tone
+mapping) share a single assembly and solve. Requests over the admission limit are answered right away with
+503 Service Unavailable, and those taking longer than the timeout with 504 Gateway Timeout. A request keeps its
+place in the admission limit until its work ends, even if it was answered with 504, so the work queued for the
+workers stays bounded. Clients that don't send their whole request within the read timeout get 408 Request Timeout.
+The service speaks a minimal HTTP/1.1: one request per connection, with a Content-Length body.
+"""
+
+from bloom_effect import read_image, save_image, detect_cb_pixels, detect_color_labels, tone_map_image, \
+    alpha_visibility, TONE_MAPPINGS, ALPHA_MODES
+from bloomBatch import limit_blas_threads
+from colors import color_int_to_float
+from images import add_to_pixels, split_alpha, merge_alpha, blend_alpha
+from imgIndices import NEIGHBOR_NORMS
+from imgSolverBackends import SOLVER_BACKENDS, PRECONDITIONERS
+from imgSystemCache import mask_key
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import multiprocessing
+import numpy as np
+import argparse
+import asyncio
+import time
+import io
+
+
+DEFAULT_PORT = 8080
+DEFAULT_MAX_PENDING = 32
+DEFAULT_TIMEOUT = 30.  # seconds
+DEFAULT_READ_TIMEOUT = 10.  # seconds
+DEFAULT_MAX_BODY = 64 * 2**20  # bytes
+MAX_HEADER_LINES = 100
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.)
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                408: "Request Timeout", 413: "Payload Too Large", 500: "Internal Server Error",
+                503: "Service Unavailable", 504: "Gateway Timeout"}
+
+CONTENT_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "bmp": "image/bmp", "gif": "image/gif",
+                 "tiff": "image/tiff"}
+
+
+class HttpError(Exception):
+    """
+    Error answered to the client with an HTTP status
+    """
+    def __init__(self, status: int, message: str, headers: dict = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+class LatencyHistogram:
+    """
+    Cumulative histogram of latencies, with fixed buckets
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+
+    def lines(self, name: str, labels: str) -> list:
+        """
+        :return: the lines of the histogram in the Prometheus text format
+        """
+        separator = "," if labels else ""
+        lines = ['{}_bucket{{{}{}le="{}"}} {}'.format(name, labels, separator, bound, count)
+                 for bound, count in zip(self.buckets, self.counts)]
+        lines.append('{}_bucket{{{}{}le="+Inf"}} {}'.format(name, labels, separator, self.count))
+        lines.append("{}_sum{{{}}} {:.6f}".format(name, labels, self.sum))
+        lines.append("{}_count{{{}}} {}".format(name, labels, self.count))
+        return lines
+
+
+class ServiceMetrics:
+    """
+    Counters and latency histograms of the service
+    """
+    def __init__(self):
+        self.responses = {}  # (path, status) -> count
+        self.request_latency = {}  # path -> LatencyHistogram
+        self.stage_latency = {}  # stage -> LatencyHistogram
+        self.coalesced = 0
+        self.systems_solved = 0
+        self.in_flight = 0
+        self.start = time.time()
+
+    def observe_request(self, path: str, status: int, seconds: float):
+        self.responses[(path, status)] = self.responses.get((path, status), 0) + 1
+        self.request_latency.setdefault(path, LatencyHistogram()).observe(seconds)
+
+    def observe_stage(self, stage: str, seconds: float):
+        self.stage_latency.setdefault(stage, LatencyHistogram()).observe(seconds)
+
+    def text(self) -> str:
+        """
+        :return: the metrics in the Prometheus text format
+        """
+        lines = ["# TYPE bloom_responses_total counter"]
+        lines += ['bloom_responses_total{{path="{}",status="{}"}} {}'.format(path, status, count)
+                  for (path, status), count in sorted(self.responses.items())]
+        lines.append("# TYPE bloom_request_seconds histogram")
+        for path, histogram in sorted(self.request_latency.items()):
+            lines += histogram.lines("bloom_request_seconds", 'path="{}"'.format(path))
+        lines.append("# TYPE bloom_stage_seconds histogram")
+        for stage, histogram in sorted(self.stage_latency.items()):
+            lines += histogram.lines("bloom_stage_seconds", 'stage="{}"'.format(stage))
+        lines += ["# TYPE bloom_systems_solved_total counter",
+                  "bloom_systems_solved_total {}".format(self.systems_solved),
+                  "# TYPE bloom_requests_coalesced_total counter",
+                  "bloom_requests_coalesced_total {}".format(self.coalesced),
+                  "# TYPE bloom_requests_in_flight gauge",
+                  "bloom_requests_in_flight {}".format(self.in_flight),
+                  "# TYPE bloom_uptime_seconds gauge",
+                  "bloom_uptime_seconds {:.3f}".format(time.time() - self.start)]
+        return "\n".join(lines) + "\n"
+
+
+def parse_bloom_query(query: str) -> dict:
+    """
+    Reads the parameters of a bloom request
+
+    :param query: query string of the request
+    :return: dictionary with the colors (in float range [0, 1]), radius, delta, tone_map, norm, preview, smoothing
+             and alpha of the request
+    :raises HttpError: with status 400, if a parameter is missing or invalid
+    """
+    params = parse_qs(query, keep_blank_values=True)
+
+    def single(name, convert, default=None):
+        values = params.get(name)
+        if not values:
+            if default is None:
+                raise HttpError(400, "missing parameter: {}".format(name))
+            return default
+        try:
+            return convert(values[-1])
+        except ValueError:
+            raise HttpError(400, "invalid {}: {}".format(name, values[-1]))
+
+    colors = []
+    for value in params.get("color", []):
+        try:
+            color = [int(component) for component in value.split(",")]
+        except ValueError:
+            color = []
+        if len(color) != 3 or not all(0 <= component <= 255 for component in color):
+            raise HttpError(400, "invalid color: {}, expected R,G,B in range [0, 255]".format(value))
+        colors.append(color_int_to_float(color))
+    if not colors:
+        raise HttpError(400, "missing parameter: color")
+    radius = single("radius", int)
+    tone_map = single("tone_map", str, "clamp")
+    norm = single("norm", str, "1")
+    preview = single("preview", int, 1)
+    smoothing = single("smoothing", int, 0)
+    alpha = single("alpha", str, "straight")
+    if radius < 0 or preview < 1 or smoothing < 0:
+        raise HttpError(400, "radius, preview and smoothing can't be negative (nor preview 0)")
+    if tone_map not in TONE_MAPPINGS or tone_map == "none":
+        raise HttpError(400, "invalid tone_map: {}".format(tone_map))
+    if norm not in NEIGHBOR_NORMS:
+        raise HttpError(400, "invalid norm: {}".format(norm))
+    if alpha not in ALPHA_MODES:
+        raise HttpError(400, "invalid alpha: {}".format(alpha))
+    return {"colors": np.array(colors), "radius": radius, "delta": single("delta", float, 0.001),
+            "tone_map": tone_map, "norm": norm, "preview": preview, "smoothing": smoothing, "alpha": alpha}
+
+
+def decode_image(data: bytes, colors: np.ndarray, delta: float, dtype=None, alpha: str = "straight") -> tuple:
+    """
+    Decodes an image file and finds its cb pixels. Runs in the thread pool.
+    The image is decoded as read_image reads files, so the result is the same as the one of the command line program.
+    Since all the cb pixels are found before the bloom, the colors are premultiplied right away if the alpha isn't
+    straight, @see bloom_effect.alpha_visibility
+
+    :param data: bytes of the image file
+    :param colors: colors to bloom, in float range [0, 1]
+    :param delta: tolerance used to match the colors
+    :param dtype: float type used through the pipeline, @see bloom_effect.bloom
+    :param alpha: how the alpha of the image is handled, @see bloom_effect.bloom
+    :return: a tuple with the float colors and alpha of the image (@see images.split_alpha), its format (png,
+             jpeg...) and the cb mask, or the color labels with several colors
+    """
+    from PIL import Image, UnidentifiedImageError
+    try:
+        with Image.open(io.BytesIO(data)) as pil_img:
+            image_format = pil_img.format.lower()
+        img_colors, img_alpha = split_alpha(read_image(io.BytesIO(data), image_format), dtype)
+    except (UnidentifiedImageError, OSError, SyntaxError, ValueError) as error:
+        raise HttpError(400, "invalid image: {}".format(error))
+    visible_mask, hidden_colors = alpha_visibility(img_colors, img_alpha, alpha)
+    if len(colors) == 1:
+        cb_mask = detect_cb_pixels(img_colors, colors[0], delta, visible_mask=visible_mask)
+    else:
+        cb_mask = detect_color_labels(img_colors, colors, delta, visible_mask=visible_mask)
+    if hidden_colors is not None:
+        img_colors -= hidden_colors
+    return img_colors, img_alpha, image_format, cb_mask
+
+
+def solve_system(cb_mask: np.ndarray, radius, system_options: dict) -> tuple:
+    """
+    Assembles and solves the bloom system of some cb pixels, for a unit color. Runs in the worker processes
+
+    :param cb_mask: boolean cb mask, or color labels, @see bloom_effect.BloomSystem
+    :param radius: controls how far the bloom is spread (in pixels), or a sequence with the radius of each color
+    :param system_options: arguments of bloom_effect.make_bloom_system, along with the system cache directory
+    :return: a tuple with the flat indices of the bloomed pixels, the unit solution of each color (an array of
+             shape (n_vars, n_colors)) and the report of the solver, if the system was solved
+    """
+    from bloom_effect import make_bloom_system
+
+    system_options = dict(system_options)
+    cache_dir = system_options.pop("cache_dir", None)
+    if cache_dir is not None:
+        from imgSystemCache import SystemCache
+        system_options["cache"] = SystemCache(cache_dir, system_options.pop("cache_size"))
+    else:
+        system_options.pop("cache_size", None)
+    n_colors = 1 if cb_mask.dtype == bool else len(radius)
+    bloom_system = make_bloom_system(cb_mask, radius, **system_options)
+    solver_reports = []
+    unit_solution = bloom_system.solve(np.eye(n_colors, dtype=bloom_system.dtype), solver_reports)
+    return bloom_system.var_pixel_indices, unit_solution, solver_reports[0] if solver_reports else None
+
+
+def render_image(img_colors: np.ndarray, img_alpha: np.ndarray, image_format: str, cb_mask: np.ndarray,
+                 var_pixel_indices: np.ndarray, unit_solution: np.ndarray, colors: np.ndarray, tone_map: str,
+                 alpha: str = "straight") -> bytes:
+    """
+    Adds the bloom to an image, tone maps it and encodes it. Runs in the thread pool
+
+    :param img_colors: float colors of the image, bloomed in place
+    :param img_alpha: float alpha of the image, or None
+    :param image_format: format of the encoded image
+    :param cb_mask: cb mask or color labels of the image
+    :param var_pixel_indices: flat indices of the bloomed pixels
+    :param unit_solution: unit solution of each color, @see solve_system
+    :param colors: colors to bloom, in float range [0, 1]
+    :param tone_map: clamp or reinhard
+    :param alpha: how the alpha of the image is handled, @see bloom_effect.bloom
+    :return: bytes of the image file
+    """
+    add_to_pixels(img_colors, var_pixel_indices, unit_solution @ colors.astype(unit_solution.dtype))
+    tone_map_image(img_colors, tone_map, cb_mask if cb_mask.dtype == bool else cb_mask >= 0)
+    if alpha == "blend" and img_alpha is not None:
+        blend_alpha(img_colors, img_alpha)
+    out_file = io.BytesIO()
+    save_image(out_file, merge_alpha(img_colors, img_alpha), image_format)
+    return out_file.getvalue()
+
+
+def warm_up():
+    """
+    Imports the bloom pipeline, along with matplotlib, which is otherwise imported by the first image read
+    """
+    import matplotlib.image
+    import bloom_effect
+    return bloom_effect.IMPORT_TIME_BUDGET
+
+
+class BloomService:
+    """
+    HTTP bloom service. @see the module documentation
+    """
+    def __init__(self, workers: int = 1, threads: int = None, max_pending: int = DEFAULT_MAX_PENDING,
+                 timeout: float = DEFAULT_TIMEOUT, max_body: int = DEFAULT_MAX_BODY, blas_threads: int = None,
+                 dtype=None, read_timeout: float = DEFAULT_READ_TIMEOUT, **system_options):
+        """
+        Constructor. Starts the worker processes
+
+        :param workers: number of worker processes solving the systems
+        :param threads: number of threads decoding, rendering and encoding the images. Defaults to workers + 1
+        :param max_pending: maximum number of bloom requests being processed, counting those answered with 504
+                            until their work ends. Requests over it are answered with 503 Service Unavailable
+        :param timeout: seconds after which a bloom request is answered with 504 Gateway Timeout
+        :param max_body: maximum size of an image, in bytes
+        :param blas_threads: maximum number of BLAS threads of each worker, or None to leave the defaults
+        :param dtype: float type used through the pipeline, @see bloom_effect.bloom
+        :param read_timeout: seconds given to a client to send its whole request, after which it's answered with
+                             408 Request Timeout
+        :param system_options: options of the bloom systems (solver, solver options, and cache_dir and
+                               cache_size for a system cache shared by the workers), @see solve_system
+        """
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.read_timeout = read_timeout
+        self.max_body = max_body
+        self.dtype = dtype
+        self.system_dtype = np.dtype(dtype if dtype is not None else np.float64)
+        self.system_options = dict(system_options, dtype=self.system_dtype)
+        self.metrics = ServiceMetrics()
+        self.solving = {}  # system key -> future of its solution, shared by the requests with that system
+        limit_blas_threads(blas_threads)
+        self.process_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=limit_blas_threads, initargs=(blas_threads,))
+        self.thread_pool = ThreadPoolExecutor(max_workers=threads or workers + 1)
+        self.workers = workers
+        self.server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = DEFAULT_PORT) -> "BloomService":
+        """
+        Starts the worker processes and listens for requests
+
+        :param host: address listened to
+        :param port: port listened to. 0 picks a free one, @see port
+        :return: self
+        """
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(loop.run_in_executor(self.thread_pool, warm_up),
+                             *[loop.run_in_executor(self.process_pool, warm_up) for _ in range(self.workers)])
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self
+
+    @property
+    def port(self) -> int:
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.process_pool.shutdown(cancel_futures=True)
+        self.thread_pool.shutdown(cancel_futures=True)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Reads a request, answers it and closes the connection
+        """
+        start = time.perf_counter()
+        path, status = "other", 500
+        try:
+            try:
+                try:
+                    method, target, body = await asyncio.wait_for(self.read_request(reader), self.read_timeout)
+                except asyncio.TimeoutError:
+                    raise HttpError(408, "the request wasn't received within {} s".format(self.read_timeout))
+                url = urlsplit(target)
+                path = url.path if url.path in ("/bloom", "/metrics", "/health") else "other"
+                status, headers, content = await self.dispatch(method, url.path, url.query, body)
+            except HttpError as error:
+                status, headers, content = error.status, dict(error.headers), (str(error) + "\n").encode()
+                headers["Content-Type"] = "text/plain; charset=utf-8"
+            except Exception as error:
+                status, headers = 500, {"Content-Type": "text/plain; charset=utf-8"}
+                content = "{}: {}\n".format(type(error).__name__, error).encode()
+            await self.write_response(writer, status, headers, content)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            self.metrics.observe_request(path, status, time.perf_counter() - start)
+
+    async def read_request(self, reader: asyncio.StreamReader) -> tuple:
+        """
+        :return: a tuple with the method, target and body of the request
+        """
+        try:
+            method, target, _ = (await reader.readline()).decode("latin-1").split()
+        except ValueError:
+            raise HttpError(400, "malformed request line")
+        headers = {}
+        for _ in range(MAX_HEADER_LINES):
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise HttpError(400, "too many headers")
+        if "chunked" in headers.get("transfer-encoding", ""):
+            raise HttpError(400, "chunked bodies are not supported, give a Content-Length")
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise HttpError(400, "invalid Content-Length")
+        if length > self.max_body:
+            raise HttpError(413, "images are limited to {} bytes".format(self.max_body))
+        return method, target, await reader.readexactly(length) if length > 0 else b""
+
+    @staticmethod
+    async def write_response(writer: asyncio.StreamWriter, status: int, headers: dict, content: bytes):
+        head = ["HTTP/1.1 {} {}".format(status, HTTP_REASONS.get(status, "")),
+                "Content-Length: {}".format(len(content)), "Connection: close"]
+        head += ["{}: {}".format(name, value) for name, value in headers.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + content)
+        await writer.drain()
+
+    async def dispatch(self, method: str, path: str, query: str, body: bytes) -> tuple:
+        """
+        :return: a tuple with the status, headers and content of the response
+        """
+        if path == "/metrics" or path == "/health":
+            if method != "GET":
+                raise HttpError(405, "{} only accepts GET".format(path), {"Allow": "GET"})
+            content = self.metrics.text() if path == "/metrics" else "ok\n"
+            return 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}, content.encode()
+        if path != "/bloom":
+            raise HttpError(404, "unknown path: {}".format(path))
+        if method != "POST":
+            raise HttpError(405, "/bloom only accepts POST, with the image as body", {"Allow": "POST"})
+        if self.metrics.in_flight >= self.max_pending:
+            raise HttpError(503, "too many requests in progress, try again later", {"Retry-After": "1"})
+        self.metrics.in_flight += 1
+        # the bloom goes on after a timeout, since the workers can't drop its solve, and it keeps its place in the
+        # admission limit until it ends
+        bloom_task = asyncio.ensure_future(self.bloom(query, body))
+        bloom_task.add_done_callback(self.release_request)
+        try:
+            image_format, content = await asyncio.wait_for(asyncio.shield(bloom_task), self.timeout)
+        except asyncio.TimeoutError:
+            raise HttpError(504, "the bloom took longer than {} s".format(self.timeout))
+        return 200, {"Content-Type": CONTENT_TYPES.get(image_format, "application/octet-stream")}, content
+
+    def release_request(self, bloom_task: asyncio.Future):
+        self.metrics.in_flight -= 1
+        if not bloom_task.cancelled():
+            # retrieved here too, as nobody awaits the bloom of a request that timed out
+            bloom_task.exception()
+
+    async def bloom(self, query: str, body: bytes) -> tuple:
+        """
+        Blooms the image of a request
+
+        :return: a tuple with the format of the image and the bytes of the bloomed image
+        """
+        params = parse_bloom_query(query)
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        img_colors, img_alpha, image_format, cb_mask = await loop.run_in_executor(
+            self.thread_pool, decode_image, body, params["colors"], params["delta"], self.dtype, params["alpha"])
+        start = self.observe_stage("decode", start)
+
+        radius = params["radius"] if len(params["colors"]) == 1 else [params["radius"]] * len(params["colors"])
+        var_pixel_indices, unit_solution = await self.solve(cb_mask, radius, params)
+        start = self.observe_stage("solve", start)
+
+        content = await loop.run_in_executor(self.thread_pool, render_image, img_colors, img_alpha, image_format,
+                                             cb_mask, var_pixel_indices, unit_solution, params["colors"],
+                                             params["tone_map"], params["alpha"])
+        self.observe_stage("render", start)
+        return image_format, content
+
+    async def solve(self, cb_mask: np.ndarray, radius, params: dict) -> tuple:
+        """
+        Solves the system of some cb pixels in the worker processes, or waits for the solve of a concurrent request
+        with the same system
+
+        :return: a tuple with the flat indices of the bloomed pixels and the unit solution of each color
+        """
+        system_options = dict(self.system_options, norm=params["norm"], preview=params["preview"],
+                              smoothing=params["smoothing"])
+        key = (mask_key(cb_mask, radius, params["norm"], self.system_dtype), params["preview"],
+               params["smoothing"])
+        future = self.solving.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = asyncio.ensure_future(loop.run_in_executor(self.process_pool, solve_system, cb_mask, radius,
+                                                                system_options))
+            self.solving[key] = future
+            future.add_done_callback(lambda _: self.solving.pop(key, None))
+            future.add_done_callback(self.count_solved)
+        else:
+            self.metrics.coalesced += 1
+        # a request timing out must not cancel the solve shared with the others
+        var_pixel_indices, unit_solution, _ = await asyncio.shield(future)
+        return var_pixel_indices, unit_solution
+
+    def count_solved(self, future: asyncio.Future):
+        if not future.cancelled() and future.exception() is None:
+            self.metrics.systems_solved += 1
+
+    def observe_stage(self, stage: str, start: float) -> float:
+        """
+        Records the time since start of a stage of a bloom request
+
+        :return: the current time, to start the next stage
+        """
+        now = time.perf_counter()
+        self.metrics.observe_stage(stage, now - start)
+        return now
+
+
+parser = argparse.ArgumentParser(description="Local HTTP service applying the bloom effect to images")
+parser.add_argument("--host", help="Address listened to", default="127.0.0.1")
+parser.add_argument("--port", help="Port listened to", type=int, default=DEFAULT_PORT)
+parser.add_argument("--workers", help="Number of worker processes solving the equation systems", type=int, default=1)
+parser.add_argument("--threads", help="Number of threads decoding and encoding the images. Defaults to workers + 1",
+                    type=int, default=None)
+parser.add_argument("--max-pending", help="Maximum number of bloom requests in progress, counting those answered "
+                                          "with 504 until their work ends. Requests over it are answered with 503",
+                    type=int, default=DEFAULT_MAX_PENDING)
+parser.add_argument("--timeout", help="Seconds after which a bloom request is answered with 504", type=float,
+                    default=DEFAULT_TIMEOUT)
+parser.add_argument("--read-timeout", help="Seconds given to a client to send its request, after which it's answered "
+                                           "with 408", type=float, default=DEFAULT_READ_TIMEOUT)
+parser.add_argument("--max-body", help="Maximum size of an image, in MiB", type=float,
+                    default=DEFAULT_MAX_BODY / 2**20)
+parser.add_argument("--blas-threads", help="Maximum number of BLAS threads of each worker", type=int, default=None)
+parser.add_argument("--solver", help="Backend used to solve the equation systems", choices=list(SOLVER_BACKENDS),
+                    default="direct")
+parser.add_argument("--preconditioner", help="Preconditioner of the cg, minres and matrix-free solvers (sor only with "
+                                             "matrix-free, ichol not with it). jacobi by default, multigrid always "
+                                             "uses its V-cycle", choices=PRECONDITIONERS,
+                    default=None)
+parser.add_argument("--tol", help="Relative tolerance of the iterative solvers", type=float, default=1e-8)
+parser.add_argument("--max-iter", help="Maximum iterations of the iterative solvers", type=int, default=None)
+parser.add_argument("--dtype", help="Float type used through the whole pipeline", choices=("float32", "float64"),
+                    default=None)
+parser.add_argument("--cache-dir", help="Directory of a cache of equation systems shared by the workers",
+                    default=None)
+parser.add_argument("--cache-size", help="Maximum size of the cache, in MiB", type=float, default=1024)
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    if args.preconditioner == "sor" and args.solver != "matrix-free":
+        parser.error("--preconditioner sor only works with --solver matrix-free")
+    if args.solver == "matrix-free" and args.preconditioner == "ichol":
+        parser.error("--solver matrix-free has no assembled matrix to use --preconditioner ichol")
+    if args.solver == "multigrid":
+        if args.preconditioner is not None:
+            parser.error("--solver multigrid is always preconditioned with its V-cycle, don't give --preconditioner")
+        args.preconditioner = "multigrid"
+    elif args.preconditioner is None:
+        args.preconditioner = "jacobi"
+    service = BloomService(args.workers, args.threads, args.max_pending, args.timeout, int(args.max_body * 2**20),
+                           args.blas_threads, solver=args.solver, preconditioner=args.preconditioner, tol=args.tol,
+                           max_iter=args.max_iter, dtype=args.dtype, read_timeout=args.read_timeout,
+                           cache_dir=args.cache_dir, cache_size=int(args.cache_size * 2**20))
+
+    async def serve():
+        await service.start(args.host, args.port)
+        print("bloom service listening on http://{}:{}".format(args.host, service.port), flush=True)
+        try:
+            await service.server.serve_forever()
+        finally:
+            await service.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""
+autor: Valentina Garrido
+
+Interactive bloom of an image, for tuning the radius or touching up the pixels to bloom while looking at the result.
+A BloomSession keeps everything found for the previous result: the distance of every pixel to the pixels of each
+color, the cb mask, the variables and their numbering, the equation system and its solution. When the radius or a
+few pixels change:
+
+* the variables are found again by thresholding the kept distances (which are only computed again around the
+  pixels that changed, or everywhere if the radius grows past what they are known for)
+* only the rows of the system next to a pixel that changed are computed again, @see
+  imgLaplaceSolver.update_equation_system_from_labels
+* the previous solution, renumbered, is the starting point of the iterative solvers, which then need far fewer
+  iterations to converge
+"""
+
+from bloom_effect import detect_color_labels, tone_map_image, solve_coupled_colors, TONE_MAPPINGS
+from bloomProfile import PipelineProfile, record_stage_time
+from colors import color_int_to_float
+from images import add_to_pixels, split_alpha, merge_alpha
+from imgIndices import get_matching_color_labels, pixel_distance_map, pixel_label_image, NEIGHBOR_NORMS
+from imgLaplaceSolver import build_equation_system_from_labels, update_equation_system_from_labels
+from imgSolverBackends import make_solver, KrylovSolver
+from scipy.sparse import csr_matrix
+import numpy as np
+import time
+
+
+class BloomSession:
+    """
+    Bloom of an image that is updated as its radius or its pixels change. Colors are bloomed in a single pass,
+    @see bloom_effect.bloom_colors, which for a single color is the same as bloom_effect.bloom.
+    """
+    def __init__(self, image: np.ndarray, radius, colors, tone_map: str = "clamp", delta=0.001, norm: str = "1",
+                 solver: str = "cg", dtype=None, profile: PipelineProfile = None, **solver_options):
+        """
+        Constructor. Finds the pixels to bloom and solves the first system
+
+        :param image: matrix with pixel data (rows, columns, channels), either uint8 or float in range [0, 1], gray,
+                      RGB or RGBA, @see images.split_alpha. It is copied, so it may be changed afterwards
+        :param radius: controls how far the bloom is spread (in pixels), or a sequence with the radius of each color
+        :param colors: color to bloom, given in int range [0, 255], or a sequence of them
+        :param tone_map: clamp, reinhard, or none to get HDR results
+        :param delta: tolerance used to match the colors, or a sequence with the tolerance of each color
+        :param norm: norm of the distance within which pixels are bloomed, @see bloom_effect.BloomSystem
+        :param solver: backend used to solve the equation system, @see imgSolverBackends.make_solver. Only the
+                       iterative ones (cg, minres and multigrid) start from the previous solution
+        :param dtype: float type used through the pipeline, @see bloom_effect.bloom
+        :param profile: optional bloomProfile.PipelineProfile recording the stages of every update
+        :param solver_options: options of the solver backend, like a looser tol for faster previews
+        """
+        if tone_map not in TONE_MAPPINGS:
+            raise ValueError("Unknown tone mapping: {}".format(tone_map))
+        if str(norm) not in NEIGHBOR_NORMS:
+            raise ValueError("Unknown norm: {}".format(norm))
+        img_colors, img_alpha = split_alpha(image, dtype)
+        # the colors and the alpha are kept apart, @see images.split_alpha, and the alpha is left as given
+        self.image = img_colors.copy() if np.may_share_memory(img_colors, image) else img_colors
+        self.alpha = None if img_alpha is None else img_alpha.copy()
+        self.cb_colors = np.array([color_int_to_float(color) for color in np.atleast_2d(colors)])
+        self.radii = [int(color_radius) for color_radius in np.broadcast_to(radius, (len(self.cb_colors),))]
+        self.deltas = np.broadcast_to(delta, (len(self.cb_colors),)).astype(np.float64)
+        self.tone_map = tone_map
+        self.norm = str(norm)
+        self.solver_name = solver
+        self.solver_options = solver_options
+        self.dtype = dtype if dtype is not None else np.float64
+        self.profile = profile
+        self.solver_reports = []
+
+        # state of the last result
+        self.color_labels = detect_color_labels(self.image, self.cb_colors, self.deltas, profile)
+        self.distances = None
+        self.distance_bound = np.inf  # distances up to this value are exact
+        self.label_img = None
+        self.var_pixel_indices = None
+        self.variable_colors = None
+        self.sparse_matrix = None
+        self.right_hand_side = None
+        self.solution = None
+        self.rebuilt_rows = 0
+
+        start = time.perf_counter()
+        self.distances = [self._distance_map(self.color_labels == color) for color in range(len(self.cb_colors))]
+        record_stage_time(profile, "neighbors", start)
+        self._update_system()
+
+    @property
+    def cb_mask(self) -> np.ndarray:
+        """
+        :return: the border condition (cb) mask of the system, or the color labels if there are several colors
+        """
+        return self.color_labels >= 0 if len(self.cb_colors) == 1 else self.color_labels
+
+    def _distance_map(self, pixel_mask: np.ndarray) -> np.ndarray:
+        return np.asarray(pixel_distance_map(pixel_mask, self.norm), dtype=np.float32)
+
+    def set_radius(self, radius) -> np.ndarray:
+        """
+        Changes the radius of the bloom
+
+        :param radius: the new radius, or a sequence with the radius of each color
+        :return: the bloomed image, @see render
+        """
+        self.radii = [int(color_radius) for color_radius in np.broadcast_to(radius, (len(self.cb_colors),))]
+        if max(self.radii) > self.distance_bound:
+            start = time.perf_counter()
+            self.distances = [self._distance_map(self.color_labels == color) for color in range(len(self.cb_colors))]
+            self.distance_bound = np.inf
+            record_stage_time(self.profile, "neighbors", start)
+        self._update_system()
+        return self.render()
+
+    def update_region(self, top: int, left: int, pixels: np.ndarray) -> np.ndarray:
+        """
+        Replaces some pixels of the image, like after painting over it, and updates the bloom
+
+        :param top: first row of the replaced pixels
+        :param left: first column of the replaced pixels
+        :param pixels: matrix with the new pixel data of a rectangle of the image, of the type of the image given
+                       to the constructor
+        :return: the bloomed image, @see render
+        """
+        pixels, pixels_alpha = split_alpha(pixels, self.image.dtype)
+        bottom, right = top + pixels.shape[0], left + pixels.shape[1]
+        self.image[top:bottom, left:right] = pixels
+        if self.alpha is not None and pixels_alpha is not None:
+            self.alpha[top:bottom, left:right] = pixels_alpha
+
+        start = time.perf_counter()
+        region_labels = get_matching_color_labels(self.image[top:bottom, left:right], self.cb_colors, self.deltas)
+        old_labels = self.color_labels[top:bottom, left:right].copy()
+        changed = region_labels != old_labels
+        start = record_stage_time(self.profile, "detection", start)
+        if not changed.any():
+            return self.render()
+
+        # the distances of each color are computed again around its pixels that changed, within a margin where they
+        # may reach the bloom. Farther away, distances over the largest radius may be outdated
+        margin = max(self.radii)
+        img_dims = self.color_labels.shape
+        self.color_labels[top:bottom, left:right] = region_labels
+        for color in range(len(self.cb_colors)):
+            color_changed = changed & ((region_labels == color) | (old_labels == color))
+            if not color_changed.any():
+                continue
+            changed_rows, changed_cols = np.nonzero(color_changed)
+            box = (top + changed_rows.min(), top + changed_rows.max() + 1,
+                   left + changed_cols.min(), left + changed_cols.max() + 1)
+            inner = (max(box[0] - margin, 0), min(box[1] + margin, img_dims[0]),
+                     max(box[2] - margin, 0), min(box[3] + margin, img_dims[1]))
+            outer = (max(box[0] - 2 * margin - 1, 0), min(box[1] + 2 * margin + 1, img_dims[0]),
+                     max(box[2] - 2 * margin - 1, 0), min(box[3] + 2 * margin + 1, img_dims[1]))
+            crop_distances = self._distance_map(self.color_labels[outer[0]:outer[1], outer[2]:outer[3]] == color)
+            self.distances[color][inner[0]:inner[1], inner[2]:inner[3]] = crop_distances[
+                inner[0] - outer[0]:inner[1] - outer[0], inner[2] - outer[2]:inner[3] - outer[2]]
+        self.distance_bound = min(self.distance_bound, margin)
+        record_stage_time(self.profile, "neighbors", start)
+        self._update_system()
+        return self.render()
+
+    def _update_system(self):
+        """
+        Finds the variables of the current radii and cb pixels, updates the system and solves it
+        """
+        start = time.perf_counter()
+        cb_mask = self.color_labels >= 0
+        color_masks = [(distances <= color_radius) & ~cb_mask
+                       for distances, color_radius in zip(self.distances, self.radii)]
+        variable_mask = np.logical_or.reduce(color_masks, axis=0)
+        start = record_stage_time(self.profile, "neighbors", start)
+
+        label_img = pixel_label_image(variable_mask)
+        var_pixel_indices = np.flatnonzero(label_img >= 0)
+        n_vars = len(var_pixel_indices)
+        self.variable_colors = np.stack([color_mask.ravel()[var_pixel_indices] for color_mask in color_masks], axis=1)
+        start = record_stage_time(self.profile, "mapping", start)
+
+        if self.sparse_matrix is None:
+            sparse_matrix, right_hand_side = build_equation_system_from_labels(
+                label_img, cb_mask, self.dtype, None if len(self.cb_colors) == 1 else self.color_labels,
+                len(self.cb_colors))
+            sparse_matrix = csr_matrix(sparse_matrix)
+            self.rebuilt_rows = n_vars
+        else:
+            sparse_matrix, right_hand_side, self.rebuilt_rows = update_equation_system_from_labels(
+                self.sparse_matrix, self.right_hand_side, self.label_img, self.previous_cb_mask, label_img,
+                self.cb_mask)
+        start = record_stage_time(self.profile, "assembly", start)
+
+        # the previous solution, in the numbering of the new variables, is the initial guess of the solve
+        initial_guess = None
+        if self.solution is not None and n_vars > 0:
+            old_vars = self.label_img.ravel()[var_pixel_indices]
+            initial_guess = np.zeros((n_vars,) + self.solution.shape[1:], dtype=self.solution.dtype)
+            initial_guess[old_vars >= 0] = self.solution[old_vars[old_vars >= 0]]
+
+        if n_vars > 0:
+            solver = make_solver(sparse_matrix, label_img, self.solver_name, **self.solver_options)
+            if isinstance(solver, KrylovSolver):
+                solution = solver.solve(right_hand_side, initial_guess)
+            else:
+                solution = solver.solve(right_hand_side)
+            self.solver_reports.append(solver.report)
+            if len(self.cb_colors) > 1:
+                # each color only blooms within its own radius, fading to 0 at its border
+                solution = solve_coupled_colors(solution * self.variable_colors, var_pixel_indices,
+                                                self.variable_colors, self.color_labels, self.dtype,
+                                                self.solver_name, solver_reports=self.solver_reports,
+                                                **self.solver_options)
+        else:
+            solution = np.zeros(right_hand_side.shape, dtype=self.dtype)
+        record_stage_time(self.profile, "solve", start)
+        if self.profile is not None:
+            self.profile.add_sizes(bloom_pixels=np.count_nonzero(cb_mask), unknowns=n_vars,
+                                   nnz=sparse_matrix.nnz)
+
+        self.label_img = label_img
+        self.var_pixel_indices = var_pixel_indices
+        self.sparse_matrix = sparse_matrix
+        self.right_hand_side = right_hand_side
+        self.solution = solution
+        self.previous_cb_mask = self.cb_mask.copy()
+
+    def render(self) -> np.ndarray:
+        """
+        :return: float matrix with the pixel data of the image bloomed with the current radii and pixels, RGBA if the
+                 image has alpha
+        """
+        start = time.perf_counter()
+        # each color only blooms within its own radius
+        unit_solution = self.solution.reshape(len(self.var_pixel_indices), len(self.cb_colors)) * self.variable_colors
+        color_solutions = unit_solution @ self.cb_colors.astype(unit_solution.dtype)
+        out = add_to_pixels(self.image, self.var_pixel_indices, color_solutions, np.empty_like(self.image))
+        record_stage_time(self.profile, "scatter", start)
+        tone_map_image(out, self.tone_map, self.color_labels >= 0, self.profile)
+        return merge_alpha(out, self.alpha)
+
+    def __str__(self):
+        report = self.solver_reports[-1] if self.solver_reports else None
+        return "bloom session: radii {}, {} unknowns, {} rows rebuilt, {}".format(
+            " ".join(str(color_radius) for color_radius in self.radii), len(self.var_pixel_indices),
+            self.rebuilt_rows, report)
@@ -0,0 +1,210 @@
+"""
+autor: Valentina Garrido
+
+Streaming mode for animations (animated GIFs, videos) and image sequences.
+Frames are read one at a time and written as soon as they are bloomed, so memory does not grow with the length of
+the sequence. The border condition pixels of consecutive frames are often the same, so the equation system of the
+last frame is kept, keyed by a hash of its cb mask, and reused (factorization and solution included) while the
+mask does not change. Only the scatter of the solution and the tone mapping are then redone.
+"""
+
+from bloom_effect import make_bloom_system, detect_cb_pixels, detect_color_labels, tone_map_image, read_image, \
+    save_image, alpha_visibility
+from bloomProfile import PipelineProfile, record_stage_time
+from bloomBatch import output_path
+from imgSystemCache import mask_key
+from colors import color_int_to_float
+from images import holds_colors, split_alpha, merge_alpha, blend_alpha
+import numpy as np
+import time
+import os
+
+
+ANIMATED_EXTENSIONS = (".gif", ".webp", ".apng")
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".webm")
+
+
+def is_animation(filename: str) -> bool:
+    """
+    :return: whether the file holds several frames, instead of a single image
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in VIDEO_EXTENSIONS:
+        return True
+    if extension in ANIMATED_EXTENSIONS:
+        from PIL import Image
+        with Image.open(filename) as img:
+            return getattr(img, "n_frames", 1) > 1
+    return False
+
+
+def iter_file_frames(filename: str):
+    """
+    Reads, lazily, the frames of an animation. Animated images are read with Pillow; videos need imageio, which is
+    an optional dependency
+
+    :param filename: path to the animation
+    :return: generator of RGB(A) uint8 frames
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in VIDEO_EXTENSIONS:
+        try:
+            import imageio.v3 as iio
+        except ImportError:
+            raise ImportError("Reading videos needs the imageio package (with its ffmpeg plugin)")
+        for frame in iio.imiter(filename):
+            yield frame
+        return
+
+    from PIL import Image, ImageSequence
+    with Image.open(filename) as img:
+        for frame in ImageSequence.Iterator(img):
+            # same conversion matplotlib.image.imread applies to palette images
+            yield np.asarray(frame.convert("RGBA" if frame.mode in ("P", "RGBA", "LA", "PA") else "RGB"))
+
+
+def iter_sequence(filenames, output_dir: str = None, suffix: str = "_out", template: str = "{stem}{suffix}{ext}"):
+    """
+    Reads, lazily, the frames of a sequence given by image files and animations, pairing each one with the name
+    of its output file. The frames of an animation are written as numbered png files.
+
+    :param filenames: list of image files or animations, in the order of the sequence
+    :param output_dir: directory of the output files. Defaults to the directory of each input
+    :param suffix: suffix added to the output names
+    :param template: format of the output names, @see bloomBatch.output_path
+    :return: generator of (frame, output filename) tuples
+    """
+    for filename in filenames:
+        if is_animation(filename):
+            (short_name, extension) = os.path.splitext(filename)
+            for index, frame in enumerate(iter_file_frames(filename)):
+                frame_name = "{}_{:05d}.png".format(short_name, index)
+                yield frame, output_path(frame_name, output_dir, suffix, template)
+        else:
+            yield read_image(filename), output_path(filename, output_dir, suffix, template)
+
+
+class BloomStream:
+    """
+    Blooms the frames of a sequence one at a time, reusing the equation system of the previous frame (one per color
+    to bloom, or a single one for all of them in single pass) when its cb mask did not change.
+    """
+    def __init__(self, radius, colors, tone_map: str = "clamp", delta=0.001, solver: str = "direct",
+                 norm: str = "1", cache=None, dtype=None, profile: PipelineProfile = None, single_pass: bool = False,
+                 alpha: str = "straight", **solver_options):
+        """
+        Constructor
+
+        :param radius: controls how far the bloom is spread (in pixels), or a sequence with the radius of each color
+        :param colors: color to bloom, given in int range [0, 255], or a sequence of them
+        :param tone_map: clamp, reinhard, or none to get HDR frames
+        :param delta: tolerance used to match the colors, or a sequence with the tolerance of each color
+        :param solver: backend used to solve the equation system, @see imgSolverBackends.make_solver
+        :param norm: norm of the distance within which pixels are bloomed, @see bloom_effect.BloomSystem
+        :param cache: optional imgSystemCache.SystemCache, looked up when the cb mask of a color changes
+        :param dtype: float type used through the pipeline, @see bloom_effect.bloom
+        :param profile: bloomProfile.PipelineProfile recording the stages of every frame. A new one (without
+                        memory tracking) by default
+        :param single_pass: whether to bloom every color with a single system, @see bloom_effect.bloom_colors
+        :param alpha: how the alpha of the frames is handled, @see bloom_effect.bloom
+        :param solver_options: options of the solver backend, along with preview and smoothing,
+                               @see bloom_effect.make_bloom_system
+        """
+        self.cb_colors = [color_int_to_float(color) for color in np.atleast_2d(colors)]
+        self.radii = [int(color_radius) for color_radius in np.broadcast_to(radius, (len(self.cb_colors),))]
+        self.deltas = [float(color_delta) for color_delta in np.broadcast_to(delta, (len(self.cb_colors),))]
+        self.single_pass = single_pass and len(self.cb_colors) > 1
+        self.tone_map = tone_map
+        self.alpha = alpha
+        self.solver = solver
+        self.norm = norm
+        self.cache = cache
+        self.dtype = dtype
+        self.system_dtype = dtype if dtype is not None else np.float64
+        self.solver_options = solver_options
+        self.cached_systems = [(None, None)] * (1 if self.single_pass else len(self.cb_colors))
+        self.frames = 0
+        self.reused = 0
+        self.rebuilt = 0
+        self.profile = profile if profile is not None else PipelineProfile()
+        self.solver_reports = []
+        self.cb_mask = None  # bloomed pixels of the last frame, saved along with it in npz frames
+
+    def process(self, frame: np.ndarray) -> np.ndarray:
+        """
+        Blooms a frame
+
+        :param frame: matrix with pixel data, either uint8 or float in range [0, 1]. Float RGB and RGBA frames are
+                      bloomed in place
+        :return: float matrix with the pixel data of the bloomed frame, @see bloom_effect.bloom
+        """
+        out = frame if holds_colors(frame, self.dtype) else None
+        img_colors, img_alpha = split_alpha(frame, self.dtype)
+        visible_mask, hidden_colors = alpha_visibility(img_colors, img_alpha, self.alpha)
+        if self.single_pass:
+            color_labels = detect_color_labels(img_colors, self.cb_colors, self.deltas, self.profile, visible_mask)
+            self.apply_system(0, img_colors, color_labels, self.radii, np.array(self.cb_colors))
+            cb_mask = color_labels >= 0
+        else:
+            cb_mask = np.zeros(img_colors.shape[:2], dtype=bool)
+            for k, cb_color in enumerate(self.cb_colors):
+                color_mask = detect_cb_pixels(img_colors, cb_color, self.deltas[k], self.profile, visible_mask)
+                cb_mask |= color_mask
+                self.apply_system(k, img_colors, color_mask, self.radii[k], cb_color)
+        if hidden_colors is not None:
+            img_colors -= hidden_colors
+
+        self.frames += 1
+        self.profile.images += 1
+        self.cb_mask = cb_mask
+        tone_map_image(img_colors, self.tone_map, cb_mask, self.profile)
+        if self.alpha == "blend" and img_alpha is not None:
+            blend_alpha(img_colors, img_alpha)
+        return merge_alpha(img_colors, img_alpha, out)
+
+    def apply_system(self, k: int, out: np.ndarray, cb_mask: np.ndarray, radius, cb_color: np.ndarray):
+        """
+        Adds a bloom to a frame with the k-th kept system, which is rebuilt if its cb mask changed
+
+        :param k: position of the system among the kept ones
+        :param out: float frame, bloomed in place
+        :param cb_mask: cb mask or color labels of the system, @see bloom_effect.BloomSystem
+        :param radius: radius of the system, or the radius of each color
+        :param cb_color: the color to bloom, or the colors, in float range [0, 1]
+        """
+        key = mask_key(cb_mask, radius, self.norm, self.system_dtype)
+        cached_key, bloom_system = self.cached_systems[k]
+        if key == cached_key:
+            self.reused += 1
+        else:
+            bloom_system = make_bloom_system(cb_mask, radius, self.solver, self.profile, norm=self.norm,
+                                             cache=self.cache, dtype=self.system_dtype, **self.solver_options)
+            self.cached_systems[k] = (key, bloom_system)
+            self.rebuilt += 1
+        bloom_system.apply(out, cb_color, self.solver_reports, self.profile)
+
+    def run(self, frames_and_outputs) -> "BloomStream":
+        """
+        Blooms a sequence, writing each frame as soon as it is ready
+
+        :param frames_and_outputs: iterable of (frame, output filename) tuples, @see iter_sequence
+        :return: self, whose attributes hold the statistics of the run
+        """
+        start = time.perf_counter()
+        for frame, out_filename in frames_and_outputs:
+            record_stage_time(self.profile, "read", start)
+            out_frame = self.process(frame)
+            start = time.perf_counter()
+            save_image(out_filename, out_frame, cb_mask=self.cb_mask)
+            start = record_stage_time(self.profile, "save", start)
+        return self
+
+    def __str__(self):
+        elapsed = self.profile.total_seconds()
+        lines = ["{} frames in {:.2f} s ({:.2f} frames/s): {} systems reused, {} built".format(
+            self.frames, elapsed, self.frames / elapsed if elapsed > 0 else 0., self.reused, self.rebuilt)]
+        for stage, stage_profile in self.profile.stages.items():
+            lines.append("  {:<14}{:>10.3f} s".format(stage, stage_profile.seconds))
+        if self.cache is not None:
+            lines.append(str(self.cache))
+        return "\n".join(lines)
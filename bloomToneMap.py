@@ -0,0 +1,127 @@
+"""
+autor: Valentina Garrido
+
+Tone mapping of the float HDR images saved by the bloom with --hdr, as a separate step. The bloom, which is the
+expensive part, is solved once, and its HDR result may then be mapped to LDR as many times as needed, trying
+several exposures or max luminances for Reinhard mapping.
+npz images keep the bloomed pixels, which Reinhard mapping leaves out, so mapping them with the default exposure
+and max luminance gives the same result as blooming the image with that tone mapping right away.
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from bloom_effect import tone_map_image, save_image
+from bloomProfile import PipelineProfile, record_stage_time
+from images import split_alpha, merge_alpha, clamp_image_colors
+from imgFiles import read_hdr_image, is_hdr_format
+
+
+def tone_map_hdr_image(image: np.ndarray, tone_map: str = "clamp", cb_mask: np.ndarray = None, exposure: float = 1,
+                       max_lum: float = None, profile: PipelineProfile = None) -> np.ndarray:
+    """
+    Maps an HDR image to LDR, leaving the image untouched, @see bloom_effect.tone_map_image
+
+    :param image: float matrix with the HDR pixel data, gray, RGB or RGBA, @see images.split_alpha
+    :param tone_map: clamp or reinhard
+    :param cb_mask: boolean mask of the bloomed pixels, which are excluded from Reinhard mapping
+    :param exposure: factor applied to the colors before mapping them
+    :param max_lum: luminance mapped to white by Reinhard mapping. By default, the max luminance of the exposed image
+    :param profile: optional bloomProfile.PipelineProfile recording each stage
+    :return: float matrix with the LDR pixel data, RGB or RGBA
+    """
+    if tone_map not in ("clamp", "reinhard"):
+        raise ValueError("Unknown tone mapping: {}".format(tone_map))
+    img_colors, img_alpha = split_alpha(image)
+    img_colors = np.multiply(img_colors, exposure, dtype=img_colors.dtype)
+    tone_map_image(img_colors, tone_map, cb_mask, profile, max_lum)
+    # the bloomed pixels are left out of Reinhard mapping, and may be over 1 once exposed
+    clamp_image_colors(img_colors, img_colors.shape[0:2])
+    return merge_alpha(img_colors, None if img_alpha is None else img_alpha.copy())
+
+
+def variant_names(exposures, max_lums) -> list:
+    """
+    :return: list of (exposure, max_lum, name suffix) tuples, one per combination of them. The suffix only names the
+             values of which several are given
+    """
+    variants = []
+    for exposure in exposures:
+        for max_lum in max_lums:
+            name = "_exposure{:g}".format(exposure) if len(exposures) > 1 else ""
+            name += "_maxlum{:g}".format(max_lum) if len(max_lums) > 1 else ""
+            variants.append((exposure, max_lum, name))
+    return variants
+
+
+def tone_map_file(in_filename: str, out_filenames: list, tone_map: str = "clamp", variants: list = ((1, None),),
+                  profile: PipelineProfile = None):
+    """
+    Reads an HDR image once and saves it tone mapped with each exposure and max luminance
+
+    :param in_filename: path of the HDR image (npz, npy or pfm)
+    :param out_filenames: path of the LDR image of each variant
+    :param tone_map: clamp or reinhard
+    :param variants: sequence of (exposure, max_lum) pairs, @see tone_map_hdr_image
+    :param profile: optional bloomProfile.PipelineProfile recording each stage
+    """
+    start = time.perf_counter()
+    image, cb_mask = read_hdr_image(in_filename)
+    record_stage_time(profile, "read", start)
+    for out_filename, (exposure, max_lum) in zip(out_filenames, variants):
+        ldr_image = tone_map_hdr_image(image, tone_map, cb_mask, exposure, max_lum, profile)
+        start = time.perf_counter()
+        save_image(out_filename, ldr_image)
+        record_stage_time(profile, "save", start)
+
+
+parser = argparse.ArgumentParser(description="Tone maps the HDR images saved by the bloom with --hdr")
+parser.add_argument("hdr_filenames", help="Path to the HDR images (npz, npy or pfm). Several images may be given, as "
+                                          "files, glob patterns (quoted) or directories",
+                    nargs="+", metavar="hdr_filename")
+parser.add_argument("--reinhard", help="Uses Reinhard mapping instead of simple color clamping", action="store_true")
+parser.add_argument("--exposure", help="Factors applied to the colors before mapping them. Each one gives an image",
+                    type=float, nargs="+", default=[1.0])
+parser.add_argument("--max-lum", help="Luminances mapped to white by Reinhard mapping, instead of the max luminance "
+                                      "of each image. Each one gives an image", type=float, nargs="+", default=[None])
+parser.add_argument("--format", help="Format of the tone mapped images", default="png")
+parser.add_argument("--output-dir", help="Directory of the tone mapped images. Defaults to the directory of each "
+                                         "image", default=None)
+parser.add_argument("--suffix", help="Suffix added to the name of the tone mapped images", default="")
+parser.add_argument("--profile", help="Prints the time spent reading, mapping and saving the images",
+                    action="store_true")
+
+
+def main(argv=None):
+    import bloomBatch
+
+    args = parser.parse_args(argv)
+    if args.max_lum != [None] and not args.reinhard:
+        parser.error("--max-lum is only used with --reinhard")
+    if is_hdr_format(None, args.format):
+        parser.error("the tone mapped images are LDR: --format can't be an HDR format")
+    in_filenames = [filename for filename in bloomBatch.expand_image_paths(args.hdr_filenames, None)
+                    if is_hdr_format(filename)]
+    if not in_filenames:
+        parser.error("no HDR images (npz, npy or pfm) were given")
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    variants = variant_names(args.exposure, args.max_lum)
+    profile = PipelineProfile(False)
+    for in_filename in in_filenames:
+        out_filenames = [bloomBatch.output_path(in_filename, args.output_dir, args.suffix + name,
+                                                "{stem}{suffix}." + args.format) for _, _, name in variants]
+        tone_map_file(in_filename, out_filenames, "reinhard" if args.reinhard else "clamp",
+                      [(exposure, max_lum) for exposure, max_lum, _ in variants], profile)
+        profile.images += 1
+    profile.finish()
+    if args.profile:
+        print(profile)
+
+
+if __name__ == '__main__':
+    main()
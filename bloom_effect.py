@@ -1,112 +1,882 @@
 """
 autor: Valentina Garrido
-Main game module
+Main module. Applies the bloom effect to images, either through the bloom function or from the command line.
+
+Importing this module does not import matplotlib, which is only loaded to read and write image files or to plot,
+so long-lived programs can call bloom directly on images in memory. Importing it (numpy and scipy included) is
+kept under a budget of IMPORT_TIME_BUDGET seconds.
 """
 
-import matplotlib.image as mpimg
 import argparse
-import matplotlib.pyplot as plt
-
-from scipy.sparse import csc_matrix
-import scipy.sparse.linalg
-import copy
+import numpy as np
 
 import os
+import time
 
 
 from colors import color_int_to_float
-from images import get_img_max_luminance, reinhard_image_mapping, clamp_image_colors, convert_to_float_img
-from imgIndices import get_matching_pixel_indices, spy_inds, get_neighbor_pixel_indices_norm_1, simple_pixel_mapping
-from imgLaplaceSolver import build_equation_system
+from images import add_to_pixels, get_img_max_luminance, reinhard_image_mapping, clamp_image_colors, \
+    holds_colors, split_alpha, merge_alpha, blend_alpha
+from imgFiles import file_format, is_hdr_format, read_png16, read_hdr_image, write_hdr_image, HDR_FORMATS
+from imgIndices import get_matching_pixel_mask, get_matching_color_labels, mask_to_index_set, pixel_label_image, \
+    spy_inds, get_neighbor_pixel_mask, NEIGHBOR_NORMS
+from imgLaplaceSolver import build_equation_system_from_labels, StencilOperator
+from imgSolverBackends import make_solver, SOLVER_BACKENDS, PRECONDITIONERS
+from imgSystemCache import mask_key
+from bloomProfile import PipelineProfile, record_stage_time
+
+
+IMPORT_TIME_BUDGET = 0.5  # seconds
+TONE_MAPPINGS = ("clamp", "reinhard", "none")
+ALPHA_MODES = ("straight", "premultiplied", "blend")
+# options of bloom that change the bloomed images, compared to tell whether an output is up to date
+OUTPUT_PARAMETERS = ("radius", "colors", "delta", "single_pass", "tone_map", "alpha", "dtype", "norm", "solver",
+                     "preconditioner", "tol", "max_iter", "preview", "smoothing")
+
+
+def read_image(filename, image_format: str = None) -> np.ndarray:
+    """
+    Reads an image file (matplotlib is imported here, on first use). 16-bit png images are read with all of their
+    precision and float HDR images (npz, npy and pfm) as they were saved, @see imgFiles
+
+    :param filename: path to the image, or a file object
+    :param image_format: format of the image (png, jpeg, npz...). By default it's given by the filename extension,
+                         and file objects are read as png
+    :return: the image data as returned by matplotlib.image.imread: float32 for png images, float for HDR images,
+             and uint8 otherwise
+    """
+    if is_hdr_format(filename, image_format):
+        return read_hdr_image(filename, image_format)[0]
+    if file_format(filename, image_format) in ("png", None):
+        img_mtrx = read_png16(filename)
+        if img_mtrx is not None:
+            return img_mtrx
+        if hasattr(filename, "seek"):
+            filename.seek(0)
+    import matplotlib.image as mpimg
+    return mpimg.imread(filename, image_format)
+
+
+def save_image(filename, img_mtrx: np.ndarray, image_format: str = None, cb_mask: np.ndarray = None):
+    """
+    Saves an image file, in the format given by the filename extension (matplotlib is imported here, on first use).
+    HDR formats (npz, npy and pfm) keep the float values as they are, @see imgFiles.write_hdr_image
+
+    :param filename: path of the saved image, or a file object
+    :param img_mtrx: matrix with pixel data representing the image
+    :param image_format: format of the image (png, jpeg, npz...), instead of the one of the filename extension
+    :param cb_mask: boolean mask of the bloomed pixels, saved along with npz images for their later tone mapping
+    """
+    if is_hdr_format(filename, image_format):
+        write_hdr_image(filename, img_mtrx, image_format, cb_mask)
+        return
+    import matplotlib.image as mpimg
+    mpimg.imsave(filename, img_mtrx, format=image_format)
+
+
+class BloomSystem:
+    """
+    Equation system of the bloom around a set of border condition (cb) pixels. It only depends on which pixels are
+    cb pixels and on the radius, so it may be solved for any color and reused on every image sharing those pixels.
+    The solver is set up (the matrix is factorized, for the direct solver) on the first solve, and the solution is
+    kept, as the solution for any color is that same solution scaled by the color. With a cache, the system and its
+    solution are loaded from it when found, and stored in it after the first solve otherwise.
+
+    Several colors, each with its own radius, may be bloomed in a single pass: the variables are the union of the
+    neighbors of each color, and the system is assembled and factorized once, with one right hand side column per
+    color. The solution of each color is kept within its own radius, and the blooms are added up where they overlap.
+    The cb pixels of every color are border conditions of every column, so they keep their color. The bloom of a color
+    must fade to 0 at the border of its radius, so the colors whose variables are contiguous to variables of other
+    colors out of their radius are solved again on their own variables, @see solve_coupled_colors.
+
+    With the matrix-free solver the matrix is never assembled: it's an imgLaplaceSolver.StencilOperator applying
+    the stencil from the label image, and only the right hand side is computed.
+    """
+    def __init__(self, cb_mask: np.ndarray, radius: int, solver: str = "direct", profile: PipelineProfile = None,
+                 split_components: bool = False, norm: str = "1", cache=None, dtype=np.float64, **solver_options):
+        """
+        Constructor. Finds the variables and assembles the system
+
+        :param cb_mask: boolean array with the image dimensions, True for border condition pixels. To bloom several
+                        colors in a single pass, an int array with the color of each cb pixel and -1 elsewhere,
+                        @see imgIndices.get_matching_color_labels
+        :param radius: controls how far the bloom is spread (in pixels). With several colors, it may be a sequence
+                       with the radius of each of them
+        :param solver: backend used to solve the equation system, @see imgSolverBackends.make_solver
+        :param profile: optional bloomProfile.PipelineProfile recording each stage
+        :param split_components: whether to solve each connected component of the variables as a separate system,
+                                 concurrently. @see imgComponents.ComponentSolver, which takes its options (workers,
+                                 executor and min_block_size) from solver_options
+        :param norm: norm of the distance to the cb pixels within which pixels are bloomed: 1 (diamonds), 2 (disks)
+                     or inf (squares). @see imgIndices.get_neighbor_pixel_mask
+        :param cache: optional imgSystemCache.SystemCache where the system is looked for
+        :param dtype: float type of the system and its solution, float64 or float32
+        :param solver_options: options of the solver backend
+        """
+        self.color_labels = None
+        self.variable_colors = None
+        if cb_mask.dtype != bool:
+            self.color_labels = cb_mask
+            cb_mask = cb_mask >= 0
+            if np.isscalar(radius):
+                radius = [radius] * (int(self.color_labels.max(initial=-1)) + 1)
+            radius = tuple(int(color_radius) for color_radius in radius)
+        if split_components and solver == "matrix-free":
+            raise ValueError("The matrix-free solver can't split the system in components")
+        self.cb_mask = cb_mask
+        self.split_components = split_components
+        self.radius = radius
+        self.norm = norm
+        self.solver_name = solver
+        self.solver_options = solver_options
+        self.solver = None
+        self.unit_solution = None
+        self.cache = cache
+        self.cache_key = None
+        self.dtype = dtype
+        img_dims = cb_mask.shape
+        start = time.perf_counter()
+
+        if cache is not None:
+            self.cache_key = mask_key(cb_mask if self.color_labels is None else self.color_labels, radius, norm,
+                                      dtype, solver, dict(solver_options, split_components=split_components))
+            cached = cache.load(self.cache_key)
+            if cached is not None:
+                self.var_pixel_indices = cached.var_pixel_indices
+                self.n_vars = len(self.var_pixel_indices)
+                variable_mask = np.zeros(img_dims, dtype=bool)
+                variable_mask.flat[self.var_pixel_indices] = True
+                self.label_img = pixel_label_image(variable_mask)
+                self.sparse_matrix = cached.sparse_matrix
+                self.right_hand_side = cached.right_hand_side
+                self.unit_solution = cached.unit_solution
+                record_stage_time(profile, "cache", start)
+                self.add_sizes(profile)
+                return
+
+        # getting the neighbor pixels that will be the variables of the Laplace equation
+        if self.color_labels is None:
+            variable_mask = get_neighbor_pixel_mask(cb_mask, radius, norm)
+        else:
+            # the neighbors of each color, which are also the only variables its bloom reaches
+            color_masks = [get_neighbor_pixel_mask(self.color_labels == color, color_radius, norm) & ~cb_mask
+                           for color, color_radius in enumerate(radius)]
+            variable_mask = np.logical_or.reduce(color_masks, axis=0) if color_masks else np.zeros_like(cb_mask)
+        start = record_stage_time(profile, "neighbors", start)
+
+        # once again, to see the position of the neighbors, uncomment this line
+        # spy_inds(mask_to_index_set(variable_mask), img_dims)
+
+        # Enumerating each unknown variable, in an image labeling each variable with its number
+        self.label_img = pixel_label_image(variable_mask)
+        self.var_pixel_indices = np.flatnonzero(self.label_img >= 0)
+        self.n_vars = len(self.var_pixel_indices)
+        if self.color_labels is not None:
+            self.variable_colors = np.stack([color_mask.ravel()[self.var_pixel_indices] for color_mask in color_masks],
+                                            axis=1) if color_masks else np.zeros((self.n_vars, 0), dtype=bool)
+        start = record_stage_time(profile, "mapping", start)
+
+        # creating the equation system with sparse matrices, or only its right hand side for the matrix-free solver
+        if solver == "matrix-free":
+            self.sparse_matrix = StencilOperator(self.label_img, dtype)
+            self.right_hand_side = self.sparse_matrix.right_hand_side(
+                cb_mask, self.color_labels, None if self.color_labels is None else len(radius))
+        else:
+            self.sparse_matrix, self.right_hand_side = build_equation_system_from_labels(
+                self.label_img, cb_mask, dtype, self.color_labels, None if self.color_labels is None else len(radius))
+        record_stage_time(profile, "assembly", start)
+        self.add_sizes(profile)
+
+    def add_sizes(self, profile: PipelineProfile):
+        """
+        Adds the sizes of the system (cb pixels, unknowns and non zeros of the matrix) to a profile, if given
+        """
+        if profile is not None:
+            profile.add_sizes(bloom_pixels=np.count_nonzero(self.cb_mask), unknowns=self.n_vars,
+                              nnz=self.sparse_matrix.nnz)
+
+    def solve(self, cb_color: np.ndarray, solver_reports: list = None,
+              profile: PipelineProfile = None) -> np.ndarray:
+        """
+        Solves the system for every component of a color.
+        The right hand side of each component is the same vector scaled by the component, so the system is set up
+        and solved only once, on the first call. @see imgLaplaceSolver.solve_color_components
+
+        :param cb_color: the color to bloom, in float range [0, 1]. For systems of several colors, an array with
+                         one row per color
+        :param solver_reports: optional list where the report of the solver is appended
+        :param profile: optional bloomProfile.PipelineProfile recording each stage
+        :return: array of shape (n_vars, n_components) with the solution of each color component, added up over
+                 the colors
+        """
+        start = time.perf_counter()
+        if self.unit_solution is None and self.n_vars > 0:
+            self.solver = make_system_solver(self.sparse_matrix, self.label_img, self.solver_name,
+                                             self.split_components, **self.solver_options)
+            self.unit_solution = self.solver.solve(self.right_hand_side)
+            if solver_reports is not None:
+                solver_reports.append(self.solver.report)
+            if self.variable_colors is not None:
+                # each color only blooms within its own radius
+                self.unit_solution *= self.variable_colors
+                solve_coupled_colors(self.unit_solution, self.var_pixel_indices, self.variable_colors,
+                                     self.color_labels, self.dtype, self.solver_name, self.split_components,
+                                     solver_reports, **self.solver_options)
+            if self.cache is not None:
+                start = record_stage_time(profile, "solve", start)
+                # entries always hold the assembled matrix, which is the same whatever the solver
+                sparse_matrix = self.sparse_matrix.to_sparse() if isinstance(self.sparse_matrix, StencilOperator) \
+                    else self.sparse_matrix
+                self.cache.store(self.cache_key, sparse_matrix, self.right_hand_side, self.var_pixel_indices,
+                                 self.unit_solution)
+                start = record_stage_time(profile, "cache", start)
+        if self.n_vars == 0:
+            color_solutions = np.zeros((0, np.shape(cb_color)[-1]), dtype=self.dtype)
+        elif self.unit_solution.ndim == 1:
+            color_solutions = np.outer(self.unit_solution, np.asarray(cb_color, dtype=self.unit_solution.dtype))
+        else:
+            color_solutions = self.unit_solution @ np.asarray(cb_color, dtype=self.unit_solution.dtype)
+        record_stage_time(profile, "solve", start)
+        return color_solutions
+
+    def apply(self, img_mtrx: np.ndarray, cb_color: np.ndarray, solver_reports: list = None,
+              profile: PipelineProfile = None) -> np.ndarray:
+        """
+        Adds, in place, the bloom of a color to an image with the same dimensions as the cb mask
+
+        :param img_mtrx: float matrix with pixel data representing the image
+        :param cb_color: the color to bloom, in float range [0, 1]
+        :param solver_reports: optional list where the report of the solver is appended
+        :param profile: optional bloomProfile.PipelineProfile recording each stage
+        :return: img_mtrx
+        """
+        color_solutions = self.solve(cb_color, solver_reports, profile)
+
+        # now, we sum these onto the image
+        start = time.perf_counter()
+        add_to_pixels(img_mtrx, self.var_pixel_indices, color_solutions)
+        record_stage_time(profile, "scatter", start)
+        return img_mtrx
+
+
+def make_system_solver(sparse_matrix, label_img: np.ndarray, solver: str = "direct", split_components: bool = False,
+                       **solver_options):
+    """
+    :param sparse_matrix: matrix of the system, or the imgLaplaceSolver.StencilOperator of the matrix-free solver
+    :param label_img: int array with the image dimensions, with the number of each variable and -1 elsewhere
+    :param solver: backend used to solve the system, @see imgSolverBackends.make_solver
+    :param split_components: whether to solve each connected component of the variables as a separate system,
+                             @see imgComponents.ComponentSolver
+    :param solver_options: options of the solver backend
+    :return: the solver of the system
+    """
+    if split_components:
+        from imgComponents import ComponentSolver
+        return ComponentSolver(sparse_matrix, label_img, solver, **solver_options)
+    return make_solver(sparse_matrix, label_img, solver, **solver_options)
+
+
+def solve_coupled_colors(unit_solution: np.ndarray, var_pixel_indices: np.ndarray, variable_colors: np.ndarray,
+                         color_labels: np.ndarray, dtype=np.float64, solver: str = "direct",
+                         split_components: bool = False, solver_reports: list = None, **solver_options) -> np.ndarray:
+    """
+    Solves again the column of each color whose variables (those within its radius) are contiguous to variables
+    of other colors out of its radius. The system shared by all the colors spans the variables of every color, so
+    there the bloom of the color goes on past its radius, and cutting it there leaves a sharp edge instead of fading
+    to 0. The system of the color alone has only its own variables, so the variables of the other colors around
+    them are border conditions of value 0, like the cb pixels of the other colors are.
+    The other colors are left as they are: their bloom is the same in both systems.
+
+    :param unit_solution: array (n_vars, n_colors) with the solution of the shared system of every color, cut to
+                          the radius of each color. The columns of the coupled colors are replaced in place
+    :param var_pixel_indices: flat indices of the pixels of the variables of the shared system
+    :param variable_colors: boolean array (n_vars, n_colors), True where a variable is within the radius of a color
+    :param color_labels: int array with the image dimensions, with the color of each cb pixel and -1 elsewhere
+    :param dtype: float type of the systems
+    :param solver: backend used to solve the systems, @see make_system_solver
+    :param split_components: whether to solve each connected component of the variables as a separate system
+    :param solver_reports: optional list where the report of each solve is appended
+    :param solver_options: options of the solver backend
+    :return: unit_solution
+    """
+    img_dims = color_labels.shape
+    variable_mask = np.zeros(img_dims, dtype=bool)
+    variable_mask.flat[var_pixel_indices] = True
+    for color in range(variable_colors.shape[1]):
+        color_variables = variable_colors[:, color]
+        color_mask = np.zeros(img_dims, dtype=bool)
+        color_mask.flat[var_pixel_indices[color_variables]] = True
+        other_mask = variable_mask & ~color_mask
+        coupled = (np.any(color_mask[1:] & other_mask[:-1]) or np.any(color_mask[:-1] & other_mask[1:]) or
+                   np.any(color_mask[:, 1:] & other_mask[:, :-1]) or np.any(color_mask[:, :-1] & other_mask[:, 1:]))
+        if not coupled:
+            continue
+        # the variables of a single color keep their order, so their solution goes right into its rows
+        label_img = pixel_label_image(color_mask)
+        if solver == "matrix-free":
+            sparse_matrix = StencilOperator(label_img, dtype)
+            right_hand_side = sparse_matrix.right_hand_side(color_labels == color)
+        else:
+            sparse_matrix, right_hand_side = build_equation_system_from_labels(label_img, color_labels == color, dtype)
+        color_solver = make_system_solver(sparse_matrix, label_img, solver, split_components, **solver_options)
+        unit_solution[color_variables, color] = color_solver.solve(right_hand_side)
+        if solver_reports is not None:
+            solver_reports.append(color_solver.report)
+    return unit_solution
+
+
+def make_bloom_system(cb_mask: np.ndarray, radius, solver: str = "direct", profile: PipelineProfile = None,
+                      preview: int = 1, smoothing: int = 0, **system_options):
+    """
+    Creates the system of the bloom around some cb pixels: a BloomSystem or, to preview the result, a
+    bloomPreview.PreviewSystem solved on a coarser grid
+
+    :param cb_mask: boolean cb mask, or int color labels to bloom several colors, @see BloomSystem
+    :param radius: controls how far the bloom is spread (in pixels), or a sequence with the radius of each color
+    :param solver: backend used to solve the equation system, @see imgSolverBackends.make_solver
+    :param profile: optional bloomProfile.PipelineProfile recording each stage
+    :param preview: ratio between the resolution of the image and the one the system is solved at. 1 solves it
+                    exactly
+    :param smoothing: number of jacobi sweeps refining a preview at full resolution
+    :param system_options: options of the system (norm, cache, dtype...) and of the solver backend
+    :return: the system, which blooms an image with its apply method
+    """
+    if preview > 1:
+        from bloomPreview import PreviewSystem
+        return PreviewSystem(cb_mask, radius, solver, profile, preview, smoothing, **system_options)
+    return BloomSystem(cb_mask, radius, solver, profile, **system_options)
+
+
+def detect_cb_pixels(img_mtrx: np.ndarray, cb_color: np.ndarray, delta: float = 0.001,
+                     profile: PipelineProfile = None, visible_mask: np.ndarray = None) -> np.ndarray:
+    """
+    Finds the border condition (cb) pixels of an image, the ones matching the color to bloom
+
+    :param img_mtrx: matrix with pixel data representing the image
+    :param cb_color: the color to bloom, in float range [0, 1]
+    :param delta: tolerance used to match cb_color
+    :param profile: optional bloomProfile.PipelineProfile recording each stage
+    :param visible_mask: optional boolean mask of the pixels that may match, @see alpha_visibility
+    :return: boolean mask of the pixels that matched cb_color
+    """
+    start = time.perf_counter()
+    # It's better to store an index ref to the CB pixel, as we suppose that, most of the times,
+    # there will be less pixels to bloom than pixels in total
+    cb_mask = get_matching_pixel_mask(img_mtrx, cb_color, delta)
+    if visible_mask is not None:
+        cb_mask &= visible_mask
+    record_stage_time(profile, "detection", start)
+
+    # Uncomment this to see the which pixels matched with the given cb pixel color
+    # spy_inds(mask_to_index_set(cb_mask), cb_mask.shape)
+    return cb_mask
+
+
+def detect_color_labels(img_mtrx: np.ndarray, cb_colors, deltas=0.001, profile: PipelineProfile = None,
+                        visible_mask: np.ndarray = None) -> np.ndarray:
+    """
+    Finds the border condition (cb) pixels of several colors at once
+
+    :param img_mtrx: matrix with pixel data representing the image
+    :param cb_colors: sequence of colors to bloom, in float range [0, 1]
+    :param deltas: tolerance used to match every color, or a sequence with the tolerance of each one
+    :param profile: optional bloomProfile.PipelineProfile recording each stage
+    :param visible_mask: optional boolean mask of the pixels that may match, @see alpha_visibility
+    :return: int array with the image dimensions, with the position of the color matched by each pixel (the first
+             one, if it matches several) and -1 elsewhere
+    """
+    start = time.perf_counter()
+    color_labels = get_matching_color_labels(img_mtrx, cb_colors, deltas)
+    if visible_mask is not None:
+        color_labels[~visible_mask] = -1
+    record_stage_time(profile, "detection", start)
+    return color_labels
+
+
+def bloom_color(img_mtrx: np.ndarray, cb_color: np.ndarray, radius: int, delta: float = 0.001,
+                solver: str = "direct", solver_reports: list = None, profile: PipelineProfile = None,
+                norm: str = "1", cache=None, dtype=np.float64, visible_mask: np.ndarray = None,
+                **solver_options) -> np.ndarray:
+    """
+    Blooms, in place, the pixels of an image matching one color. The image is left in HDR
+
+    :param img_mtrx: float matrix with pixel data representing the image
+    :param cb_color: the color to bloom, in float range [0, 1]
+    :param radius: controls how far the bloom is spread (in pixels)
+    :param delta: tolerance used to match cb_color
+    :param solver: backend used to solve the equation system, @see imgSolverBackends.make_solver
+    :param solver_reports: optional list where the report of the solver is appended
+    :param profile: optional bloomProfile.PipelineProfile recording each stage
+    :param norm: norm of the distance within which pixels are bloomed, @see BloomSystem
+    :param cache: optional imgSystemCache.SystemCache where the system is looked for
+    :param dtype: float type of the system, @see BloomSystem
+    :param visible_mask: optional boolean mask of the pixels that may match, @see alpha_visibility
+    :param solver_options: options of the solver backend, along with preview and smoothing, @see make_bloom_system
+    :return: boolean mask of the pixels that matched cb_color
+    """
+    cb_mask = detect_cb_pixels(img_mtrx, cb_color, delta, profile, visible_mask)
+    bloom_system = make_bloom_system(cb_mask, radius, solver, profile, norm=norm, cache=cache, dtype=dtype,
+                                     **solver_options)
+    bloom_system.apply(img_mtrx, cb_color, solver_reports, profile)
+    return cb_mask
+
+
+def bloom_colors(img_mtrx: np.ndarray, cb_colors, radii, deltas=0.001, solver: str = "direct",
+                 solver_reports: list = None, profile: PipelineProfile = None, norm: str = "1", cache=None,
+                 dtype=np.float64, visible_mask: np.ndarray = None, **solver_options) -> np.ndarray:
+    """
+    Blooms, in place, the pixels of an image matching several colors in a single pass: the pixels of every color
+    are found at once and a single system is assembled and solved for all of them, @see BloomSystem.
+    Unlike blooming the colors one after the other, the bloom of a color never reaches the pixels of the others,
+    nor creates new pixels matching them. The image is left in HDR
+
+    :param img_mtrx: float matrix with pixel data representing the image
+    :param cb_colors: sequence of colors to bloom, in float range [0, 1]
+    :param radii: radius of every color, or a sequence with the radius of each one
+    :param deltas: tolerance used to match every color, or a sequence with the tolerance of each one
+    :param solver: backend used to solve the equation system, @see imgSolverBackends.make_solver
+    :param solver_reports: optional list where the report of the solver is appended
+    :param profile: optional bloomProfile.PipelineProfile recording each stage
+    :param norm: norm of the distance within which pixels are bloomed, @see BloomSystem
+    :param cache: optional imgSystemCache.SystemCache where the system is looked for
+    :param dtype: float type of the system, @see BloomSystem
+    :param visible_mask: optional boolean mask of the pixels that may match, @see alpha_visibility
+    :param solver_options: options of the solver backend, along with preview and smoothing, @see make_bloom_system
+    :return: boolean mask of the pixels that matched any of the colors
+    """
+    cb_colors = np.atleast_2d(cb_colors)
+    radii = np.broadcast_to(radii, (len(cb_colors),))
+    if len(cb_colors) == 1:
+        return bloom_color(img_mtrx, cb_colors[0], int(radii[0]), float(np.ravel(deltas)[0]), solver, solver_reports,
+                           profile, norm, cache, dtype, visible_mask, **solver_options)
+    color_labels = detect_color_labels(img_mtrx, cb_colors, deltas, profile, visible_mask)
+    bloom_system = make_bloom_system(color_labels, radii, solver, profile, norm=norm, cache=cache, dtype=dtype,
+                                     **solver_options)
+    bloom_system.apply(img_mtrx, cb_colors, solver_reports, profile)
+    return color_labels >= 0
+
+
+def tone_map_image(img_mtrx: np.ndarray, tone_map: str, cb_mask: np.ndarray = None,
+                   profile: PipelineProfile = None, max_lum: float = None) -> np.ndarray:
+    """
+    Converts, in place, the HDR pixel values of a bloomed image to LDR
+
+    :param img_mtrx: float matrix with pixel data representing the image
+    :param tone_map: clamp, reinhard, or none to leave the image in HDR
+    :param cb_mask: boolean mask of the bloomed pixels, which are excluded from Reinhard mapping
+    :param profile: optional bloomProfile.PipelineProfile recording each stage
+    :param max_lum: luminance mapped to white by Reinhard mapping. By default, the max luminance of the image
+    :return: img_mtrx
+    """
+    img_dims = (img_mtrx.shape[0], img_mtrx.shape[1])
+    start = time.perf_counter()
+    if tone_map == "reinhard":
+        if max_lum is None:
+            max_lum = get_img_max_luminance(img_mtrx, img_dims)
+        reinhard_image_mapping(img_mtrx, img_dims, max_lum, cb_mask)
+    elif tone_map == "clamp":
+        clamp_image_colors(img_mtrx, img_dims)
+    record_stage_time(profile, "tone_mapping", start)
+    return img_mtrx
+
+
+def alpha_visibility(img_colors: np.ndarray, img_alpha: np.ndarray, alpha: str = "straight") -> tuple:
+    """
+    Prepares the bloom of an image with alpha, @see bloom. With straight alpha every pixel is bloomed as if it was
+    opaque. Otherwise the bloom is added to the premultiplied colors, so the colors hidden by the alpha are taken
+    away from the bloomed image afterwards, and fully transparent pixels never match the colors to bloom
+
+    :param img_colors: float colors of the image, @see images.split_alpha
+    :param img_alpha: float alpha of the image, or None if it has no alpha
+    :param alpha: straight, premultiplied or blend
+    :return: a tuple with the boolean mask of the pixels that may match and the hidden colors, to subtract from the
+             bloomed colors. Both are None if the image has no alpha or it's straight
+    """
+    if alpha not in ALPHA_MODES:
+        raise ValueError("Unknown alpha mode: {}".format(alpha))
+    if img_alpha is None or alpha == "straight":
+        return None, None
+    return img_alpha > 0, img_colors * (1 - img_alpha)[..., np.newaxis]
+
+
+def bloom(image: np.ndarray, radius, colors, tone_map: str = "clamp", delta=0.001, out: np.ndarray = None,
+          solver: str = "direct", solver_reports: list = None, profile: PipelineProfile = None, norm: str = "1",
+          cache=None, dtype=None, single_pass: bool = False, preview: int = 1, smoothing: int = 0,
+          alpha: str = "straight", cb_masks: list = None, **solver_options) -> np.ndarray:
+    """
+    Applies the bloom effect to an image in memory.
+    The image is normalized once into its colors and its alpha, @see images.split_alpha, so gray, RGB and RGBA
+    images are bloomed alike. The result is RGB, or RGBA if the image has alpha.
+
+    :param image: matrix with pixel data (rows, columns, channels), either uint8 or float in range [0, 1]. Gray
+                  images may have no channel axis
+    :param radius: controls how far the bloom is spread (in pixels), or a sequence with the radius of each color
+    :param colors: color to bloom, given in int range [0, 255], or a sequence of them, which are bloomed one after
+                   the other (unless single_pass is set)
+    :param tone_map: how HDR colors are converted to LDR: clamp, reinhard, or none to get the HDR result
+    :param delta: tolerance used to match the colors, or a sequence with the tolerance of each color
+    :param out: optional float array with the shape of the result where it's stored. It may be image itself to bloom
+                it in place, which is only done for float RGB and RGBA images of type dtype (others are bloomed into
+                a new array). By default a new array is returned and image is left untouched
+    :param solver: backend used to solve the equation system, @see imgSolverBackends.make_solver
+    :param solver_reports: optional list where the report of each solve is appended
+    :param profile: optional bloomProfile.PipelineProfile recording the time and memory of each stage
+    :param norm: norm of the distance within which pixels are bloomed: 1 (diamonds, the default), 2 (disks) or inf
+                 (squares)
+    :param cache: optional imgSystemCache.SystemCache, so that the systems already solved (for any color) are not
+                  assembled and solved again
+    :param dtype: float type used through the whole pipeline (image, system, solution and tone mapping), like
+                  float32 to halve the memory used. By default the image is kept in the type it has (uint8 images
+                  are converted to float64) and the system is solved in float64. @see dtype_deviation
+    :param single_pass: whether to bloom every color with a single system, @see bloom_colors. The pixels of all the
+                        colors are then found on the image as given, instead of after the bloom of the previous ones
+    :param preview: to get a quick approximation, like for thumbnails, the bloom is solved on a grid this many times
+                    coarser and interpolated. 1 (the default) solves it exactly. @see bloomPreview.preview_deviation
+    :param smoothing: number of jacobi sweeps refining a preview at full resolution
+    :param alpha: how the alpha of the image is handled. straight (the default) blooms the colors as if the image was
+                  opaque and keeps its alpha. premultiplied adds the bloom to the premultiplied colors (so it spreads
+                  over transparent pixels) and returns them premultiplied, as additive light that may exceed the
+                  alpha. blend does the same but returns straight colors, raising the alpha of each pixel to its
+                  brightest component so that the bloom shows over transparent pixels. In both, fully transparent
+                  pixels never match the colors to bloom. Images without alpha are bloomed the same with all three
+    :param cb_masks: optional list where the boolean mask of the bloomed pixels is appended, to tone map the HDR
+                     result later as it would have been here, @see bloomToneMap
+    :param solver_options: options of the solver backend: preconditioner, tol, max_iter and track_memory
+    :return: float matrix with the pixel data of the resulting image
+    """
+    if tone_map not in TONE_MAPPINGS:
+        raise ValueError("Unknown tone mapping: {}".format(tone_map))
+
+    if out is image and not holds_colors(image, dtype):
+        out = None
+    if out is None and holds_colors(image, dtype):
+        out = image.copy()
+    elif out is not None and out is not image:
+        merge_alpha(*split_alpha(image, dtype), out)
+    img_colors, img_alpha = split_alpha(image if out is None else out, dtype)
+    visible_mask, hidden_colors = alpha_visibility(img_colors, img_alpha, alpha)
+    img_dims = (img_colors.shape[0], img_colors.shape[1])
+
+    cb_colors = [color_int_to_float(color) for color in np.atleast_2d(colors)]
+    radii = np.broadcast_to(radius, (len(cb_colors),))
+    deltas = np.broadcast_to(delta, (len(cb_colors),))
+    system_dtype = dtype if dtype is not None else np.float64
+    if preview > 1:
+        solver_options.update(preview=preview, smoothing=smoothing)
+    if single_pass:
+        cb_mask = bloom_colors(img_colors, cb_colors, radii, deltas, solver, solver_reports, profile, norm, cache,
+                               system_dtype, visible_mask, **solver_options)
+    else:
+        cb_mask = np.zeros(img_dims, dtype=bool)
+        for cb_color, color_radius, color_delta in zip(cb_colors, radii, deltas):
+            cb_mask |= bloom_color(img_colors, cb_color, int(color_radius), float(color_delta), solver,
+                                   solver_reports, profile, norm, cache, system_dtype, visible_mask, **solver_options)
+    if hidden_colors is not None:
+        img_colors -= hidden_colors
+    if cb_masks is not None:
+        cb_masks.append(cb_mask)
+
+    # convert HDR pixel values to LDR
+    tone_map_image(img_colors, tone_map, cb_mask, profile)
+    if alpha == "blend" and img_alpha is not None:
+        blend_alpha(img_colors, img_alpha)
+    if profile is not None:
+        profile.images += 1
+    return merge_alpha(img_colors, img_alpha, out)
+
+
+def quantize_image(img_mtrx: np.ndarray) -> np.ndarray:
+    """
+    Converts float pixel data to uint8, as matplotlib.image.imsave does when saving it. Values out of range [0, 1]
+    are clamped first
+
+    :param img_mtrx: float matrix with pixel data
+    :return: uint8 matrix with the pixel data
+    """
+    return (np.clip(img_mtrx, 0, 1) * 255).astype(np.uint8)
+
+
+def dtype_deviation(image: np.ndarray, radius: int, colors, dtype="float32", **bloom_options) -> np.ndarray:
+    """
+    Blooms an image in float64 and in a more compact float type, and compares both results once quantized to uint8,
+    which is what is finally saved.
+
+    :param image: matrix with pixel data (rows, columns, channels), either uint8 or float in range [0, 1]
+    :param radius: controls how far the bloom is spread (in pixels)
+    :param colors: color to bloom, given in int range [0, 255], or a sequence of them
+    :param dtype: float type to compare with float64
+    :param bloom_options: other arguments of bloom
+    :return: array with the maximum absolute difference of each channel, in uint8 levels
+    """
+    reference = quantize_image(bloom(image, radius, colors, dtype=np.float64, **bloom_options))
+    compact = quantize_image(bloom(image, radius, colors, dtype=dtype, **bloom_options))
+    return np.abs(reference.astype(np.int16) - compact).max(axis=(0, 1))
+
+
+def write_json_line(filename: str, line: str):
+    """
+    Appends a line to a file, or prints it if filename is -
+    """
+    if filename == "-":
+        print(line)
+    else:
+        with open(filename, "a") as json_file:
+            json_file.write(line + "\n")
 
 
 parser = argparse.ArgumentParser()
-parser.add_argument("image_filename", help="Path to image that will be transformed")
+parser.add_argument("image_filenames", help="Path to image that will be transformed. Several images may be given, as "
+                                            "files, glob patterns (quoted) or directories",
+                    nargs="+", metavar="image_filename")
 parser.add_argument("N", help="Controls how far the bloom is spread (in pixels)", type=int)
 parser.add_argument("R", help="Red component of color that will be bloomed (from 0 to 255)", type=int)
 parser.add_argument("G", help="Green component of color that will be bloomed (from 0 to 255)", type=int)
 parser.add_argument("B", help="Blue component of color that will be bloomed (from 0 to 255)", type=int)
+parser.add_argument("--color", help="Another color to bloom, in the same pass as R G B, optionally with its own radius "
+                                    "(N by default) and tolerance (--tolerance by default). May be repeated",
+                    nargs="+", action="append", default=[], metavar="R G B [N] [TOL]")
+parser.add_argument("--tolerance", help="Tolerance used to match the colors, in float range [0, 1]", type=float,
+                    default=0.001)
 parser.add_argument("--reinhard", help="Tells the program to use Reinhard mapping to convert HDR colors to LDR. "
                                            "If flag is not present, simple color clamping is used instead",
                         action="store_true")
-#parser.add_argument("-o", "--outfile", help="Name of the transformed image file. Defaults to [image_filename]_out, "
-#                                            "where [image_filename] is the filename given as argument. Format is "
-#                                            "always png.")
+parser.add_argument("--hdr", help="Saves the bloomed images before tone mapping, as float HDR files of this format "
+                                  "(npz also keeps the bloomed pixels), to tone map them later with bloomToneMap",
+                    choices=HDR_FORMATS, default=None)
+parser.add_argument("--alpha", help="How the alpha of the images is handled: straight blooms them as if they were "
+                                    "opaque, premultiplied adds the bloom to the premultiplied colors and saves them "
+                                    "so, and blend raises the alpha wherever the bloom spreads over transparent pixels",
+                    choices=ALPHA_MODES, default="straight")
+parser.add_argument("--norm", help="Norm of the distance within which pixels are bloomed: 1 spreads the bloom in "
+                                   "diamonds, 2 in disks and inf in squares", choices=NEIGHBOR_NORMS, default="1")
+parser.add_argument("--dtype", help="Float type used through the whole pipeline. float32 halves the memory used. By "
+                                    "default images are kept as read and the system is solved in float64",
+                    choices=("float32", "float64"), default=None)
+parser.add_argument("--dtype-report", help="Also blooms each image in float64 and in --dtype again, and prints the "
+                                           "maximum difference of each channel between both, in uint8 levels. Not "
+                                           "available with --stream",
+                    action="store_true")
+parser.add_argument("--profile", help="Prints, for each image, the time, peak memory and calls of each stage of the "
+                                      "pipeline, along with the bloomed pixels, unknowns and non zeros of the systems",
+                    action="store_true")
+parser.add_argument("--profile-json", help="File where the profile of each image is appended as a line of json "
+                                           "(- prints them)", default=None, metavar="FILE")
+parser.add_argument("--preview", help="Solves the bloom on a grid FACTOR times coarser and interpolates it, for quick "
+                                      "previews and thumbnails. 1 solves it exactly", type=int, default=1,
+                    metavar="FACTOR")
+parser.add_argument("--smoothing", help="Number of jacobi sweeps refining a preview at full resolution", type=int,
+                    default=0)
+parser.add_argument("--preview-report", help="Also blooms each image exactly and prints the maximum and mean "
+                                             "difference of each channel with the preview, in uint8 levels. Not "
+                                             "available with --stream",
+                    action="store_true")
+parser.add_argument("--timings", help="Prints the time spent setting up and solving the equation system, along with "
+                                        "the residual, iterations and peak memory of the solve",
+                    action="store_true")
+parser.add_argument("--solver", help="Backend used to solve the equation system. direct factorizes it with SuperLU, "
+                                     "the others are iterative and need much less memory for large N. matrix-free "
+                                     "doesn't even assemble the matrix",
+                    choices=list(SOLVER_BACKENDS), default="direct")
+parser.add_argument("--preconditioner", help="Preconditioner of the cg, minres and matrix-free solvers. ichol needs "
+                                             "the assembled matrix, and sor (red-black symmetric SOR sweeps) is only "
+                                             "available with matrix-free. jacobi by default, multigrid always "
+                                             "uses its V-cycle",
+                    choices=PRECONDITIONERS, default=None)
+parser.add_argument("--tol", help="Relative tolerance of the iterative solvers", type=float, default=1e-8)
+parser.add_argument("--max-iter", help="Maximum iterations of the iterative solvers", type=int, default=None)
+parser.add_argument("--components", help="Solves each connected group of bloomed pixels as a separate system, "
+                                         "concurrently", action="store_true")
+parser.add_argument("--component-workers", help="Number of threads (or processes) solving the components. Defaults "
+                                                "to the number of CPUs", type=int, default=None)
+parser.add_argument("--component-executor", help="Whether the components are solved by threads or processes",
+                    choices=("thread", "process"), default="thread")
+parser.add_argument("-j", "--jobs", help="Number of worker processes used when several images are given. "
+                                         "0 uses one per CPU", type=int, default=1)
+parser.add_argument("--blas-threads", help="Maximum number of BLAS threads of each worker", type=int, default=None)
+parser.add_argument("--output-dir", help="Directory of the transformed images. Defaults to the directory of each "
+                                         "image", default=None)
+parser.add_argument("--suffix", help="Suffix added to the name of the transformed images", default="_out")
+parser.add_argument("--output-template", help="Format of the name of the transformed images. It may use {stem} "
+                                              "(image name without extension), {ext} (extension), {name} (image "
+                                              "name) and {suffix}", default="{stem}{suffix}{ext}")
+parser.add_argument("--large", help="Processes each image in strips of rows, from a memory mapped copy, so that only "
+                                    "the rows reached by the bloom are held in memory as float. For very large images",
+                    action="store_true")
+parser.add_argument("--strip-rows", help="Number of rows processed at a time with --large", type=int, default=256)
+parser.add_argument("--scratch-dir", help="Directory of the temporary files used with --large. Defaults to the "
+                                          "temporary directory of the system", default=None)
+parser.add_argument("--cache-dir", help="Directory of a cache of equation systems and their solutions, reused when "
+                                        "the same pixels are bloomed again with any color", default=None)
+parser.add_argument("--cache-size", help="Maximum size of the cache, in MiB. The least recently used systems are "
+                                         "removed", type=float, default=1024)
+parser.add_argument("--force", help="Transforms the images even if their outputs are up to date: newer than them and "
+                                      "bloomed with the same parameters",
+                    action="store_true")
+parser.add_argument("--stream", help="Treats the images as the frames of a sequence, read and written one at a time, "
+                                     "and reuses the equation system while the bloomed pixels do not change. "
+                                     "Animations (like animated gifs) are split into numbered png frames",
+                    action="store_true")
 
-if __name__ == '__main__':
-    args = parser.parse_args()
 
-    in_filename = args.image_filename
+def parse_color_targets(args) -> tuple:
+    """
+    Gathers the colors to bloom given in the command line: R G B, along with every --color
 
-    # os.path.split divides the filename in the head, which contains the parent folders of the file and tail, which
-    # contains the filename with it's extension
-    (dir, filename) = os.path.split(in_filename)
+    :param args: arguments parsed by parser
+    :return: a tuple with the list of colors, the list of their radii and the list of their tolerances
+    """
+    colors, radii, deltas = [[args.R, args.G, args.B]], [args.N], [args.tolerance]
+    for values in args.color:
+        if not 3 <= len(values) <= 5:
+            parser.error("--color takes R G B, and optionally N and TOL")
+        try:
+            colors.append([int(component) for component in values[0:3]])
+            radii.append(int(values[3]) if len(values) > 3 else args.N)
+            deltas.append(float(values[4]) if len(values) > 4 else args.tolerance)
+        except ValueError:
+            parser.error("invalid --color: {}".format(" ".join(values)))
+    return colors, radii, deltas
 
-    # os.path.splittext divides once more the filename into its name without extension and the extension.
-    # This will be useful for generating the out filename
-    (short_name, extension) = os.path.splitext(filename)
 
-    out_filename = os.path.join(dir,short_name+"_out"+extension)
-    #print(out_filename)
+def main(argv=None):
+    import bloomBatch
 
-    np_img = mpimg.imread(args.image_filename)
-    np_img = convert_to_float_img(np_img)
-    img_dims = (np_img.shape[0], np_img.shape[1])
+    args = parser.parse_args(argv)
+    colors, radii, deltas = parse_color_targets(args)
+    if args.preconditioner == "sor" and args.solver != "matrix-free":
+        parser.error("--preconditioner sor only works with --solver matrix-free")
+    if args.solver == "matrix-free" and (args.preconditioner == "ichol" or args.components):
+        parser.error("--solver matrix-free has no assembled matrix to use --preconditioner ichol or --components")
+    if args.solver == "multigrid":
+        if args.preconditioner is not None:
+            parser.error("--solver multigrid is always preconditioned with its V-cycle, don't give --preconditioner")
+        args.preconditioner = "multigrid"
+    elif args.preconditioner is None:
+        args.preconditioner = "jacobi"
+    if args.stream and args.dtype_report:
+        parser.error("--dtype-report blooms each image on its own, so it can't be used with --stream")
+    if args.stream and args.preview_report:
+        parser.error("--preview-report blooms each image on its own, so it can't be used with --stream")
+    tone_map = "reinhard" if args.reinhard else "clamp"
+    output_template = args.output_template
+    if args.hdr is not None:
+        if args.reinhard or args.large or args.alpha == "blend":
+            parser.error("--hdr saves the images before tone mapping (and before blending their alpha), so it can't "
+                         "be used with --reinhard, --large or --alpha blend")
+        tone_map = "none"
+        output_template = output_template.replace("{ext}", "." + args.hdr)
+    # colors given with --color are bloomed in a single pass along with R G B
+    single_pass = len(colors) > 1
+    if not single_pass:
+        colors, radii, deltas = colors[0], radii[0], deltas[0]
 
-    cb_color = color_int_to_float([args.R, args.G, args.B])
-    #cb_color = np.array([color_int_to_float(comp) for comp in [args.R, args.G, args.B]])
-    delta = 0.001
+    in_filenames = bloomBatch.expand_image_paths(args.image_filenames, args.suffix)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
 
-    # It's better to store an index ref to the CB pixel, as we suppose that, most of the times,
-    # there will be less pixels to bloom than pixels in total
-    cb_indices = get_matching_pixel_indices(np_img, cb_color, img_dims)
+    cache = None
+    if args.cache_dir is not None:
+        from imgSystemCache import SystemCache
+        cache = SystemCache(args.cache_dir, int(args.cache_size * 2**20))
 
-    # Uncomment this to see the which pixels matched with the given cb pixel color
-    # spy_inds(cb_indices, img_dims)
-
-    # getting the neighbor pixels that will be the variables of the Laplace equation
-    variable_indices = get_neighbor_pixel_indices_norm_1(cb_indices, img_dims, args.N)
-    variable_indices = list(variable_indices)
-
-    # once again, to see the position of the neighbors, uncomment this line
-    # spy_inds(variable_indices, img_dims)
-
-    # Enumerating each unknown variable
-    n_vars = len(variable_indices)
-    var_dict = simple_pixel_mapping(variable_indices, n_vars, sort=True)
-
-    # creating the equation system with sparse matrices
-    sparse_matrix, right_hand_side = build_equation_system(var_dict, n_vars, cb_indices, img_dims)
-
-    # solving for each color component
-    sol_R = scipy.sparse.linalg.spsolve(sparse_matrix, cb_color[0] * right_hand_side)
-    sol_G = scipy.sparse.linalg.spsolve(sparse_matrix, cb_color[1] * right_hand_side)
-    sol_B = scipy.sparse.linalg.spsolve(sparse_matrix, cb_color[2] * right_hand_side)
-
-    # now, we sum these onto a new image
-    out_image = copy.deepcopy(np_img)
-    for var in var_dict:
-        ind = var_dict[var]
-        added_R = sol_R[ind]
-        added_G = sol_G[ind]
-        added_B = sol_B[ind]
-        out_image[var[0], var[1]][0] += added_R
-        out_image[var[0], var[1]][1] += added_G
-        out_image[var[0], var[1]][2] += added_B
+    if args.stream:
+        import bloomStream
+        stream = bloomStream.BloomStream(radii, colors, tone_map, deltas,
+                                         solver=args.solver, single_pass=single_pass, norm=args.norm, dtype=args.dtype,
+                                         alpha=args.alpha,
+                                         preview=args.preview, smoothing=args.smoothing,
+                                         preconditioner=args.preconditioner, tol=args.tol, max_iter=args.max_iter,
+                                         track_memory=args.timings, split_components=args.components,
+                                         workers=args.component_workers, executor=args.component_executor,
+                                         cache=cache, profile=PipelineProfile(args.profile))
+        try:
+            stream.run(bloomStream.iter_sequence(in_filenames, args.output_dir, args.suffix, output_template))
+        finally:
+            stream.profile.finish()
+        print(stream)
+        if args.profile:
+            print(stream.profile)
+        if args.profile_json is not None:
+            write_json_line(args.profile_json, stream.profile.json_line(sequence=in_filenames))
+        return
 
-    # convert HDR pixel values to LDR
-    if args.reinhard:
-        max_lum = get_img_max_luminance(out_image, img_dims)
-        reinhard_image_mapping(out_image, img_dims, max_lum, cb_indices)
+    bloom_options = {"radius": radii, "colors": colors, "delta": deltas, "single_pass": single_pass,
+                     "tone_map": tone_map, "solver": args.solver, "norm": args.norm,
+                     "dtype": args.dtype, "alpha": args.alpha, "preview": args.preview, "smoothing": args.smoothing,
+                     "preconditioner": args.preconditioner, "tol": args.tol, "max_iter": args.max_iter,
+                     "track_memory": args.timings, "split_components": args.components,
+                     "workers": args.component_workers, "executor": args.component_executor, "cache": cache}
+    # the options that change the output images, which are only skipped if bloomed with the same ones
+    output_parameters = {name: bloom_options[name] for name in OUTPUT_PARAMETERS}
 
-    else:
-        clamp_image_colors(out_image, img_dims)
+    summary_skipped = 0
+    jobs_list = []
+    for in_filename in in_filenames:
+        out_filename = bloomBatch.output_path(in_filename, args.output_dir, args.suffix, output_template)
+        if not args.force and bloomBatch.is_up_to_date(in_filename, out_filename, output_parameters):
+            print("{}: skipped (up to date, use --force)".format(in_filename))
+            summary_skipped += 1
+        else:
+            jobs_list.append((in_filename, out_filename))
+
+    bloom_function = bloomBatch.bloom_file
+    if args.large:
+        import bloomLarge
+        bloom_options.update(strip_rows=args.strip_rows, scratch_dir=args.scratch_dir)
+        bloom_function = bloomLarge.bloom_large_file
+
+    def print_reports(in_filename, solver_reports, profile):
+        if args.timings:
+            for report in solver_reports:
+                print("{}: {}".format(in_filename, report) if len(in_filenames) > 1 else report)
+        if args.profile:
+            print("{}:\n{}".format(in_filename, profile))
+        if args.profile_json is not None:
+            write_json_line(args.profile_json, profile.json_line(image=in_filename))
 
-    # uncomment these lines to see the image plotted
-    # fig = plt.figure(figsize=(15, 10))
-    # plt.imshow(out_image)
-    # plt.show()
+    summary = bloomBatch.run_batch(jobs_list, bloom_options, args.jobs, args.blas_threads,
+                                   print_reports if args.timings or args.profile or args.profile_json else None,
+                                   bloom_function, args.profile)
+    summary.skipped = summary_skipped
+    # parameters are only saved next to the outputs of batches, and kept up to date where they already were
+    failed_filenames = {in_filename for in_filename, _ in summary.failed}
+    for in_filename, out_filename in jobs_list:
+        if in_filename not in failed_filenames and (len(in_filenames) > 1 or bloomBatch.has_parameters(out_filename)):
+            bloomBatch.save_parameters(out_filename, output_parameters)
 
-    # Save the result in a image
-    mpimg.imsave(out_filename, out_image)
+    # the summary is always shown for batches, and only on errors or on demand for a single image
+    if len(in_filenames) > 1 or summary.failed or args.timings:
+        print(summary)
+    if args.profile and len(jobs_list) > 1:
+        print("all images:\n{}".format(summary.profile))
+    if args.dtype_report:
+        for in_filename, _ in jobs_list:
+            deviation = dtype_deviation(read_image(in_filename), radii, colors, args.dtype or "float32",
+                                        delta=deltas, single_pass=single_pass, tone_map=bloom_options["tone_map"],
+                                        solver=args.solver, norm=args.norm, alpha=args.alpha,
+                                        preconditioner=args.preconditioner, tol=args.tol, max_iter=args.max_iter)
+            print("{}: max deviation from float64 in {} (uint8 levels per channel): {}".format(
+                in_filename, args.dtype or "float32", " ".join(str(level) for level in deviation)))
+    if args.preview_report:
+        from bloomPreview import preview_deviation, BOUND_MIN_RADIUS, MEAN_DEVIATION_BOUNDS
+        mean_bound = MEAN_DEVIATION_BOUNDS.get(args.preview) if np.min(radii) >= BOUND_MIN_RADIUS * args.preview \
+            else None
+        for in_filename, _ in jobs_list:
+            max_deviation, mean_deviation = preview_deviation(
+                read_image(in_filename), radii, colors, args.preview, args.smoothing, delta=deltas,
+                single_pass=single_pass, tone_map=bloom_options["tone_map"], solver=args.solver, norm=args.norm,
+                dtype=args.dtype, alpha=args.alpha, preconditioner=args.preconditioner, tol=args.tol,
+                max_iter=args.max_iter)
+            print("{}: deviation of the preview from the full solve (uint8 levels per channel): max {}, mean over the "
+                  "bloomed pixels {}".format(
+                in_filename, " ".join(str(level) for level in max_deviation),
+                " ".join("{:.3f}".format(level) for level in mean_deviation)))
+            if mean_bound is not None and mean_deviation.max() > mean_bound:
+                print("{}: the mean deviation is over the known bound of {} levels of --preview {}".format(
+                    in_filename, mean_bound, args.preview))
+    if summary.failed:
+        raise SystemExit(1)
 
+
+if __name__ == '__main__':
+    main()
@@ -34,14 +34,35 @@ def within_eps_colors(c1: np.ndarray, c2: np.ndarray, delta: float) -> bool:
     :param delta: tolerance of the operation. Less means more precision
     :return: True if the absolute value of all components is less than delta, False otherwise
     """
-    num_of_components = len(c1)  # for now, only RGB is considered
-    truth_array = [within_eps(c1[i], c2[i], delta) for i in
-                   range(num_of_components)]  # evaluating for each RGB component
-    total_true = sum(truth_array)  # each time the condition holds, it sums 1
-    if total_true == len(truth_array):  # every component must be close to be true
-        return True
+    # every component at once, @see withinEps.within_eps
+    return bool(np.all(np.fabs(np.asarray(c1, dtype=np.float64) - c2) < delta))
+
+
+def within_eps_colors_mask(img_colors: np.ndarray, color: np.ndarray, delta: float,
+                            out: np.ndarray = None) -> np.ndarray:
+    """
+    Vectorized version of within_eps_colors. Compares every color of an array of colors (for example, the pixels
+    of an image) against a single color, one component at a time, so no per-pixel Python work is done.
+
+    :param img_colors: array of colors, the last axis holding the color components
+    :param color: a color to be compared against every color in img_colors
+    :param delta: tolerance of the operation. Less means more precision
+    :param out: optional boolean array where the result is stored
+    :return: boolean array with the shape of img_colors without its last axis. True where the absolute difference
+             of all components is less than delta
+    """
+    if out is None:
+        out = np.ones(img_colors.shape[:-1], dtype=bool)
     else:
-        return False
+        out.fill(True)
+    # the differences and comparisons of every component reuse the same buffers, instead of allocating new ones
+    difference = np.empty(img_colors.shape[:-1], dtype=np.result_type(img_colors, np.asarray(color)))
+    matches = np.empty(img_colors.shape[:-1], dtype=bool)
+    for i in range(len(color)):
+        np.subtract(img_colors[..., i], color[i], out=difference)
+        np.less(np.fabs(difference, out=difference), delta, out=matches)
+        out &= matches
+    return out
 
 
 def clamp_color(hdr_color: np.ndarray) -> np.ndarray:
@@ -104,3 +125,19 @@ def reinhard_mapping(hdr_color: np.ndarray, max_lum: float) -> np.ndarray:
     mapped_color = change_luminance(hdr_color, new_lum)
     ldr_color = clamp_color(mapped_color) # in case there are decimal reminders from last operations
     return ldr_color
+
+
+def reinhard_luminance_scale(old_lum: np.ndarray, max_lum: float) -> np.ndarray:
+    """
+    Vectorized Reinhard Mapping of luminance values. Returns the factor each color has to be multiplied by to get
+    its mapped luminance, which is 1 where the luminance is near zero, as in change_luminance.
+    @see reinhard_mapping
+
+    :param old_lum: array of luminance values
+    :param max_lum: max luminance to perform the mapping
+    :return: array with the scale of each color
+    """
+    factor = old_lum * (1 + (old_lum / max_lum**2))
+    new_lum = factor / (1 + old_lum)
+    near_zero = np.fabs(old_lum) < 0.001
+    return np.divide(new_lum, old_lum, out=np.ones_like(new_lum), where=~near_zero)
@@ -24,24 +24,62 @@ def in_image_bounds(pixel_index, image_dims):
     return False
 
 
+def add_to_pixels(img_mtrx, pixel_indices, values, out=None):
+    """
+    Adds values to the color components of the pixels at pixel_indices, all of them in a single fancy indexing
+    operation.
+    By default the values are added in place. If out is given, img_mtrx is left untouched and the result is written
+    in out instead, which allows reusing the same preallocated buffer for several images.
+
+    :param img_mtrx: matrix with pixel data representing the image
+    :param pixel_indices: flat (row order) indices of the pixels
+    :param values: array of shape (len(pixel_indices), n_components) with the values to add to each pixel
+    :param out: optional array with the same shape as img_mtrx where the result is stored
+    :return: the resulting image, which is either img_mtrx or out
+    """
+    if out is None:
+        out = img_mtrx
+    elif out is not img_mtrx:
+        np.copyto(out, img_mtrx)
+    rows, cols = np.divmod(pixel_indices, out.shape[1])
+    out[rows, cols, 0:values.shape[1]] += values
+    return out
+
+
 def get_img_max_luminance(img_mtrx, img_dims) -> float:
     """
-    Scans through the whole image data looking for the max luminance value found in the image pixels
+    Looks through the whole image data for the max luminance value found in the image pixels
     :param img_mtrx: matrix with pixel data representing the image
     :param img_dims: a tuple representing the number of rows and number of columns of an image
     :return: the value of the max luminance found
     """
-    max_lum = 0.
-    for i in range(img_dims[0]):
-        for j in range(img_dims[1]):
-            current_color = img_mtrx[i][j][0:3]
-            lum = rgb_luminance(current_color)
-            if lum > max_lum:
-                max_lum = lum
-    return max_lum
+    img_colors = img_mtrx[0:img_dims[0], 0:img_dims[1], 0:3]
+    return float(np.max(rgb_luminance(img_colors), initial=0.))
 
 
-def reinhard_image_mapping(img_mtrx, img_dims, max_lum, excluded_pixels = set()):
+def excluded_pixels_mask(excluded_pixels, img_dims) -> np.ndarray:
+    """
+    Returns the excluded pixels as a boolean mask. They may be given either as a mask already or as an iterable of
+    (row, column) indices
+
+    :param excluded_pixels: None, a boolean mask or an iterable containing the indices of the excluded pixels
+    :param img_dims: a tuple representing the number of rows and number of columns of an image
+    :return: None if there are no excluded pixels, a boolean mask with the image dimensions otherwise
+    """
+    if excluded_pixels is None:
+        return None
+    if isinstance(excluded_pixels, np.ndarray) and excluded_pixels.dtype == bool:
+        return excluded_pixels
+    excluded_pixels = list(excluded_pixels)
+    if len(excluded_pixels) == 0:
+        return None
+    mask = np.zeros(img_dims, dtype=bool)
+    index_array = np.array(excluded_pixels, dtype=np.intp)
+    mask[index_array[:, 0], index_array[:, 1]] = True
+    return mask
+
+
+def reinhard_image_mapping(img_mtrx, img_dims, max_lum, excluded_pixels=None):
     """
     Applies Reinhard Mapping to all pixels of an image, except for those given in excluded_pixels.
     @see colors.reinhard_mapping
@@ -49,54 +87,134 @@ def reinhard_image_mapping(img_mtrx, img_dims, max_lum, excluded_pixels = set())
     :param img_mtrx: matrix with pixel data representing the image
     :param img_dims: a tuple representing the number of rows and number of columns of an image
     :param max_lum: max luminance to perform the mapping
-    :param excluded_pixels: an iterable containing the indices of the pixels to exclude from mapping
+    :param excluded_pixels: a boolean mask or an iterable containing the indices of the pixels to exclude from mapping
     :return:
     """
-    _hdr_to_ldr_image(img_mtrx, img_dims, reinhard_mapping, excluded_pixels, max_lum)
+    img_colors = img_mtrx[0:img_dims[0], 0:img_dims[1], 0:3]
+    excluded_mask = excluded_pixels_mask(excluded_pixels, img_dims)
 
+    scale = reinhard_luminance_scale(rgb_luminance(img_colors), max_lum)
+    if excluded_mask is not None:
+        scale[excluded_mask] = 1.
+    img_colors *= scale[..., np.newaxis]
+    _clamp_colors(img_colors, excluded_mask)
 
-def clamp_image_colors(img_mtrx, img_dims, excluded_pixels=set()):
+
+def clamp_image_colors(img_mtrx, img_dims, excluded_pixels=None):
     """
     Applies simple clamping to all pixels of an image, except for those in excluded_pixels
     @see colors.clamp_color
 
     :param img_mtrx: matrix with pixel data representing the image
     :param img_dims: a tuple representing the number of rows and number of columns of an image
-    :param excluded_pixels: an iterable containing the indices of the pixels to exclude from mapping
+    :param excluded_pixels: a boolean mask or an iterable containing the indices of the pixels to exclude from mapping
     :return:
     """
-    _hdr_to_ldr_image(img_mtrx, img_dims, clamp_color, excluded_pixels)
+    img_colors = img_mtrx[0:img_dims[0], 0:img_dims[1], 0:3]
+    _clamp_colors(img_colors, excluded_pixels_mask(excluded_pixels, img_dims))
 
 
-def _hdr_to_ldr_image(img_mtrx, img_dims, mapping_function, excluded_pixels, *additional_args):
+def _clamp_colors(img_colors, excluded_mask):
     """
-    Maps pixels from an image in (possibly) hdr to ldr, except for those in excluded_pixels, using a
-    mapping_function to convert individual pixels
+    Clamps, in place, the colors of an image to 1.0, except for those in excluded_mask
     """
-    for i in range(img_dims[0]):
-        for j in range(img_dims[1]):
-            if (i, j) not in excluded_pixels:
-                current_color = img_mtrx[i][j][0:3]
-                if len(additional_args) > 0:
-                    new_mapped = mapping_function(current_color, *additional_args)
-                else:
-                    new_mapped = mapping_function(current_color)
-                img_mtrx[i][j][0:3] = new_mapped
+    if excluded_mask is None:
+        np.minimum(img_colors, 1.0, out=img_colors)
+    else:
+        np.minimum(img_colors, 1.0, out=img_colors, where=~excluded_mask[..., np.newaxis])
 
 
-def convert_to_float_img(img_mtrx):
+def convert_to_float_img(img_mtrx, dtype=None):
     """
     Since the library matplotlib.images handles most of the cases to transform image data
     to RGB (or RGBA) data, we only have to worry for the final output of the matrix, if its
-    8-bit unsigned integer (uint8) or float.
-    If it's integer, it gets converted to float. If it's float, the image is left as it is.
+    unsigned integer (8-bit uint8, or 16-bit uint16 as saved in npy files) or float.
+    If it's integer, it gets converted to float, dividing it by its largest value. If it's float, the image is left as
+    it is (HDR values over 1 included), unless a dtype is given.
 
     :param img_mtrx: matrix with pixel data representing the image
+    :param dtype: float type of the result. By default integer images are converted to float64
     :return: image matrix of type float in range [0,1]
     """
-    if img_mtrx.dtype == np.uint8:
-        converted_img = img_mtrx.astype(np.float64)
-        return converted_img/255
+    if img_mtrx.dtype.kind == "u":
+        converted_img = img_mtrx.astype(np.float64 if dtype is None else dtype)
+        converted_img /= np.iinfo(img_mtrx.dtype).max
+        return converted_img
+    elif dtype is not None:
+        return img_mtrx.astype(dtype, copy=False)
     else:
         return img_mtrx
 
+
+def holds_colors(img_mtrx, dtype=None) -> bool:
+    """
+    Checks whether an image is float RGB or RGBA (of type dtype, if given), which split_alpha doesn't copy, so it
+    may be bloomed in place
+
+    :param img_mtrx: matrix with pixel data representing the image
+    :param dtype: float type the image should have. Any float type by default
+    :return: True if the colors and alpha given by split_alpha are views of img_mtrx
+    """
+    return img_mtrx.ndim == 3 and img_mtrx.shape[2] in (3, 4) and img_mtrx.dtype.kind == "f" and \
+        (dtype is None or img_mtrx.dtype == dtype)
+
+
+def split_alpha(img_mtrx, dtype=None) -> tuple:
+    """
+    Normalizes the pixel data of an image, whatever its channels, into float colors (rows, columns, 3) and a separate
+    alpha plane (rows, columns), so that the rest of the pipeline works on whole arrays of RGB colors.
+    Float RGB and RGBA images are not copied (unless a different dtype is given): their colors and alpha are views
+    of them. Every other image is converted once, into contiguous arrays: uint8 colors and alpha are converted
+    separately, and gray levels are repeated into the three color channels. Palette images are read as RGBA already
+
+    :param img_mtrx: matrix with pixel data, either uint8 or float in range [0, 1]. Gray images may have no channel
+                     axis, or one channel (two with alpha). Color images have three channels (four with alpha)
+    :param dtype: float type of the result. By default float images keep theirs, @see convert_to_float_img
+    :return: a tuple with the colors and the alpha, which is None if the image has no alpha channel
+    """
+    if img_mtrx.ndim == 2:
+        img_mtrx = img_mtrx[..., np.newaxis]
+    n_channels = img_mtrx.shape[2]
+    if n_channels not in (1, 2, 3, 4):
+        raise ValueError("Unsupported number of channels: {}".format(n_channels))
+    if n_channels <= 2:
+        img_colors = convert_to_float_img(np.repeat(img_mtrx[..., 0:1], 3, axis=2), dtype)
+    else:
+        img_colors = convert_to_float_img(img_mtrx[..., 0:3], dtype)
+    alpha = convert_to_float_img(img_mtrx[..., -1], dtype) if n_channels in (2, 4) else None
+    return img_colors, alpha
+
+
+def merge_alpha(img_colors, alpha, out=None):
+    """
+    Puts the colors and the alpha given by split_alpha back together, into an RGB image if there is no alpha and
+    into an RGBA image otherwise
+
+    :param img_colors: float array (rows, columns, 3) with the colors
+    :param alpha: float array (rows, columns) with the alpha, or None
+    :param out: optional float array (rows, columns, 3 or 4) where the image is stored. The colors and the alpha
+                that are views of it already are not copied
+    :return: the image, which is out if given, and img_colors itself if there is no alpha
+    """
+    if out is None:
+        if alpha is None:
+            return img_colors
+        out = np.empty(img_colors.shape[0:2] + (4,), dtype=img_colors.dtype)
+    if not np.may_share_memory(out, img_colors):
+        out[..., 0:3] = img_colors
+    if alpha is not None and not np.may_share_memory(out, alpha):
+        out[..., 3] = alpha
+    return out
+
+
+def blend_alpha(img_colors, alpha):
+    """
+    Converts, in place, premultiplied colors into straight ones, first raising the alpha of each pixel up to its
+    brightest color component (at most 1), so that colors added over transparent pixels show
+
+    :param img_colors: float array (rows, columns, 3) with premultiplied colors
+    :param alpha: float array (rows, columns) with the alpha of the pixels, updated in place
+    """
+    np.maximum(alpha, np.minimum(img_colors.max(axis=2), 1), out=alpha)
+    visible = (alpha > 0)[..., np.newaxis]
+    np.divide(img_colors, alpha[..., np.newaxis], out=img_colors, where=visible)
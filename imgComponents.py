@@ -0,0 +1,212 @@
+"""
+autor: Valentina Garrido
+
+Decomposition of the bloom equation system into its connected components.
+Each variable is only related to its 4 contiguous pixels, so groups of variables that do not touch (like the bloom
+of highlights that are far apart) form independent systems. Solving them separately needs less memory (the fill-in
+of a factorization grows faster than the size of the system) and they may be solved concurrently.
+"""
+
+from imgLaplaceSolver import system_dtype
+from imgSolverBackends import make_solver, SolveReport, VariablePositions, variable_positions, relative_residual, \
+    _MemoryTracker
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from scipy.sparse import csr_matrix
+import scipy.ndimage
+import numpy as np
+import time
+import os
+
+
+def variable_components(label_img: np.ndarray):
+    """
+    Finds the connected components (4-connectivity, as the 5-point stencil) of the variables of a label image
+
+    :param label_img: int array with the image dimensions, with the number of each variable and -1 elsewhere
+    :return: a tuple with the number of components and an array holding the component of each variable
+    """
+    component_img, n_components = scipy.ndimage.label(label_img >= 0)
+    # label_img numbers the variables in row order, which is also the order of boolean indexing
+    return n_components, component_img[label_img >= 0] - 1
+
+
+def _solve_block(block_matrix, positions: VariablePositions, right_hand_side: np.ndarray, backend: str,
+                 solver_options: dict):
+    """
+    Sets up a solver for a block of the system and solves it. Used by the worker processes
+
+    :return: a tuple with the solution and the report of the solver
+    """
+    solver = make_solver(block_matrix, positions, backend, **solver_options)
+    return solver.solve(right_hand_side), solver.report
+
+
+class ComponentSolver:
+    """
+    Solver that splits the system into its connected components and solves them separately, concurrently in a
+    pool of threads or processes.
+    Small components are grouped into blocks of at least min_block_size variables, so that there are not too many
+    tiny tasks. Each block is solved with one of the backends of imgSolverBackends.
+    """
+    name = "components"
+
+    def __init__(self, sparse_matrix, label_img: np.ndarray, backend: str = "direct", workers: int = None,
+                 executor: str = "thread", min_block_size: int = 2000, track_memory: bool = False, **solver_options):
+        """
+        Constructor. Splits the system into blocks
+
+        :param sparse_matrix: matrix of the system
+        :param label_img: int array with the image dimensions, with the number of each variable and -1 elsewhere
+        :param backend: backend used for each block, @see imgSolverBackends.make_solver
+        :param workers: number of threads or processes. Defaults to the number of CPUs
+        :param executor: thread or process. The direct and iterative solvers spend most of their time in compiled
+                         code, so threads are usually enough and avoid copying the blocks to other processes
+        :param min_block_size: minimum number of variables of each block, unless the component is smaller
+        :param track_memory: whether to measure the peak memory
+        :param solver_options: options of the backend
+        """
+        self.report = SolveReport("{} ({})".format(self.name, backend))
+        self.backend = backend
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.executor = executor
+        self.solver_options = solver_options
+        self.track_memory = track_memory
+        self.sparse_matrix = sparse_matrix
+        self.solvers = None
+        start = time.perf_counter()
+
+        positions = variable_positions(label_img)
+        self.n_components, components = variable_components(label_img)
+        # sorting the variables by component makes the matrix block diagonal
+        self.order = np.argsort(components, kind="stable")
+        component_bounds = np.searchsorted(components[self.order], np.arange(self.n_components + 1))
+        permuted = csr_matrix(sparse_matrix)[self.order][:, self.order]
+
+        # consecutive components are grouped until they reach min_block_size variables
+        block_size = max(min_block_size, -(-len(self.order) // (4 * self.workers)))
+        block_bounds = [0]
+        for bound in component_bounds[1:]:
+            if bound - block_bounds[-1] >= block_size or bound == len(self.order):
+                block_bounds.append(int(bound))
+        self.blocks = []
+        for block_start, block_end in zip(block_bounds[:-1], block_bounds[1:]):
+            block_vars = self.order[block_start:block_end]
+            block_positions = VariablePositions(positions.rows[block_vars], positions.cols[block_vars],
+                                                positions.img_dims)
+            self.blocks.append((block_start, block_end, permuted[block_start:block_end, block_start:block_end],
+                                block_positions))
+        self.report.setup_time = time.perf_counter() - start
+
+    def _new_pool(self):
+        if self.executor == "process":
+            return ProcessPoolExecutor(max_workers=self.workers)
+        elif self.executor == "thread":
+            return ThreadPoolExecutor(max_workers=self.workers)
+        raise ValueError("Unknown executor: {}".format(self.executor))
+
+    def _make_block_solver(self, block):
+        return make_solver(block[2], block[3], self.backend, **self.solver_options)
+
+    @staticmethod
+    def _solve_with(solver, right_hand_side: np.ndarray):
+        return solver.solve(right_hand_side), solver.report
+
+    def solve(self, right_hand_side: np.ndarray) -> np.ndarray:
+        """
+        Solves every block and merges their solutions
+
+        :param right_hand_side: array of shape (n_vars,) or (n_vars, k)
+        :return: solution with the same shape as right_hand_side
+        """
+        start = time.perf_counter()
+        permuted_rhs = right_hand_side[self.order]
+        permuted_solution = np.empty(permuted_rhs.shape, dtype=system_dtype(self.sparse_matrix))
+        with _MemoryTracker(self.track_memory) as memory, self._new_pool() as pool:
+            if self.executor == "thread":
+                # solvers (and so the factorizations) are kept for the next solves
+                if self.solvers is None:
+                    self.solvers = list(pool.map(self._make_block_solver, self.blocks))
+                results = pool.map(self._solve_with, self.solvers,
+                                   [permuted_rhs[block[0]:block[1]] for block in self.blocks])
+            else:
+                results = pool.map(_solve_block, [block[2] for block in self.blocks],
+                                   [block[3] for block in self.blocks],
+                                   [permuted_rhs[block[0]:block[1]] for block in self.blocks],
+                                   [self.backend] * len(self.blocks), [self.solver_options] * len(self.blocks))
+            block_reports = []
+            for block, (block_solution, block_report) in zip(self.blocks, results):
+                permuted_solution[block[0]:block[1]] = block_solution
+                block_reports.append(block_report)
+
+        solution = np.empty(permuted_solution.shape, dtype=permuted_solution.dtype)
+        solution[self.order] = permuted_solution
+        self.report.solve_time += time.perf_counter() - start
+        self.report.iterations = sum(block_report.iterations for block_report in block_reports)
+        self.report.converged = self.report.converged and all(block_report.converged for block_report in block_reports)
+        # factors allocated by SuperLU are not seen by the memory tracker. The threads keep all of them at once
+        factor_memory = sum(getattr(solver, "factor_memory", 0) for solver in self.solvers or [])
+        if self.track_memory:
+            self.report.peak_memory = max(self.report.peak_memory, memory.peak + factor_memory)
+        self.report.residual = max(self.report.residual, relative_residual(self.sparse_matrix, solution,
+                                                                           right_hand_side))
+        return solution
+
+    def timings(self) -> dict:
+        return {"factorization": self.report.setup_time, "solve": self.report.solve_time}
+
+
+def benchmark_component_scaling(component_counts=(1, 4, 16, 64, 256), img_dims=(1024, 1024), radius: int = 24,
+                                workers: int = None, backend: str = "direct"):
+    """
+    Measures the time and memory of solving the bloom of a synthetic image with a given number of highlights, as one
+    system and split into components.
+    Highlights are small squares placed on a regular grid, so their blooms do not touch.
+
+    :param component_counts: numbers of highlights to try (squares of integers give an even grid)
+    :param img_dims: dimensions of the synthetic image
+    :param radius: bloom radius
+    :param workers: number of threads of the component solver
+    :param backend: backend used for the whole system and for each block
+    :return: list of dictionaries with the results of each count
+    """
+    from imgIndices import pixel_label_image, get_neighbor_pixel_mask
+    from imgLaplaceSolver import build_equation_system_from_labels
+
+    results = []
+    for count in component_counts:
+        per_side = int(np.ceil(np.sqrt(count)))
+        cb_mask = np.zeros(img_dims, dtype=bool)
+        centers_r = (np.arange(per_side) + 0.5) * img_dims[0] / per_side
+        centers_c = (np.arange(per_side) + 0.5) * img_dims[1] / per_side
+        for k in range(count):
+            r, c = int(centers_r[k // per_side]), int(centers_c[k % per_side])
+            cb_mask[r - 1:r + 2, c - 1:c + 2] = True
+        band_radius = min(radius, int(min(img_dims) / per_side / 2) - 3)
+        band = get_neighbor_pixel_mask(cb_mask, band_radius)
+        label_img = pixel_label_image(band)
+        sparse_matrix, right_hand_side = build_equation_system_from_labels(label_img, cb_mask)
+
+        row = {"components": count, "radius": band_radius, "unknowns": sparse_matrix.shape[0]}
+        for name, solver_factory in (("monolithic", lambda: make_solver(sparse_matrix, label_img, backend,
+                                                                        track_memory=True)),
+                                     ("split", lambda: ComponentSolver(sparse_matrix, label_img, backend, workers,
+                                                                       track_memory=True))):
+            start = time.perf_counter()
+            solver = solver_factory()
+            solver.solve(right_hand_side)
+            row[name + "_time"] = time.perf_counter() - start
+            row[name + "_memory"] = solver.report.peak_memory
+        row["speedup"] = row["monolithic_time"] / row["split_time"]
+        results.append(row)
+    return results
+
+
+if __name__ == '__main__':
+    print("{:>10} {:>7} {:>9} {:>14} {:>10} {:>8} {:>16} {:>11}".format(
+        "components", "radius", "unknowns", "monolithic (s)", "split (s)", "speedup", "monolithic (MiB)",
+        "split (MiB)"))
+    for result in benchmark_component_scaling():
+        print("{components:>10} {radius:>7} {unknowns:>9} {monolithic_time:>14.3f} {split_time:>10.3f} "
+              "{speedup:>8.2f} {monolithic_mib:>16.1f} {split_mib:>11.1f}".format(
+                monolithic_mib=result["monolithic_memory"] / 2**20, split_mib=result["split_memory"] / 2**20,
+                **result))
@@ -0,0 +1,213 @@
+"""
+autor: Valentina Garrido
+
+Image files that matplotlib.image doesn't read or write as they are: 16-bit PNG images, which Pillow (and so imread)
+reads with 8 bits per component, and float HDR images, which hold the bloom before tone mapping:
+
+* PFM, the portable float map: gray or RGB, in float32
+* .npy, a numpy array with any number of channels and its own float type
+* .npz, an .npy image along with the cb mask of the bloom, so that the image can be tone mapped later exactly as the
+  bloom would have done it, @see bloomToneMap
+"""
+
+import numpy as np
+import os
+
+
+HDR_FORMATS = ("npz", "npy", "pfm")
+
+# raw modes of 16-bit png images, and the raw modes with the same pixel size giving the high and low bytes of each
+# component. Pillow unfilters the rows with the pixel size of the raw mode, so they are read correctly with any of them
+PNG16_RAW_MODES = {"RGB;16B": ("RGB;16B", "RGB;16L"), "RGBA;16B": ("RGBA;16B", "RGBA;16L"), "LA;16B": ("RGBA",)}
+
+
+def file_format(filename, image_format: str = None) -> str:
+    """
+    :param filename: path to an image, or a file object
+    :param image_format: format given explicitly, if any
+    :return: the format of the image in lower case (png, npy...): image_format, or the extension of filename. None for
+             file objects without a format
+    """
+    if image_format is not None:
+        return image_format.lower()
+    if isinstance(filename, str):
+        return os.path.splitext(filename)[1][1:].lower() or None
+    return None
+
+
+def is_hdr_format(filename, image_format: str = None) -> bool:
+    """
+    :return: whether the image is, or will be saved as, a float HDR image file
+    """
+    return file_format(filename, image_format) in HDR_FORMATS
+
+
+def png_bit_depth(filename) -> int:
+    """
+    Reads the bit depth of a png image from its header (the IHDR chunk, which always comes first), without decoding it
+
+    :param filename: path to the image, or a file object, which is left at its start
+    :return: bits per component (or per palette index) of the image, or None if it isn't a png image
+    """
+    if hasattr(filename, "seek"):
+        filename.seek(0)
+        header = filename.read(26)
+        filename.seek(0)
+    else:
+        with open(filename, "rb") as png_file:
+            header = png_file.read(26)
+    # signature, length and type of the IHDR chunk, width, height and bit depth
+    if len(header) < 25 or header[0:8] != b"\x89PNG\r\n\x1a\n" or header[12:16] != b"IHDR":
+        return None
+    return header[24]
+
+
+def read_png16(filename) -> np.ndarray:
+    """
+    Reads a 16-bit png image with all of its precision, as float32 in range [0, 1] like imread reads 8-bit ones.
+    Color images are decoded twice, keeping the high and then the low byte of each component, since Pillow has no
+    16-bit color modes
+
+    :param filename: path to the image, or a file object
+    :return: float32 matrix with the pixel data, or None if the image is not a 16-bit png
+    """
+    if png_bit_depth(filename) != 16:
+        return None
+    from PIL import Image, PngImagePlugin
+
+    def open_png():
+        if hasattr(filename, "seek"):
+            filename.seek(0)
+        return Image.open(filename)
+
+    with open_png() as pil_img:
+        if not isinstance(pil_img, PngImagePlugin.PngImageFile) or len(pil_img.tile) != 1:
+            return None
+        # tiles are (decoder, extents, offset, raw mode) tuples
+        raw_mode = pil_img.tile[0][3]
+        if pil_img.mode == "I;16":
+            # gray levels are kept by Pillow, and converted as imread does
+            return np.divide(np.asarray(pil_img), 2**16 - 1, dtype=np.float32)
+        if raw_mode not in PNG16_RAW_MODES:
+            return None
+
+    byte_planes = []
+    for byte_raw_mode in PNG16_RAW_MODES[raw_mode]:
+        with open_png() as pil_img:
+            tile = pil_img.tile[0]
+            pil_img.tile = [tuple(tile[0:3]) + (byte_raw_mode,) + tuple(tile[4:])]
+            byte_planes.append(np.asarray(pil_img))
+    if len(byte_planes) == 1:
+        # the bytes of gray and alpha, read as 8-bit RGBA: high and low byte of the gray level, then of the alpha
+        gray_alpha = byte_planes[0].reshape(byte_planes[0].shape[0:2] + (2, 2))
+        components = gray_alpha[..., 0].astype(np.uint16) << 8 | gray_alpha[..., 1]
+    else:
+        components = byte_planes[0].astype(np.uint16) << 8 | byte_planes[1]
+    return np.divide(components, 2**16 - 1, dtype=np.float32)
+
+
+def read_pfm(filename) -> np.ndarray:
+    """
+    Reads a PFM image: a header with PF (RGB) or Pf (gray), the width and height, and a scale whose sign gives the
+    byte order (negative for little endian), followed by the float32 rows from the bottom one up
+
+    :param filename: path to the image, or a file object
+    :return: float32 matrix with the pixel data, (rows, columns, 3) for RGB and (rows, columns) for gray images
+    """
+    pfm_file = open(filename, "rb") if isinstance(filename, str) else filename
+    try:
+        header = []
+        while len(header) < 4:
+            token = b""
+            char = pfm_file.read(1)
+            while char.isspace():
+                char = pfm_file.read(1)
+            while char and not char.isspace():
+                token += char
+                char = pfm_file.read(1)
+            if not token:
+                raise ValueError("Truncated PFM header")
+            header.append(token)
+        if header[0] not in (b"PF", b"Pf"):
+            raise ValueError("Not a PFM image")
+        width, height, scale = int(header[1]), int(header[2]), float(header[3])
+        n_channels = 3 if header[0] == b"PF" else 1
+        data = np.frombuffer(pfm_file.read(), dtype="<f4" if scale < 0 else ">f4")
+    finally:
+        if pfm_file is not filename:
+            pfm_file.close()
+    if data.size < width * height * n_channels:
+        raise ValueError("Truncated PFM data")
+    pixels = data[0:width * height * n_channels].reshape((height, width, 3) if n_channels == 3 else (height, width))
+    return np.flipud(pixels).astype(np.float32)
+
+
+def write_pfm(filename, img_mtrx: np.ndarray):
+    """
+    Saves a PFM image, little endian. PFM has no alpha, so RGBA images can only be saved if they are opaque
+
+    :param filename: path of the saved image, or a file object
+    :param img_mtrx: float matrix with pixel data, gray (no channel axis, or one channel), RGB or opaque RGBA
+    """
+    if img_mtrx.ndim == 3 and img_mtrx.shape[2] in (2, 4):
+        if np.any(img_mtrx[..., -1] != 1):
+            raise ValueError("PFM images have no alpha: save images with transparency as npy or npz")
+        img_mtrx = img_mtrx[..., 0:-1]
+    if img_mtrx.ndim == 3 and img_mtrx.shape[2] == 1:
+        img_mtrx = img_mtrx[..., 0]
+    header = "{}\n{} {}\n-1.0\n".format("PF" if img_mtrx.ndim == 3 else "Pf", img_mtrx.shape[1], img_mtrx.shape[0])
+    pfm_file = open(filename, "wb") if isinstance(filename, str) else filename
+    try:
+        pfm_file.write(header.encode("ascii"))
+        pfm_file.write(np.ascontiguousarray(np.flipud(img_mtrx), dtype="<f4").tobytes())
+    finally:
+        if pfm_file is not filename:
+            pfm_file.close()
+
+
+def read_hdr_image(filename, image_format: str = None) -> tuple:
+    """
+    Reads a float HDR image file
+
+    :param filename: path to the image, or a file object
+    :param image_format: npz, npy or pfm. By default it's given by the filename extension
+    :return: a tuple with the pixel data (float, or integer if an integer array was saved as npy) and the cb mask
+             saved along with it, which is None except for npz images saved with one
+    """
+    image_format = file_format(filename, image_format)
+    if image_format == "pfm":
+        return read_pfm(filename), None
+    if image_format == "npy":
+        return np.load(filename, allow_pickle=False), None
+    if image_format == "npz":
+        with np.load(filename, allow_pickle=False) as arrays:
+            return arrays["image"], arrays["cb_mask"] if "cb_mask" in arrays.files else None
+    raise ValueError("Unsupported HDR format: {}".format(image_format))
+
+
+def write_hdr_image(filename, img_mtrx: np.ndarray, image_format: str = None, cb_mask: np.ndarray = None):
+    """
+    Saves a float HDR image file, with its values as they are (out of range [0, 1] included)
+
+    :param filename: path of the saved image, or a file object
+    :param img_mtrx: float matrix with pixel data
+    :param image_format: npz, npy or pfm. By default it's given by the filename extension
+    :param cb_mask: boolean mask of the bloomed pixels, only saved in npz images
+    """
+    image_format = file_format(filename, image_format)
+    if image_format not in HDR_FORMATS:
+        raise ValueError("Unsupported HDR format: {}".format(image_format))
+    if image_format == "pfm":
+        write_pfm(filename, img_mtrx)
+        return
+    # numpy adds its extension to the names of the files, unless they are given already open
+    hdr_file = open(filename, "wb") if isinstance(filename, str) else filename
+    try:
+        if image_format == "npy":
+            np.save(hdr_file, img_mtrx, allow_pickle=False)
+        else:
+            arrays = {"image": img_mtrx} if cb_mask is None else {"image": img_mtrx, "cb_mask": cb_mask}
+            np.savez(hdr_file, **arrays)
+    finally:
+        if hdr_file is not filename:
+            hdr_file.close()
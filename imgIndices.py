@@ -2,10 +2,13 @@
 autor: Valentina Garrido
 """
 
-from colors import within_eps_colors
+from colors import within_eps_colors_mask
 from images import in_image_bounds, get_image_pixel_num
 import numpy as np
-import matplotlib.pyplot as plt
+
+
+# distance norms supported by get_neighbor_pixel_mask
+NEIGHBOR_NORMS = ("1", "2", "inf")
 
 
 def diamond_mask(n: int) -> np.ndarray:
@@ -43,9 +46,73 @@ def create_empty_image_index_matrix(img_dims: tuple) -> np.ndarray:
     return img_index_array
 
 
+def get_matching_color_labels(img_mtrx: np.ndarray, colors_to_match, deltas=0.001) -> np.ndarray:
+    """
+    Labels each pixel of the image with the position of the first color in colors_to_match that it matches.
+    Every color is compared against the whole image at once, so this does a single pass over the targets
+    instead of a pass over the pixels.
+
+    :param img_mtrx: matrix with image pixel data
+    :param colors_to_match: a color, or a sequence of colors, to match
+    :param deltas: tolerance used for every color, or a sequence with one tolerance per color
+    :return: int array with the image dimensions. -1 where no color matched, the index of the color otherwise
+    """
+    colors_to_match = np.atleast_2d(np.asarray(colors_to_match, dtype=np.float64))
+    deltas = np.broadcast_to(np.asarray(deltas, dtype=np.float64), (colors_to_match.shape[0],))
+    img_colors = img_mtrx[..., 0:colors_to_match.shape[1]]
+
+    labels = np.full(img_mtrx.shape[:2], -1, dtype=np.int32)
+    matches = np.empty(img_mtrx.shape[:2], dtype=bool)
+    # traversed backwards, so pixels matching several colors end up labeled with the first one
+    for k in range(colors_to_match.shape[0] - 1, -1, -1):
+        within_eps_colors_mask(img_colors, colors_to_match[k], deltas[k], out=matches)
+        labels[matches] = k
+    return labels
+
+
+def get_matching_pixel_mask(img_mtrx: np.ndarray, colors_to_match, deltas=0.001) -> np.ndarray:
+    """
+    Returns a boolean mask of the pixels whose colors match any of the given colors
+
+    :param img_mtrx: matrix with image pixel data
+    :param colors_to_match: a color, or a sequence of colors, to match
+    :param deltas: tolerance used for every color, or a sequence with one tolerance per color
+    :return: boolean array with the image dimensions, True for matching pixels
+    """
+    colors_to_match = np.atleast_2d(np.asarray(colors_to_match, dtype=np.float64))
+    if colors_to_match.shape[0] == 1:
+        img_colors = img_mtrx[..., 0:colors_to_match.shape[1]]
+        return within_eps_colors_mask(img_colors, colors_to_match[0], np.ravel(deltas)[0])
+    return get_matching_color_labels(img_mtrx, colors_to_match, deltas) >= 0
+
+
+def get_matching_flat_indices(img_mtrx: np.ndarray, colors_to_match, deltas=0.001) -> np.ndarray:
+    """
+    Returns the flat (row order) indices of the pixels whose colors match any of the given colors
+
+    :param img_mtrx: matrix with image pixel data
+    :param colors_to_match: a color, or a sequence of colors, to match
+    :param deltas: tolerance used for every color, or a sequence with one tolerance per color
+    :return: sorted array of flat pixel indices
+    """
+    return np.flatnonzero(get_matching_pixel_mask(img_mtrx, colors_to_match, deltas))
+
+
+def mask_to_index_set(pixel_mask: np.ndarray) -> set:
+    """
+    Converts a boolean pixel mask into the set of (row, column) tuples used by the set based functions
+
+    :param pixel_mask: boolean array with the image dimensions
+    :return: set of the indices where the mask is True
+    """
+    rows, cols = np.nonzero(pixel_mask)
+    return set(zip(rows.tolist(), cols.tolist()))
+
+
 def get_matching_pixel_indices(img_mtrx: np.ndarray, color_to_match: np.ndarray, img_dims: tuple) -> set:
     """
     Returns the set of pixel indices whose colors match the given color_to_match
+    @see get_matching_pixel_mask
 
     :param img_mtrx: matrix with image pixel data
     :param color_to_match: array representing the color
@@ -56,14 +123,8 @@ def get_matching_pixel_indices(img_mtrx: np.ndarray, color_to_match: np.ndarray,
 
     # the in operator for numpy arrays seems to be broken, so store cb pixels to check later their presence its better
     # to use a set, which performs the in operator in O(1)
-    matching_indices = set()
-    for i in range(img_dims[0]):
-        for j in range(img_dims[1]):
-            current_color = img_mtrx[i][j][0:3]
-            if within_eps_colors(current_color, color_to_match, delta):
-                matching_indices.add((i, j))
-                # cb_indices.append((i, j)) # these indices are stored in row order
-    return matching_indices
+    matching_mask = get_matching_pixel_mask(img_mtrx[0:img_dims[0], 0:img_dims[1]], color_to_match, delta)
+    return mask_to_index_set(matching_mask)
 
 
 def get_neighbor_pixel_indices_norm_1(pixel_indices: set, img_dims: tuple, radius_n: int) -> set:
@@ -89,6 +150,50 @@ def get_neighbor_pixel_indices_norm_1(pixel_indices: set, img_dims: tuple, radiu
     return neighbor_indices
 
 
+def get_neighbor_pixel_mask(pixel_mask: np.ndarray, radius_n: int, norm: str = "1") -> np.ndarray:
+    """
+    Mask version of get_neighbor_pixel_indices_norm_1. Computes the distance from every pixel of the image to the
+    nearest pixel in pixel_mask with a distance transform, so the cost depends on the image dimensions but not on the
+    number of pixels in pixel_mask or on the radius.
+    With norm 1 the neighbors are the union of the diamonds of diamond_mask(radius_n) around each pixel; norm 2 gives
+    disks and norm inf gives squares.
+
+    :param pixel_mask: boolean array with the image dimensions, True for the pixels to get the neighbors from
+    :param radius_n: radius (in the given norm) of the shape that contains neighbors
+    :param norm: 1 (taxicab distance), 2 (euclidean distance) or inf (chessboard distance)
+    :return: boolean array with the image dimensions, True for the neighbor pixels (not including pixel_mask)
+    """
+    if not pixel_mask.any():
+        return np.zeros(pixel_mask.shape, dtype=bool)
+    neighbor_mask = pixel_distance_map(pixel_mask, norm) <= radius_n
+    neighbor_mask &= ~pixel_mask
+    return neighbor_mask
+
+
+def pixel_distance_map(pixel_mask: np.ndarray, norm: str = "1") -> np.ndarray:
+    """
+    Computes the distance from every pixel of the image to the nearest pixel in pixel_mask, with a distance transform
+
+    :param pixel_mask: boolean array with the image dimensions
+    :param norm: 1 (taxicab distance), 2 (euclidean distance) or inf (chessboard distance)
+    :return: array with the image dimensions with the distances, 0 on the pixels of pixel_mask. Int for norms 1 and
+             inf, float for norm 2, and float filled with inf if pixel_mask is empty
+    """
+    # scipy.ndimage is imported here, on first use, as it is slow to import. @see bloom_effect.IMPORT_TIME_BUDGET
+    import scipy.ndimage
+
+    norm = str(norm)
+    if norm not in NEIGHBOR_NORMS:
+        raise ValueError("Unknown norm: {}".format(norm))
+    if not pixel_mask.any():
+        return np.full(pixel_mask.shape, np.inf)
+    if norm == "1":
+        return scipy.ndimage.distance_transform_cdt(~pixel_mask, metric="taxicab")
+    elif norm == "inf":
+        return scipy.ndimage.distance_transform_cdt(~pixel_mask, metric="chessboard")
+    return scipy.ndimage.distance_transform_edt(~pixel_mask)
+
+
 def simple_pixel_mapping(pixel_indices: list, len_pixels: int, sort=True):
     """
     Returns a dictionary assigning an integer to identify each pixel index in
@@ -109,6 +214,21 @@ def simple_pixel_mapping(pixel_indices: list, len_pixels: int, sort=True):
     return neighbor_dict
 
 
+def pixel_label_image(pixel_mask: np.ndarray) -> np.ndarray:
+    """
+    Array version of simple_pixel_mapping with sort enabled. Enumerates the pixels in pixel_mask by row, then by
+    column, and stores each number at the position of its pixel.
+
+    :param pixel_mask: boolean array with the image dimensions
+    :return: int array with the image dimensions, holding the number of each pixel and -1 outside of the mask. It's
+             int32 unless the image has too many pixels, so that the indices of the sparse matrices built from it
+             are int32 too
+    """
+    label_img = np.full(pixel_mask.shape, -1, dtype=np.int32 if pixel_mask.size < 2**31 else np.int64)
+    label_img[pixel_mask] = np.arange(np.count_nonzero(pixel_mask))
+    return label_img
+
+
 def spy_inds(ind_iterable, img_dims):
     """
     Plots the pixels in ind_iterable
@@ -117,6 +237,8 @@ def spy_inds(ind_iterable, img_dims):
     :param img_dims:
     :return:
     """
+    import matplotlib.pyplot as plt  # only needed for debugging, so it is not imported along with the module
+
     mtrx = np.zeros(img_dims)
     for ind in ind_iterable:
         mtrx[ind[0], ind[1]] = 1
@@ -3,8 +3,17 @@ autor: Valentina Garrido
 """
 
 from images import in_image_bounds
-from scipy.sparse import csc_matrix
+from scipy.sparse import csc_matrix, csr_matrix
+import scipy.sparse.linalg
 import numpy as np
+import time
+
+
+# Offsets of the four contiguous pixels of the 5-point stencil. They are ordered so that, for a given variable,
+# the numbers of its contiguous variables come out sorted: up < left < (itself) < right < down
+STENCIL_OFFSETS = ((-1, 0), (0, -1), (0, 1), (1, 0))
+# position in STENCIL_OFFSETS of the pixel that is on the opposite side of each offset
+OPPOSITE_OFFSETS = (3, 2, 1, 0)
 
 
 
@@ -128,4 +137,492 @@ def build_equation_system(variable_dict, n_vars, cb_indices, img_dims):
                     sparse_data.add_entry(diag_val, variable_dict.get(contiguous_var), c)
 
     sparse_matrix = sparse_data.get_sparse_matrix()
-    return sparse_matrix, right_hand_side
\ No newline at end of file
+    return sparse_matrix, right_hand_side
+
+
+def stencil_coefficients(label_img: np.ndarray, cb_mask: np.ndarray, variables: tuple = None):
+    """
+    Computes, with whole array shifts, the coefficients that var_coefficients gives to the contiguous pixels of every
+    variable in label_img. Columns follow STENCIL_OFFSETS.
+
+    The same three cases of build_equation_system apply: an out of bounds pixel weighs 0 and doubles the opposite
+    one, a border condition (cb) pixel gets a negative coefficient that goes to the right hand side, and a pixel
+    outside of the blooming range weighs 0.
+
+    :param label_img: int array with the image dimensions, with the number of each variable and -1 elsewhere
+    :param cb_mask: boolean array with the image dimensions, True for border condition pixels
+    :param variables: optional tuple with the rows and columns of the pixels of some of the variables, to compute
+                      only their coefficients. By default, those of every variable are computed, in order
+    :return: a tuple with the variables rows and columns, the numbers of their contiguous variables (-1 if there
+             is none) and the coefficients, the last two with shape (n_vars, 4)
+    """
+    img_dims = label_img.shape
+    if variables is None:
+        rows, cols = np.nonzero(label_img >= 0)  # row order, so position k holds variable k
+    else:
+        rows, cols = variables
+    n_vars = len(rows)
+
+    out_of_bounds = np.empty((n_vars, 4), dtype=bool)
+    neighbor_labels = np.empty((n_vars, 4), dtype=label_img.dtype)
+    neighbor_is_cb = np.empty((n_vars, 4), dtype=bool)
+    for k, (row_offset, col_offset) in enumerate(STENCIL_OFFSETS):
+        neighbor_rows = rows + row_offset
+        neighbor_cols = cols + col_offset
+        out_of_bounds[:, k] = ((neighbor_rows < 0) | (neighbor_rows >= img_dims[0]) |
+                               (neighbor_cols < 0) | (neighbor_cols >= img_dims[1]))
+        np.clip(neighbor_rows, 0, img_dims[0] - 1, out=neighbor_rows)
+        np.clip(neighbor_cols, 0, img_dims[1] - 1, out=neighbor_cols)
+        neighbor_labels[:, k] = np.where(out_of_bounds[:, k], -1, label_img[neighbor_rows, neighbor_cols])
+        neighbor_is_cb[:, k] = ~out_of_bounds[:, k] & cb_mask[neighbor_rows, neighbor_cols]
+
+    coefs = np.where(out_of_bounds[:, OPPOSITE_OFFSETS], 2., 1.)
+    coefs[neighbor_is_cb] *= -1
+    # var_coefficients checks variables with var_dict.get, which is falsy for the variable numbered 0 too. That
+    # variable is then weighed 0 by its contiguous variables; this is kept to produce the very same matrix
+    coefs[~neighbor_is_cb & (neighbor_labels <= 0)] = 0
+    coefs[out_of_bounds] = 0
+    neighbor_labels[coefs <= 0] = -1
+    return rows, cols, neighbor_labels, coefs
+
+
+def system_dtype(sparse_matrix):
+    """
+    :return: the float type a system is solved in: float32 for single precision matrices, float64 otherwise
+    """
+    return np.float32 if sparse_matrix.dtype == np.float32 else np.float64
+
+
+def build_equation_system_from_labels(label_img: np.ndarray, cb_mask: np.ndarray, dtype=np.float64,
+                                      color_labels: np.ndarray = None, n_colors: int = None):
+    """
+    Array version of build_equation_system. Works on a label image of the unknowns instead of dictionaries and sets
+    of tuples, and fills the compressed sparse arrays directly instead of going through SparseData.
+    The resulting matrix and right hand side are the same that build_equation_system gives.
+    When the cb pixels belong to several bloomed colors, the right hand side may be split in one column per color,
+    each with the border conditions of the cb pixels of that color only. The columns add up to the single right
+    hand side.
+
+    :param label_img: int array with the image dimensions, with the number of each variable and -1 elsewhere.
+                      @see imgIndices.pixel_label_image
+    :param cb_mask: boolean array with the image dimensions, True for border condition pixels
+    :param dtype: float type of the matrix and the right hand side. Their values are small integers, so they are
+                  exact in float32 too
+    :param color_labels: optional int array with the image dimensions, with the color of each cb pixel and -1
+                         elsewhere. @see imgIndices.get_matching_color_labels
+    :param n_colors: number of columns of the split right hand side. Defaults to the largest color label plus one
+    :return: a tuple with the sparse matrix (csc) and the right hand side of the system, of shape (n_vars,), or
+             (n_vars, n_colors) if color_labels is given
+    """
+    rows, cols, neighbor_labels, coefs = stencil_coefficients(label_img, cb_mask)
+    n_vars = len(rows)
+
+    row_cols, row_values, stored = _stencil_rows(neighbor_labels, coefs, np.arange(n_vars), dtype)
+    indptr = np.zeros(n_vars + 1, dtype=label_img.dtype)
+    np.cumsum(np.count_nonzero(stored, axis=1), out=indptr[1:])
+
+    sparse_matrix = csr_matrix((row_values[stored], row_cols[stored], indptr), shape=(n_vars, n_vars))
+    right_hand_side = _stencil_right_hand_side(rows, cols, coefs, label_img.shape, dtype, color_labels, n_colors)
+    return sparse_matrix.tocsc(), right_hand_side
+
+
+def _stencil_rows(neighbor_labels: np.ndarray, coefs: np.ndarray, var_numbers: np.ndarray, dtype):
+    """
+    Lays out the rows of the matrix of some variables, @see stencil_coefficients
+
+    :return: a tuple with the columns and values of the 5 entries of each row, (n, 5) arrays, and a boolean (n, 5)
+             array telling which of them are stored in the sparse matrix
+    """
+    # each row of the matrix has, in column order: up, left, diagonal, right and down
+    row_cols = np.empty((len(var_numbers), 5), dtype=neighbor_labels.dtype)
+    row_values = np.empty((len(var_numbers), 5), dtype=dtype)
+    row_cols[:, [0, 1, 3, 4]] = neighbor_labels
+    row_cols[:, 2] = var_numbers
+    row_values[:, [0, 1, 3, 4]] = coefs
+    row_values[:, 2] = -4  # value of the current u_ij is multiplied by -4
+
+    stored = row_values > 0
+    stored[:, 2] = True
+    return row_cols, row_values, stored
+
+
+def _stencil_right_hand_side(rows: np.ndarray, cols: np.ndarray, coefs: np.ndarray, img_dims: tuple, dtype,
+                             color_labels: np.ndarray = None, n_colors: int = None) -> np.ndarray:
+    """
+    Adds up the coefficients of the cb pixels of some variables, @see build_equation_system_from_labels
+
+    :return: the right hand side of the variables, of shape (n,), or (n, n_colors) if color_labels is given
+    """
+    cb_coefs = np.where(coefs < 0, coefs, 0.)
+    if color_labels is None:
+        return cb_coefs.sum(axis=1).astype(dtype, copy=False)
+    if n_colors is None:
+        n_colors = int(color_labels.max(initial=-1)) + 1
+    # color of the cb pixel next to each variable, on each side. Out of bounds pixels have no coefficient, so
+    # clipping their positions is harmless
+    neighbor_colors = np.empty((len(rows), 4), dtype=color_labels.dtype)
+    for k, (row_offset, col_offset) in enumerate(STENCIL_OFFSETS):
+        neighbor_colors[:, k] = color_labels[np.clip(rows + row_offset, 0, img_dims[0] - 1),
+                                             np.clip(cols + col_offset, 0, img_dims[1] - 1)]
+    right_hand_side = np.empty((len(rows), n_colors), dtype=dtype)
+    for color in range(n_colors):
+        right_hand_side[:, color] = np.where(neighbor_colors == color, cb_coefs, 0.).sum(axis=1)
+    return right_hand_side
+
+
+class StencilOperator(scipy.sparse.linalg.LinearOperator):
+    """
+    Matrix-free form of the matrix given by build_equation_system_from_labels. Instead of storing the entries of
+    every row, the 5-point stencil is applied on the values of the variables laid out on the pixel grid, adding up
+    the four contiguous pixels of each variable: the coefficients only depend on which pixels are variables and on
+    the image bounds, @see stencil_coefficients. Pixels that are not variables (cb pixels included, which go to the
+    right hand side) hold 0 on the grid, and so does the variable numbered 0, while out of bounds pixels double the
+    opposite one.
+    Only the bounding box of the variables, with a margin of one pixel where their cb pixels are, is laid out, so
+    applying it takes an array the size of that box (which is kept between calls) and the flat position of each
+    variable in it, instead of the five entries and indices of each row of the matrix.
+
+    With symmetric, it's instead the symmetric positive definite form of the system, @see
+    imgSolverBackends.SymmetricForm: the variable numbered 0 is left out of the unknowns (if there are others), and
+    the rows are scaled by the border weights and negated.
+    """
+    def __init__(self, label_img: np.ndarray, dtype=np.float64, symmetric: bool = False):
+        """
+        Constructor
+
+        :param label_img: int array with the image dimensions, with the number of each variable and -1 elsewhere.
+                          @see imgIndices.pixel_label_image
+        :param dtype: float type of the operator
+        :param symmetric: whether to apply the symmetric form of the system instead
+        """
+        self.label_img = label_img
+        self.symmetric = symmetric
+        img_dims = label_img.shape
+        variable_mask = label_img >= 0
+        var_rows = np.flatnonzero(variable_mask.any(axis=1))
+        var_cols = np.flatnonzero(variable_mask.any(axis=0))
+        top, bottom = (max(var_rows[0] - 1, 0), min(var_rows[-1] + 2, img_dims[0])) if len(var_rows) else (0, 0)
+        left, right = (max(var_cols[0] - 1, 0), min(var_cols[-1] + 2, img_dims[1])) if len(var_cols) else (0, 0)
+        self.box = (slice(top, bottom), slice(left, right))
+        # the box is surrounded by a ring of zeros in the grid, standing for the pixels out of bounds and for those
+        # out of the box, which are neither variables nor cb pixels
+        self.grid_dims = (bottom - top + 2, right - left + 2)
+        self.reflected_borders = (top == 0, left == 0, right == img_dims[1], bottom == img_dims[0])
+
+        grid_mask = np.zeros(self.grid_dims, dtype=bool)
+        grid_mask[1:-1, 1:-1] = variable_mask[self.box]
+        del variable_mask
+        # flat position of each variable in the grid, in the order they are numbered
+        self.variable_indices = np.flatnonzero(grid_mask)
+        del grid_mask
+        n_vars = len(self.variable_indices)
+        self.first = 1 if symmetric and n_vars > 1 else 0
+        self.unknown_indices = self.variable_indices[self.first:]
+        self.unknown_fixes = self._reflected_neighbors(self.unknown_indices)
+
+        self.weights = None
+        if symmetric:
+            # negated border weights of the unknowns, @see imgSolverBackends.border_weights
+            rows, cols = np.divmod(self.unknown_indices, self.grid_dims[1])
+            self.weights = -np.ones(len(rows), dtype=dtype)
+            if img_dims[0] > 1:
+                self.weights[(rows == 1 - top) | (rows == img_dims[0] - top)] *= 0.5
+            if img_dims[1] > 1:
+                self.weights[(cols == 1 - left) | (cols == img_dims[1] - left)] *= 0.5
+        self._grids = {}
+        n_unknowns = n_vars - self.first
+        super().__init__(dtype=np.dtype(dtype), shape=(n_unknowns, n_unknowns))
+
+    def _reflected_neighbors(self, indices: np.ndarray) -> list:
+        """
+        :param indices: flat positions in the grid
+        :return: list of (positions in indices, offset) pairs, with the positions on each border of the image and the
+                 offset of the contiguous pixel opposite to the out of bounds one, which weighs 2
+        """
+        rows, cols = np.divmod(indices, self.grid_dims[1])
+        top_border, left_border, right_border, bottom_border = self.reflected_borders
+        sides = ((top_border, rows == 1, self.grid_dims[1]), (bottom_border, rows == self.grid_dims[0] - 2,
+                                                              -self.grid_dims[1]),
+                 (left_border, cols == 1, 1), (right_border, cols == self.grid_dims[1] - 2, -1))
+        return [(np.flatnonzero(on_side), offset) for border, on_side, offset in sides if border]
+
+    def _get_grid(self, columns_shape: tuple) -> np.ndarray:
+        """
+        :return: the grid for values with some trailing columns. It's kept, and only ever written at the variables
+        """
+        if columns_shape not in self._grids:
+            self._grids[columns_shape] = np.zeros(self.grid_dims + columns_shape, dtype=self.dtype)
+        return self._grids[columns_shape]
+
+    def _neighbor_sum(self, grid: np.ndarray, indices: np.ndarray, reflected_neighbors: list) -> np.ndarray:
+        """
+        Adds up the contiguous pixels of some pixels of the grid, weighed by their coefficients
+
+        :param grid: array (box rows + 2, box columns + 2, ...) with the values of the pixels of the box
+        :param indices: flat positions of the pixels in the grid
+        :param reflected_neighbors: @see _reflected_neighbors
+        :return: array (len(indices), ...) with the sums
+        """
+        flat_grid = grid.reshape((-1,) + grid.shape[2:])
+        total = flat_grid.take(indices - self.grid_dims[1], axis=0)
+        for offset in (-1, 1, self.grid_dims[1]):
+            total += flat_grid.take(indices + offset, axis=0)
+        for positions, offset in reflected_neighbors:
+            total[positions] += flat_grid.take(indices[positions] + offset, axis=0)
+        return total
+
+    def _apply(self, x: np.ndarray) -> np.ndarray:
+        x = np.asarray(x, dtype=self.dtype)
+        grid = self._get_grid(x.shape[1:])
+        flat_grid = grid.reshape((-1,) + x.shape[1:])
+        flat_grid[self.unknown_indices] = x
+        if not self.symmetric and len(x) > 0:
+            # the variable numbered 0 weighs 0 on its contiguous variables
+            flat_grid[self.variable_indices[0]] = 0
+        result = self._neighbor_sum(grid, self.unknown_indices, self.unknown_fixes)
+        result -= 4 * x
+        if self.symmetric:
+            result *= self.weights.reshape((-1,) + (1,) * (x.ndim - 1))
+        return result
+
+    def _matvec(self, x: np.ndarray) -> np.ndarray:
+        return self._apply(np.ravel(x))
+
+    def _matmat(self, x: np.ndarray) -> np.ndarray:
+        return self._apply(x)
+
+    def diagonal(self) -> np.ndarray:
+        """
+        :return: the diagonal of the matrix
+        """
+        return np.full(self.shape[0], -4, dtype=self.dtype) if not self.symmetric else -4 * self.weights
+
+    @property
+    def nnz(self) -> int:
+        """
+        :return: number of entries the assembled matrix would store
+        """
+        if len(self.variable_indices) == 0:
+            return 0
+        weighed = np.zeros(self.grid_dims, dtype=bool)
+        weighed.flat[self.variable_indices[1:]] = True
+        return len(self.variable_indices) + sum(int(np.count_nonzero(weighed.flat[self.variable_indices + offset]))
+                                                for offset in (-self.grid_dims[1], -1, 1, self.grid_dims[1]))
+
+    def right_hand_side(self, cb_mask: np.ndarray, color_labels: np.ndarray = None,
+                        n_colors: int = None) -> np.ndarray:
+        """
+        Computes the right hand side of the system with the same sums: each cb pixel adds minus its coefficient.
+        It's the same that build_equation_system_from_labels gives
+
+        :param cb_mask: boolean array with the image dimensions, True for border condition pixels
+        :param color_labels: optional int array with the image dimensions, with the color of each cb pixel and -1
+                             elsewhere, to split the right hand side in one column per color
+        :param n_colors: number of columns of the split right hand side. Defaults to the largest color label plus one
+        :return: array of shape (n_vars,), or (n_vars, n_colors) if color_labels is given
+        """
+        if color_labels is None:
+            cb_pixels = cb_mask[self.box]
+        else:
+            if n_colors is None:
+                n_colors = int(color_labels.max(initial=-1)) + 1
+            cb_pixels = color_labels[self.box][..., np.newaxis] == np.arange(n_colors)
+        grid = np.zeros(self.grid_dims + cb_pixels.shape[2:], dtype=self.dtype)
+        grid[1:-1, 1:-1] = cb_pixels
+        total = self._neighbor_sum(grid, self.variable_indices, self._reflected_neighbors(self.variable_indices))
+        return np.negative(total, out=total)
+
+    def ssor_preconditioner(self, omega: float = 1., sweeps: int = 1) -> scipy.sparse.linalg.LinearOperator:
+        """
+        Symmetric successive over-relaxation (SOR) sweeps of the symmetric form, in red-black order: the pixels of
+        each color of a checkerboard only depend on those of the other color, so each half sweep is a single array
+        update. Every sweep goes over the red pixels, then the black ones, and back, so the result is symmetric and
+        may be used as a conjugate gradient preconditioner.
+
+        :param omega: relaxation factor, between 0 and 2. 1 gives symmetric Gauss-Seidel sweeps
+        :param sweeps: number of symmetric sweeps, starting from zero
+        :return: operator applying the sweeps to a residual
+        """
+        if not self.symmetric:
+            raise ValueError("The SOR preconditioner needs the symmetric form of the system")
+        rows, cols = np.divmod(self.unknown_indices, self.grid_dims[1])
+        is_red = (rows + cols) % 2 == 0
+        del rows, cols
+        colors = [(np.flatnonzero(is_red), self.unknown_indices[is_red]),
+                  (np.flatnonzero(~is_red), self.unknown_indices[~is_red])]
+        colors = [(positions, indices, self._reflected_neighbors(indices)) for positions, indices in colors]
+        # with omega 1, a half sweep right after one of the same color changes nothing
+        half_sweeps = [0] + [1, 0] * sweeps if omega == 1 else [0, 1, 1, 0] * sweeps
+        # the diagonal of the symmetric form is 4 times the (negated) weights
+        inverse_diagonal = -1 / (4 * self.weights)
+        grid = np.zeros(self.grid_dims, dtype=self.dtype)
+
+        def apply(residual):
+            # Gauss-Seidel updates of the symmetric form: residual / diagonal + neighbor sum / 4
+            scaled_residual = np.ravel(residual) * inverse_diagonal
+            grid.flat[self.unknown_indices] = 0
+            for step, color in enumerate(half_sweeps):
+                positions, indices, reflected_neighbors = colors[color]
+                gauss_seidel = scaled_residual[positions]
+                if step > 0:
+                    gauss_seidel += self._neighbor_sum(grid, indices, reflected_neighbors) / 4
+                values = grid.flat[indices]
+                values += omega * (gauss_seidel - values)
+                grid.flat[indices] = values
+            return grid.flat[self.unknown_indices]
+
+        return scipy.sparse.linalg.LinearOperator(self.shape, matvec=apply, dtype=self.dtype)
+
+    def to_sparse(self):
+        """
+        :return: the assembled matrix (csc), @see build_equation_system_from_labels
+        """
+        if self.symmetric:
+            raise ValueError("Only the matrix of the original system is assembled")
+        return build_equation_system_from_labels(self.label_img, np.zeros(self.label_img.shape, dtype=bool),
+                                                 self.dtype)[0]
+
+
+def update_equation_system_from_labels(sparse_matrix, right_hand_side: np.ndarray, old_label_img: np.ndarray,
+                                       old_cb_mask: np.ndarray, label_img: np.ndarray, cb_mask: np.ndarray):
+    """
+    Rebuilds the system of build_equation_system_from_labels after some variables or cb pixels changed (like when
+    the radius or a few cb pixels change), reusing the rows of the previous system that did not change.
+    Only the rows of the variables next to a pixel that changed are computed again; the others are copied from the
+    previous system, with their columns renumbered. The result is the same as building the system again.
+
+    :param sparse_matrix: matrix of the previous system
+    :param right_hand_side: right hand side of the previous system
+    :param old_label_img: label image of the variables of the previous system
+    :param old_cb_mask: cb mask of the previous system, or its color labels if the right hand side has one column
+                        per color
+    :param label_img: label image of the new variables, @see imgIndices.pixel_label_image
+    :param cb_mask: new cb mask, or new color labels
+    :return: a tuple with the sparse matrix (csr) and the right hand side of the new system, and the number of rows
+             that were computed again
+    """
+    img_dims = label_img.shape
+    old_matrix = csr_matrix(sparse_matrix)
+    rows, cols = np.nonzero(label_img >= 0)
+    n_vars = len(rows)
+    old_vars = old_label_img[rows, cols]
+
+    # pixels whose kind (variable, cb or neither) changed. The variable numbered 0 weighs 0 on its contiguous
+    # variables (@see stencil_coefficients), so its pixel changes too if another variable takes that number
+    changed = ((old_label_img >= 0) != (label_img >= 0)) | (old_cb_mask != cb_mask)
+    color_labels = None
+    if cb_mask.dtype != bool:
+        color_labels = cb_mask
+        cb_mask = color_labels >= 0
+    for first_vars in (old_label_img, label_img):
+        first = np.flatnonzero(first_vars.ravel() == 0)
+        changed.flat[first] = True
+    # and every variable next to one of those pixels needs its row computed again
+    affected = changed.copy()
+    affected[1:] |= changed[:-1]
+    affected[:-1] |= changed[1:]
+    affected[:, 1:] |= changed[:, :-1]
+    affected[:, :-1] |= changed[:, 1:]
+    rebuilt = affected[rows, cols] | (old_vars < 0)
+    kept = ~rebuilt
+    rebuilt_vars = np.flatnonzero(rebuilt)
+    kept_vars = np.flatnonzero(kept)
+
+    _, _, neighbor_labels, coefs = stencil_coefficients(label_img, cb_mask, (rows[rebuilt], cols[rebuilt]))
+    row_cols, row_values, stored = _stencil_rows(neighbor_labels, coefs, rebuilt_vars, old_matrix.dtype)
+
+    # number in the new system of the variables of the old one that are kept
+    old_to_new = np.full(old_matrix.shape[0], -1, dtype=label_img.dtype)
+    old_to_new[old_vars[old_vars >= 0]] = np.flatnonzero(old_vars >= 0)
+    kept_old = old_vars[kept]
+    kept_lengths = np.diff(old_matrix.indptr)[kept_old]
+
+    lengths = np.empty(n_vars, dtype=label_img.dtype)
+    lengths[kept_vars] = kept_lengths
+    lengths[rebuilt_vars] = np.count_nonzero(stored, axis=1)
+    indptr = np.zeros(n_vars + 1, dtype=label_img.dtype)
+    np.cumsum(lengths, out=indptr[1:])
+    indices = np.empty(indptr[-1], dtype=label_img.dtype)
+    data = np.empty(indptr[-1], dtype=old_matrix.dtype)
+
+    # kept rows are copied entry by entry: position of each entry in the old and in the new arrays
+    entry_offsets = np.arange(kept_lengths.sum()) - np.repeat(np.cumsum(kept_lengths) - kept_lengths, kept_lengths)
+    old_entries = np.repeat(old_matrix.indptr[kept_old], kept_lengths) + entry_offsets
+    new_entries = np.repeat(indptr[kept_vars], kept_lengths) + entry_offsets
+    indices[new_entries] = old_to_new[old_matrix.indices[old_entries]]
+    data[new_entries] = old_matrix.data[old_entries]
+    # rebuilt rows keep the column order of their entries
+    new_entries = (indptr[rebuilt_vars][:, np.newaxis] + np.cumsum(stored, axis=1) - 1)[stored]
+    indices[new_entries] = row_cols[stored]
+    data[new_entries] = row_values[stored]
+    new_matrix = csr_matrix((data, indices, indptr), shape=(n_vars, n_vars))
+
+    new_rhs = np.empty((n_vars,) + right_hand_side.shape[1:], dtype=right_hand_side.dtype)
+    new_rhs[kept_vars] = right_hand_side[kept_old]
+    new_rhs[rebuilt_vars] = _stencil_right_hand_side(rows[rebuilt], cols[rebuilt], coefs, img_dims,
+                                                     right_hand_side.dtype, color_labels,
+                                                     right_hand_side.shape[1] if right_hand_side.ndim > 1 else None)
+    return new_matrix, new_rhs, len(rebuilt_vars)
+
+
+class FactorizedSystem:
+    """
+    Sparse LU factorization of the matrix of an equation system. The matrix is factorized only once, at
+    construction, and the factorization is then reused for every right hand side given to solve.
+    Time spent factorizing and solving is accumulated separately.
+    Single precision matrices are factorized in single precision, @see system_dtype.
+    """
+    def __init__(self, sparse_matrix):
+        """
+        Constructor. Factorizes the matrix
+
+        :param sparse_matrix: square sparse matrix of the system
+        """
+        start = time.perf_counter()
+        self.dtype = system_dtype(sparse_matrix)
+        self.lu = scipy.sparse.linalg.splu(csc_matrix(sparse_matrix, dtype=self.dtype))
+        self.factorization_time = time.perf_counter() - start
+        self.solve_time = 0.
+        self.shape = sparse_matrix.shape
+
+    def solve(self, right_hand_side: np.ndarray) -> np.ndarray:
+        """
+        Solves the system for a right hand side, which may have several columns (one system per column)
+
+        :param right_hand_side: array of shape (n_vars,) or (n_vars, k)
+        :return: solution with the same shape as right_hand_side
+        """
+        start = time.perf_counter()
+        solution = self.lu.solve(np.asarray(right_hand_side, dtype=self.dtype))
+        self.solve_time += time.perf_counter() - start
+        return solution
+
+    def timings(self) -> dict:
+        """
+        :return: dictionary with the factorization and (accumulated) solve times, in seconds
+        """
+        return {"factorization": self.factorization_time, "solve": self.solve_time}
+
+
+def solve_color_components(system, right_hand_side: np.ndarray, color: np.ndarray) -> np.ndarray:
+    """
+    Solves the system for every component of the color to bloom.
+    Since the right hand side of each component is the same vector multiplied by that component, the system is
+    solved only once and the solution is scaled by each component.
+    If right_hand_side has one column per bloomed color, color must have one row per column of right_hand_side, and
+    the solutions of every column are added up weighted by their colors.
+
+    :param system: the sparse matrix of the system, or an object solving it with a solve method like
+                   FactorizedSystem or the backends of imgSolverBackends
+    :param right_hand_side: array of shape (n_vars,), or (n_vars, k) for k colors
+    :param color: a color, or an array of shape (k, n_components) for k colors
+    :return: array of shape (n_vars, n_components) with the solution of each color component
+    """
+    if not hasattr(system, "solve"):
+        system = FactorizedSystem(system)
+    solution = system.solve(right_hand_side)
+    color = np.asarray(color, dtype=np.float64)
+    if solution.ndim == 1:
+        return np.outer(solution, color)
+    return solution @ color.reshape(solution.shape[1], -1)
+
@@ -0,0 +1,568 @@
+"""
+autor: Valentina Garrido
+
+Interchangeable backends to solve the Laplace equation system of the bloom effect.
+The direct backend factorizes the matrix with SuperLU, which is the fastest choice for small and medium systems
+but needs memory for the fill-in of the factors. The iterative backends only need a few vectors the size of the
+system, so they are the choice for millions of unknowns:
+
+* cg and minres: Krylov methods applied to the symmetric form of the system, with a jacobi or incomplete
+  cholesky (ichol) preconditioner
+* multigrid: cg preconditioned with a geometric multigrid V-cycle, which coarsens the unknowns using their
+  positions in the pixel grid
+* matrix-free: cg on the symmetric form of the system applied as a stencil, without assembling any matrix, with
+  a jacobi or red-black SOR preconditioner. It only needs a few arrays the size of the box around the bloomed pixels
+"""
+
+from imgLaplaceSolver import FactorizedSystem, StencilOperator, system_dtype
+from scipy.sparse import csr_matrix, diags, tril
+from collections import namedtuple
+import scipy.sparse.linalg
+import numpy as np
+import tracemalloc
+import warnings
+import time
+
+
+# pixel positions of the variables of a system: arrays with the row and column of each variable, and the image
+# dimensions. Backends accept it in place of a label image, which is handy for systems of a part of an image
+VariablePositions = namedtuple("VariablePositions", ["rows", "cols", "img_dims"])
+
+
+def variable_positions(label_img) -> VariablePositions:
+    """
+    :param label_img: int array with the image dimensions, with the number of each variable and -1 elsewhere, or
+                      the VariablePositions of the variables
+    :return: the VariablePositions of the variables
+    """
+    if isinstance(label_img, VariablePositions):
+        return label_img
+    rows, cols = np.nonzero(label_img >= 0)
+    return VariablePositions(rows, cols, label_img.shape)
+
+
+class SolveReport:
+    """
+    Simple object with the statistics of the solves done by a solver backend
+    """
+    def __init__(self, backend: str):
+        """
+        Constructor
+
+        :param backend: name of the backend
+        """
+        self.backend = backend
+        self.setup_time = 0.
+        self.solve_time = 0.
+        self.iterations = 0
+        self.residual = 0.
+        self.peak_memory = 0
+        # false once an iterative solve stops at its maximum number of iterations
+        self.converged = True
+
+    def as_dict(self) -> dict:
+        """
+        :return: the statistics in a dictionary
+        """
+        return {"backend": self.backend, "setup_time": self.setup_time, "solve_time": self.solve_time,
+                "iterations": self.iterations, "residual": self.residual, "peak_memory": self.peak_memory,
+                "converged": self.converged}
+
+    def __str__(self):
+        return ("{backend}: setup {setup_time:.4f} s, solve {solve_time:.4f} s, {iterations} iterations, "
+                "relative residual {residual:.2e}, peak memory {mib:.1f} MiB{warning}").format(
+            mib=self.peak_memory / 2**20, warning="" if self.converged else ", not converged", **self.as_dict())
+
+
+class _MemoryTracker:
+    """
+    Context manager measuring the peak of memory allocated by Python objects, including numpy arrays, while it is
+    active. Memory allocated directly by C libraries (like the factors of SuperLU) is not seen by it.
+    Does nothing if track is False, as tracing allocations slows the program down.
+    """
+    def __init__(self, track: bool):
+        self.track = track
+        self.peak = 0
+
+    def __enter__(self):
+        if self.track:
+            self.started = not tracemalloc.is_tracing()
+            if self.started:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            self.initial = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.track:
+            self.peak = tracemalloc.get_traced_memory()[1] - self.initial
+            if self.started:
+                tracemalloc.stop()
+        return False
+
+
+def relative_residual(sparse_matrix, solution: np.ndarray, right_hand_side: np.ndarray) -> float:
+    """
+    Returns ||b - A x|| / ||b||, the largest among the columns if there are several right hand sides
+
+    :param sparse_matrix: matrix of the system (A)
+    :param solution: solution found (x)
+    :param right_hand_side: right hand side of the system (b)
+    :return: the relative residual
+    """
+    residual = np.linalg.norm(right_hand_side - sparse_matrix @ solution, axis=0)
+    rhs_norm = np.linalg.norm(right_hand_side, axis=0)
+    return float(np.max(residual / np.where(rhs_norm > 0, rhs_norm, 1.)))
+
+
+def border_weights(rows: np.ndarray, cols: np.ndarray, img_dims: tuple) -> np.ndarray:
+    """
+    Returns the scale of each row of the matrix that makes the system symmetric.
+    The stencil of a variable on the image border doubles the coefficient of the variable opposite to the border,
+    so the rows of those variables are halved once per border they touch.
+
+    :param rows: row of the pixel of each variable
+    :param cols: column of the pixel of each variable
+    :param img_dims: a tuple representing the number of rows and number of columns of an image
+    :return: array with the weight of each variable
+    """
+    weights = np.ones(len(rows))
+    if img_dims[0] > 1:
+        weights[(rows == 0) | (rows == img_dims[0] - 1)] *= 0.5
+    if img_dims[1] > 1:
+        weights[(cols == 0) | (cols == img_dims[1] - 1)] *= 0.5
+    return weights
+
+
+class SymmetricForm:
+    """
+    Symmetric positive definite system equivalent to the one given by imgLaplaceSolver.build_equation_system.
+
+    The column of the variable numbered 0 only holds its diagonal (its contiguous variables weigh it 0, see
+    imgLaplaceSolver.stencil_coefficients), so the other variables do not depend on it: they are solved first
+    and variable 0 is then obtained from its own equation. The remaining rows are scaled with border_weights and
+    negated, which gives a symmetric matrix with positive diagonal.
+    Systems of a part of the image (@see imgComponents) may not have such a first variable, in which case all the
+    variables are kept.
+    """
+    def __init__(self, sparse_matrix, label_img):
+        """
+        Constructor
+
+        :param sparse_matrix: matrix of the system
+        :param label_img: int array with the image dimensions, with the number of each variable and -1 elsewhere,
+                          or the VariablePositions of the variables
+        """
+        positions = variable_positions(label_img)
+        self.original = csr_matrix(sparse_matrix, dtype=system_dtype(sparse_matrix))
+        n_vars = self.original.shape[0]
+        self.first = 1 if n_vars > 1 and self.original[:, 0].nnz == 1 else 0
+        self.weights = -border_weights(positions.rows, positions.cols, positions.img_dims)[self.first:].astype(
+            self.original.dtype)
+        self.matrix = (diags(self.weights) @ self.original[self.first:, self.first:]).tocsr()
+        self.rows = positions.rows[self.first:]
+        self.cols = positions.cols[self.first:]
+        self.img_dims = positions.img_dims
+        self.dtype = self.original.dtype
+
+    def reduce_rhs(self, right_hand_side: np.ndarray) -> np.ndarray:
+        """
+        :param right_hand_side: right hand side of the original system
+        :return: right hand side of the symmetric system
+        """
+        return self.weights * right_hand_side[self.first:]
+
+    def expand_solution(self, reduced_solution: np.ndarray, right_hand_side: np.ndarray) -> np.ndarray:
+        """
+        :param reduced_solution: solution of the symmetric system
+        :param right_hand_side: right hand side of the original system
+        :return: solution of the original system
+        """
+        if self.first == 0:
+            return reduced_solution
+        first_row = self.original.getrow(0)
+        first_value = (right_hand_side[0] - first_row[:, 1:] @ reduced_solution) / first_row[0, 0]
+        return np.concatenate(([first_value.item()], reduced_solution))
+
+
+class StencilSymmetricForm(SymmetricForm):
+    """
+    Matrix-free version of SymmetricForm, whose matrices are imgLaplaceSolver.StencilOperator. Only full label
+    images are supported, where the variable numbered 0 is always weighed 0 by its contiguous variables
+    """
+    def __init__(self, label_img: np.ndarray, dtype=np.float64):
+        """
+        Constructor
+
+        :param label_img: int array with the image dimensions, with the number of each variable and -1 elsewhere
+        :param dtype: float type of the system
+        """
+        self.original = StencilOperator(label_img, dtype)
+        self.matrix = StencilOperator(label_img, dtype, symmetric=True)
+        self.first = self.matrix.first
+        self.weights = self.matrix.weights
+        self.dtype = self.original.dtype
+
+    def expand_solution(self, reduced_solution: np.ndarray, right_hand_side: np.ndarray) -> np.ndarray:
+        if self.first == 0:
+            return reduced_solution
+        # the row of the variable numbered 0, applied to the others: its diagonal is -4
+        solution = np.concatenate(([0], reduced_solution)).astype(self.dtype)
+        solution[0] = (right_hand_side[0] - (self.original @ solution)[0]) / -4
+        return solution
+
+
+def jacobi_preconditioner(sparse_matrix) -> scipy.sparse.linalg.LinearOperator:
+    """
+    :param sparse_matrix: matrix of the system
+    :return: operator applying the inverse of the diagonal of the matrix
+    """
+    inverse_diagonal = 1 / sparse_matrix.diagonal()
+    return scipy.sparse.linalg.LinearOperator(sparse_matrix.shape, matvec=lambda x: inverse_diagonal * x.ravel(),
+                                              dtype=inverse_diagonal.dtype)
+
+
+def incomplete_cholesky_preconditioner(sparse_matrix, rows: np.ndarray, cols: np.ndarray):
+    """
+    Zero fill-in incomplete Cholesky factorization of a symmetric 5-point stencil matrix, in the form
+    (D + L) D^-1 (D + L^T), with L the strictly lower part of the matrix.
+    The diagonal D needs the values of the up and left pixels, so it is computed one anti-diagonal of the image
+    at a time, each of them with array operations.
+
+    :param sparse_matrix: symmetric positive definite matrix of the system, variables numbered in row order
+    :param rows: row of the pixel of each variable
+    :param cols: column of the pixel of each variable
+    :return: operator applying the inverse of the incomplete factorization
+    """
+    n_vars = sparse_matrix.shape[0]
+    lower = tril(sparse_matrix, k=-1, format="csr")
+    lower.sort_indices()
+    counts = np.diff(lower.indptr)
+
+    # at most two lower neighbors per variable (up and left), stored in padded arrays
+    lower_cols = np.zeros((n_vars, 2), dtype=np.intp)
+    lower_values = np.zeros((n_vars, 2))
+    for k in range(2):
+        has_k = counts > k
+        lower_cols[has_k, k] = lower.indices[lower.indptr[:-1][has_k] + k]
+        lower_values[has_k, k] = lower.data[lower.indptr[:-1][has_k] + k]
+
+    diagonal = sparse_matrix.diagonal().copy()
+    wavefront = rows + cols
+    order = np.argsort(wavefront, kind="stable")
+    bounds = np.searchsorted(wavefront[order], np.arange(wavefront.max(initial=0) + 2))
+    for front in range(len(bounds) - 1):
+        current = order[bounds[front]:bounds[front + 1]]
+        diagonal[current] -= np.sum(lower_values[current] ** 2 / diagonal[lower_cols[current]], axis=1)
+
+    factor_lower = (lower + diags(diagonal)).tocsr()
+    factor_upper = factor_lower.T.tocsr()
+
+    def apply(x):
+        y = scipy.sparse.linalg.spsolve_triangular(factor_lower, x.ravel(), lower=True)
+        return scipy.sparse.linalg.spsolve_triangular(factor_upper, diagonal * y, lower=False)
+
+    return scipy.sparse.linalg.LinearOperator(sparse_matrix.shape, matvec=apply, dtype=np.float64)
+
+
+class GridMultigrid:
+    """
+    Geometric multigrid hierarchy for a 5-point stencil system whose variables live on a pixel grid.
+    Each coarser level groups the variables by blocks of 2x2 pixels, with the Galerkin coarse matrix P^T A P for the
+    piecewise constant prolongation P. The smoother is weighted jacobi and the coarsest level is solved directly.
+    """
+    def __init__(self, sparse_matrix, rows: np.ndarray, cols: np.ndarray, smoothing_steps: int = 2,
+                 omega: float = 2 / 3, coarsest_size: int = 1000):
+        """
+        Constructor. Builds the hierarchy
+
+        :param sparse_matrix: symmetric positive definite matrix of the system
+        :param rows: row of the pixel of each variable
+        :param cols: column of the pixel of each variable
+        :param smoothing_steps: jacobi sweeps before and after each coarse correction
+        :param omega: jacobi weight
+        :param coarsest_size: number of variables under which a level is solved directly
+        """
+        self.smoothing_steps = smoothing_steps
+        self.omega = omega
+        self.levels = []
+        level_matrix = csr_matrix(sparse_matrix)
+        while level_matrix.shape[0] > coarsest_size:
+            rows, cols = rows // 2, cols // 2
+            width = cols.max(initial=0) + 1
+            blocks, aggregates = np.unique(rows * width + cols, return_inverse=True)
+            if len(blocks) == level_matrix.shape[0]:
+                break
+            n_vars = level_matrix.shape[0]
+            prolongation = csr_matrix((np.ones(n_vars), (np.arange(n_vars), aggregates)), shape=(n_vars, len(blocks)))
+            self.levels.append((level_matrix, prolongation, self.omega / level_matrix.diagonal()))
+            level_matrix = (prolongation.T @ level_matrix @ prolongation).tocsr()
+            rows, cols = np.divmod(blocks, width)
+        self.coarsest = FactorizedSystem(level_matrix)
+
+    def v_cycle(self, right_hand_side: np.ndarray, level: int = 0) -> np.ndarray:
+        """
+        Applies one V-cycle starting from a zero guess. Pre and post smoothing are the same, so the cycle is a
+        symmetric operator and may be used as a conjugate gradient preconditioner.
+
+        :param right_hand_side: right hand side at the given level
+        :param level: level of the hierarchy
+        :return: approximate solution at the given level
+        """
+        if level == len(self.levels):
+            return self.coarsest.solve(right_hand_side)
+        level_matrix, prolongation, scaled_inverse_diagonal = self.levels[level]
+        solution = scaled_inverse_diagonal * right_hand_side
+        for _ in range(self.smoothing_steps - 1):
+            solution += scaled_inverse_diagonal * (right_hand_side - level_matrix @ solution)
+        coarse_rhs = prolongation.T @ (right_hand_side - level_matrix @ solution)
+        solution += prolongation @ self.v_cycle(coarse_rhs, level + 1)
+        for _ in range(self.smoothing_steps):
+            solution += scaled_inverse_diagonal * (right_hand_side - level_matrix @ solution)
+        return solution
+
+    def as_preconditioner(self) -> scipy.sparse.linalg.LinearOperator:
+        """
+        :return: operator applying one V-cycle
+        """
+        shape = self.levels[0][0].shape if self.levels else self.coarsest.shape
+        return scipy.sparse.linalg.LinearOperator(shape, matvec=lambda x: self.v_cycle(x.ravel()), dtype=np.float64)
+
+
+class DirectSolver:
+    """
+    Backend that factorizes the system with SuperLU. @see imgLaplaceSolver.FactorizedSystem
+    """
+    name = "direct"
+
+    def __init__(self, sparse_matrix, label_img=None, track_memory: bool = False, **unused_options):
+        """
+        Constructor. Factorizes the matrix
+
+        :param sparse_matrix: matrix of the system
+        :param label_img: not needed by this backend
+        :param track_memory: whether to measure the peak memory
+        """
+        self.report = SolveReport(self.name)
+        self.sparse_matrix = sparse_matrix
+        self.track_memory = track_memory
+        with _MemoryTracker(track_memory) as memory:
+            self.factorized = FactorizedSystem(sparse_matrix)
+        # the factors live in memory allocated by SuperLU: 8 (or 4, in single precision) bytes per value and 4 per
+        # index
+        self.factor_memory = (np.dtype(self.factorized.dtype).itemsize + 4) * self.factorized.lu.nnz
+        self.report.peak_memory = memory.peak + self.factor_memory if track_memory else 0
+        self.report.setup_time = self.factorized.factorization_time
+
+    def solve(self, right_hand_side: np.ndarray) -> np.ndarray:
+        """
+        :param right_hand_side: array of shape (n_vars,) or (n_vars, k)
+        :return: solution with the same shape as right_hand_side
+        """
+        with _MemoryTracker(self.track_memory) as memory:
+            solution = self.factorized.solve(right_hand_side)
+        self.report.solve_time = self.factorized.solve_time
+        self.report.residual = max(self.report.residual, relative_residual(self.sparse_matrix, solution,
+                                                                           right_hand_side))
+        if self.track_memory:
+            self.report.peak_memory = max(self.report.peak_memory, memory.peak + self.factor_memory)
+        return solution
+
+    def timings(self) -> dict:
+        return {"factorization": self.report.setup_time, "solve": self.report.solve_time}
+
+
+class KrylovSolver:
+    """
+    Backend that solves the symmetric form of the system with a preconditioned Krylov method
+    """
+    name = "cg"
+    methods = {"cg": scipy.sparse.linalg.cg, "minres": scipy.sparse.linalg.minres}
+
+    def __init__(self, sparse_matrix, label_img, method: str = None, preconditioner: str = "jacobi",
+                 tol: float = 1e-8, max_iter: int = None, track_memory: bool = False, **unused_options):
+        """
+        Constructor. Builds the symmetric form of the system and the preconditioner
+
+        :param sparse_matrix: matrix of the system
+        :param label_img: int array with the image dimensions, with the number of each variable and -1 elsewhere,
+                          or the VariablePositions of the variables
+        :param method: either cg or minres
+        :param preconditioner: jacobi, ichol or none
+        :param tol: relative tolerance of the residual
+        :param max_iter: maximum number of iterations for each right hand side
+        :param track_memory: whether to measure the peak memory
+        """
+        self.method = method if method is not None else self.name
+        self.report = SolveReport(self.method)
+        self.sparse_matrix = sparse_matrix
+        self.tol = tol
+        self.max_iter = max_iter
+        self.track_memory = track_memory
+        start = time.perf_counter()
+        with _MemoryTracker(track_memory) as memory:
+            self.symmetric = self.build_symmetric_form(sparse_matrix, label_img)
+            self.preconditioner = self.build_preconditioner(preconditioner)
+        self.report.setup_time = time.perf_counter() - start
+        self.report.peak_memory = memory.peak
+
+    def build_symmetric_form(self, sparse_matrix, label_img):
+        return SymmetricForm(sparse_matrix, label_img)
+
+    def build_preconditioner(self, preconditioner: str):
+        matrix = self.symmetric.matrix
+        if preconditioner == "jacobi":
+            return jacobi_preconditioner(matrix)
+        elif preconditioner == "ichol":
+            return incomplete_cholesky_preconditioner(matrix, self.symmetric.rows, self.symmetric.cols)
+        elif preconditioner == "sor":
+            raise ValueError("The sor preconditioner is only available with the matrix-free solver")
+        elif preconditioner in (None, "none"):
+            return None
+        raise ValueError("Unknown preconditioner: {}".format(preconditioner))
+
+    def solve(self, right_hand_side: np.ndarray, initial_guess: np.ndarray = None) -> np.ndarray:
+        """
+        Solves the system, one column of right_hand_side at a time
+
+        :param right_hand_side: array of shape (n_vars,) or (n_vars, k)
+        :param initial_guess: optional starting point of the iterations, with the same shape as right_hand_side
+        :return: solution with the same shape as right_hand_side
+        """
+        start = time.perf_counter()
+        columns = right_hand_side.reshape(len(right_hand_side), -1)
+        guesses = None if initial_guess is None else initial_guess.reshape(columns.shape)
+        solution = np.empty(columns.shape, dtype=self.symmetric.dtype)
+        with _MemoryTracker(self.track_memory) as memory:
+            for k in range(columns.shape[1]):
+                solution[:, k] = self._solve_column(columns[:, k], None if guesses is None else guesses[:, k])
+        solution = solution.reshape(right_hand_side.shape)
+        self.report.solve_time += time.perf_counter() - start
+        self.report.peak_memory = max(self.report.peak_memory, memory.peak)
+        self.report.residual = max(self.report.residual, relative_residual(self.sparse_matrix, solution,
+                                                                           right_hand_side))
+        return solution
+
+    def _solve_column(self, right_hand_side: np.ndarray, initial_guess: np.ndarray) -> np.ndarray:
+        if len(right_hand_side) < 2:
+            return right_hand_side / self.sparse_matrix.diagonal()
+        reduced_rhs = self.symmetric.reduce_rhs(right_hand_side)
+        x0 = None if initial_guess is None else initial_guess[self.symmetric.first:]
+
+        def count_iteration(xk):
+            self.report.iterations += 1
+
+        # tolerances below the precision of the system (float32 ones) can't be reached
+        rtol = max(self.tol, 10 * np.finfo(self.symmetric.dtype).eps)
+        reduced_solution, info = self.methods[self.method](self.symmetric.matrix, reduced_rhs, x0=x0, rtol=rtol,
+                                                           maxiter=self.max_iter, M=self.preconditioner,
+                                                           callback=count_iteration)
+        if info != 0:
+            # the iterations stopped before reaching the tolerance, the solution is only an approximation
+            self.report.converged = False
+            warnings.warn("{} stopped before reaching a relative residual of {:.1e}, the solution is not "
+                          "converged".format(self.report.backend, rtol), RuntimeWarning, stacklevel=3)
+        return self.symmetric.expand_solution(reduced_solution, right_hand_side)
+
+    def timings(self) -> dict:
+        return {"factorization": self.report.setup_time, "solve": self.report.solve_time}
+
+
+class MinresSolver(KrylovSolver):
+    """
+    Krylov backend using minres
+    """
+    name = "minres"
+
+
+class MultigridSolver(KrylovSolver):
+    """
+    Krylov backend using cg preconditioned with a geometric multigrid V-cycle. @see GridMultigrid
+    """
+    name = "multigrid"
+
+    def __init__(self, sparse_matrix, label_img, preconditioner: str = "multigrid", **options):
+        """
+        Constructor. Builds the symmetric form of the system and the multigrid hierarchy
+
+        :param sparse_matrix: matrix of the system
+        :param label_img: int array with the image dimensions, with the number of each variable and -1 elsewhere,
+                          or the VariablePositions of the variables
+        :param preconditioner: only multigrid, the V-cycle is the preconditioner of this backend
+        :param options: the other options of KrylovSolver
+        """
+        if preconditioner != "multigrid":
+            raise ValueError("The multigrid solver is always preconditioned with its V-cycle, not {}".format(
+                preconditioner))
+        super().__init__(sparse_matrix, label_img, method="cg", preconditioner="multigrid", **options)
+        self.report.backend = self.name
+
+    def build_preconditioner(self, preconditioner: str):
+        return GridMultigrid(self.symmetric.matrix, self.symmetric.rows, self.symmetric.cols).as_preconditioner()
+
+
+class MatrixFreeSolver(KrylovSolver):
+    """
+    Krylov backend using cg on the symmetric form of the system applied as a stencil, without any assembled matrix.
+    @see imgLaplaceSolver.StencilOperator. Along with jacobi, it may be preconditioned with red-black symmetric SOR
+    sweeps, which need no matrix either
+    """
+    name = "matrix-free"
+
+    def __init__(self, sparse_matrix, label_img, preconditioner: str = "jacobi", omega: float = 1.,
+                 sor_sweeps: int = 1, **options):
+        """
+        Constructor. Builds the stencil operators and the preconditioner
+
+        :param sparse_matrix: matrix of the system, or the imgLaplaceSolver.StencilOperator of it. Only its type is
+                              used, the stencil is applied from label_img
+        :param label_img: int array with the image dimensions, with the number of each variable and -1 elsewhere
+        :param preconditioner: jacobi, sor or none
+        :param omega: relaxation factor of the sor preconditioner
+        :param sor_sweeps: number of symmetric sweeps of the sor preconditioner
+        :param options: tol, max_iter and track_memory, @see KrylovSolver
+        """
+        self.omega = omega
+        self.sor_sweeps = sor_sweeps
+        super().__init__(sparse_matrix, label_img, method="cg", preconditioner=preconditioner, **options)
+        self.report.backend = self.name
+
+    def build_symmetric_form(self, sparse_matrix, label_img):
+        if isinstance(label_img, VariablePositions):
+            raise ValueError("The matrix-free solver needs the label image of the whole system")
+        return StencilSymmetricForm(label_img, system_dtype(sparse_matrix))
+
+    def build_preconditioner(self, preconditioner: str):
+        if preconditioner == "sor":
+            return self.symmetric.matrix.ssor_preconditioner(self.omega, self.sor_sweeps)
+        elif preconditioner == "ichol":
+            raise ValueError("The ichol preconditioner needs the assembled matrix")
+        return super().build_preconditioner(preconditioner)
+
+
+SOLVER_BACKENDS = {
+    "direct": DirectSolver,
+    "cg": KrylovSolver,
+    "minres": MinresSolver,
+    "multigrid": MultigridSolver,
+    "matrix-free": MatrixFreeSolver,
+}
+
+PRECONDITIONERS = ("jacobi", "ichol", "sor", "none")
+
+
+def make_solver(sparse_matrix, label_img, backend: str = "direct", **options):
+    """
+    Prepares a solver backend for the system. The returned object solves right hand sides with its solve method,
+    so it may be given to imgLaplaceSolver.solve_color_components, and keeps its statistics in its report.
+
+    :param sparse_matrix: matrix of the system
+    :param label_img: int array with the image dimensions, with the number of each variable and -1 elsewhere,
+                      or the VariablePositions of the variables
+    :param backend: one of the keys of SOLVER_BACKENDS
+    :param options: preconditioner, tol, max_iter and track_memory, @see KrylovSolver
+    :return: the solver backend
+    """
+    if backend not in SOLVER_BACKENDS:
+        raise ValueError("Unknown solver backend: {}".format(backend))
+    return SOLVER_BACKENDS[backend](sparse_matrix, label_img, **options)
@@ -0,0 +1,176 @@
+"""
+autor: Valentina Garrido
+
+Persistent cache of bloom equation systems. The system only depends on the border condition pixels, the radius and
+the norm of the bloom, and its solution on the solver and its tolerances, so images sharing them (the same asset
+bloomed with other colors or tone mappings) may skip the assembly and the solve. Entries are kept in a directory,
+one subdirectory per system named after the hash of its mask, with each array in an .npy file that is memory mapped
+when loaded.
+"""
+
+from scipy.sparse import csc_matrix
+import numpy as np
+import hashlib
+import shutil
+import uuid
+import os
+
+
+# bumped whenever the layout of the entries or the assembly of the system changes
+CACHE_FORMAT_VERSION = 2
+
+CACHE_ARRAYS = ("data", "indices", "indptr", "right_hand_side", "var_pixel_indices", "unit_solution")
+
+# options of the iterative solvers that change the solution they give, @see imgSolverBackends
+SOLUTION_OPTIONS = ("preconditioner", "tol", "max_iter", "omega", "sor_sweeps", "split_components")
+
+
+def mask_key(cb_mask: np.ndarray, radius, norm: str = "1", dtype=np.float64, solver: str = "direct",
+             solver_options: dict = None) -> str:
+    """
+    Returns a hash identifying the equation system of a cb mask, and the solution stored along with it
+
+    :param cb_mask: boolean array with the image dimensions, True for border condition pixels, or int array with the
+                    color of each cb pixel and -1 elsewhere, for systems of several colors
+    :param radius: controls how far the bloom is spread (in pixels), or a sequence with the radius of each color
+    :param norm: norm of the distance within which pixels are bloomed
+    :param dtype: float type of the system
+    :param solver: backend solving the system, @see imgSolverBackends.make_solver
+    :param solver_options: options of the solver. Those in SOLUTION_OPTIONS are part of the key for the iterative
+                           solvers, while the direct one solves the system exactly whatever they are
+    :return: hexadecimal digest of the mask, its dimensions, the radius, the norm, the float type and the solver
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.array(cb_mask.shape + tuple(np.atleast_1d(radius)), dtype=np.int64).tobytes())
+    digest.update(str(norm).encode())
+    digest.update(np.dtype(dtype).str.encode())
+    digest.update(str(solver).encode())
+    if solver != "direct":
+        options = solver_options or {}
+        digest.update(repr([(name, options.get(name)) for name in SOLUTION_OPTIONS]).encode())
+    if cb_mask.dtype == bool:
+        digest.update(np.packbits(cb_mask).tobytes())
+    else:
+        digest.update(b"labels")
+        digest.update(cb_mask.astype(np.int32).tobytes())
+    return digest.hexdigest()
+
+
+def _directory_size(path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+class CachedSystem:
+    """
+    Simple object holding the arrays of a cached system. They are read only memory maps
+    """
+    def __init__(self, sparse_matrix, right_hand_side: np.ndarray, var_pixel_indices: np.ndarray,
+                 unit_solution: np.ndarray):
+        self.sparse_matrix = sparse_matrix
+        self.right_hand_side = right_hand_side
+        self.var_pixel_indices = var_pixel_indices
+        self.unit_solution = unit_solution
+
+
+class SystemCache:
+    """
+    Content addressed cache of equation systems, stored in a directory.
+    Its size is capped: when it grows over max_bytes, the least recently used entries are removed (the modification
+    time of each entry is updated when it is read). Entries are written to a temporary directory and renamed, so
+    several processes may share the cache.
+    """
+    def __init__(self, directory: str, max_bytes: int = 1 << 30):
+        """
+        Constructor
+
+        :param directory: directory holding the cache. It is created if it does not exist
+        :param max_bytes: maximum size of the cache in bytes
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def counts(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "stores": self.stores, "evictions": self.evictions}
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, "v{}-{}".format(CACHE_FORMAT_VERSION, key))
+
+    def load(self, key: str):
+        """
+        Looks for a system in the cache
+
+        :param key: hash of the system, @see mask_key
+        :return: the CachedSystem, or None if it is not in the cache
+        """
+        path = self._entry_path(key)
+        try:
+            arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in CACHE_ARRAYS}
+            os.utime(path)
+        except (OSError, ValueError):
+            # missing, evicted meanwhile or partially removed entry
+            self.misses += 1
+            return None
+        self.hits += 1
+        n_vars = len(arrays["var_pixel_indices"])
+        sparse_matrix = csc_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=(n_vars, n_vars))
+        return CachedSystem(sparse_matrix, arrays["right_hand_side"], arrays["var_pixel_indices"],
+                            arrays["unit_solution"])
+
+    def store(self, key: str, sparse_matrix, right_hand_side: np.ndarray, var_pixel_indices: np.ndarray,
+              unit_solution: np.ndarray):
+        """
+        Adds a system and its solution to the cache, then evicts old entries if the cache is too big
+
+        :param key: hash of the system, @see mask_key
+        :param sparse_matrix: matrix of the system
+        :param right_hand_side: right hand side of the system
+        :param var_pixel_indices: flat index of the pixel of each variable
+        :param unit_solution: solution of the system
+        """
+        path = self._entry_path(key)
+        if os.path.isdir(path):
+            return
+        sparse_matrix = csc_matrix(sparse_matrix)
+        arrays = {"data": sparse_matrix.data, "indices": sparse_matrix.indices, "indptr": sparse_matrix.indptr,
+                  "right_hand_side": right_hand_side, "var_pixel_indices": var_pixel_indices,
+                  "unit_solution": unit_solution}
+        temp_path = os.path.join(self.directory, ".tmp-{}".format(uuid.uuid4().hex))
+        os.makedirs(temp_path)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(temp_path, name + ".npy"), np.ascontiguousarray(array))
+            os.replace(temp_path, path)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(temp_path, ignore_errors=True)
+            return
+        self.stores += 1
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_dir() and not entry.name.startswith("."):
+                try:
+                    entries.append((entry.stat().st_mtime, _directory_size(entry.path), entry.path))
+                except OSError:
+                    continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            self.evictions += 1
+
+    def __str__(self):
+        return "system cache {}: {} hits, {} misses, {} stored, {} evicted".format(
+            self.directory, self.hits, self.misses, self.stores, self.evictions)
@@ -0,0 +1,25 @@
+"""
+autor: Valentina Garrido
+
+Tests of the quality of the preview of bloomPreview: on the images in examples/, the mean deviation from the full
+solve over the bloomed pixels must stay under the bound documented for each factor.
+"""
+
+import os
+
+import matplotlib.image as mpimg
+import pytest
+
+from bloomPreview import BOUND_MIN_RADIUS, MEAN_DEVIATION_BOUNDS, preview_deviation
+from test_imgLaplaceSolver import EXAMPLE_CASES, EXAMPLES_DIR
+
+
+@pytest.mark.parametrize("radius", [None, 10, 40])
+@pytest.mark.parametrize("factor", sorted(MEAN_DEVIATION_BOUNDS))
+@pytest.mark.parametrize("filename,case_radius,color", EXAMPLE_CASES)
+def test_mean_deviation_within_bound(filename, case_radius, color, factor, radius):
+    image = mpimg.imread(os.path.join(EXAMPLES_DIR, filename))
+    # the bounds only hold from a minimum radius
+    radius = max(radius or case_radius, BOUND_MIN_RADIUS * factor)
+    _, mean_deviation = preview_deviation(image, radius, color, factor)
+    assert mean_deviation.max() <= MEAN_DEVIATION_BOUNDS[factor]
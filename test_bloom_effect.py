@@ -0,0 +1,68 @@
+"""
+autor: Valentina Garrido
+
+Tests of bloom_effect: the time it takes to import, and bloom blooming several colors in a single pass.
+"""
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from bloom_effect import bloom, IMPORT_TIME_BUDGET
+from bloomSession import BloomSession
+
+
+RED, WHITE = (255, 0, 0), (255, 255, 255)
+
+
+def test_import_stays_under_budget():
+    # each import runs on a new interpreter, the fastest of a few is kept to leave out the noise of the machine
+    code = ("import time, sys; start = time.perf_counter(); import bloom_effect; "
+            "print(time.perf_counter() - start, 'matplotlib' in sys.modules, 'PIL' in sys.modules)")
+    best = float("inf")
+    for _ in range(3):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+        best = min(best, float(output[0]))
+        assert output[1:] == ["False", "False"], "importing bloom_effect loads matplotlib or Pillow"
+    assert best < IMPORT_TIME_BUDGET
+
+
+def two_color_image() -> np.ndarray:
+    """
+    :return: black float RGB image with a red and a white square, whose radii below make their neighbors overlap
+             (but not reach the pixels of the other color)
+    """
+    image = np.zeros((64, 80, 3))
+    image[30:33, 10:13] = (1, 0, 0)
+    image[30:33, 40:43] = 1
+    return image
+
+
+def separate_blooms(image: np.ndarray, radii: tuple) -> np.ndarray:
+    """
+    :return: the image with the bloom of each color, solved on its own, added up
+    """
+    out = image.copy()
+    for color, radius in zip((RED, WHITE), radii):
+        out += bloom(image, radius, color, tone_map="none") - image
+    return out
+
+
+@pytest.mark.parametrize("solver", ["direct", "cg", "matrix-free"])
+def test_single_pass_matches_separate_blooms(solver):
+    image = two_color_image()
+    radii = (22, 8)
+    expected = separate_blooms(image, radii)
+    out = bloom(image, list(radii), [RED, WHITE], tone_map="none", single_pass=True, solver=solver)
+    assert np.allclose(out, expected, atol=1e-6)
+
+
+def test_session_matches_separate_blooms():
+    image = two_color_image()
+    session = BloomSession(image, (22, 4), [RED, WHITE], tone_map="none", solver="cg")
+    session.set_radius((22, 8))
+    assert np.allclose(session.render(), separate_blooms(image, (22, 8)), atol=1e-6)
@@ -0,0 +1,66 @@
+"""
+autor: Valentina Garrido
+
+Regression test of the array assembly of the Laplace system: on the images in examples/, the matrix and the right
+hand side given by build_equation_system_from_labels must be bit-for-bit identical to the ones of
+build_equation_system, which works on dictionaries and sets of pixel tuples.
+"""
+
+import os
+
+import matplotlib.image as mpimg
+import numpy as np
+import pytest
+
+from colors import color_int_to_float
+from images import convert_to_float_img
+from imgIndices import get_matching_pixel_indices, get_matching_pixel_mask, get_neighbor_pixel_indices_norm_1, \
+    get_neighbor_pixel_mask, pixel_label_image, simple_pixel_mapping
+from imgLaplaceSolver import build_equation_system, build_equation_system_from_labels
+
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+
+# image of examples/, radius and a color of it to bloom
+EXAMPLE_CASES = [
+    ("no_bloom_01.png", 6, (255, 255, 255)),
+    ("no_bloom_02.png", 3, (0, 0, 0)),
+    ("no_bloom_03.png", 4, (255, 255, 255)),
+    ("no_bloom_04.png", 5, (128, 128, 255)),
+    ("no_bloom_05.png", 3, (255, 255, 255)),
+    ("no_bloom_bmp.bmp", 4, (137, 195, 245)),
+    ("no_bloom_gif.gif", 2, (255, 255, 255)),
+    ("no_bloom_jpeg.jpeg", 3, (12, 6, 6)),
+]
+
+
+def test_every_example_is_covered():
+    example_inputs = {name for name in os.listdir(EXAMPLES_DIR) if not os.path.splitext(name)[0].endswith("_out")}
+    assert example_inputs == {name for name, _, _ in EXAMPLE_CASES}
+
+
+@pytest.mark.parametrize("filename,radius,color", EXAMPLE_CASES)
+def test_label_assembly_matches_dictionary_assembly(filename, radius, color):
+    np_img = convert_to_float_img(mpimg.imread(os.path.join(EXAMPLES_DIR, filename)))
+    img_dims = np_img.shape[0:2]
+    cb_color = color_int_to_float(color)
+
+    # the system as the original program assembled it
+    cb_indices = get_matching_pixel_indices(np_img, cb_color, img_dims)
+    variable_indices = list(get_neighbor_pixel_indices_norm_1(cb_indices, img_dims, radius))
+    n_vars = len(variable_indices)
+    var_dict = simple_pixel_mapping(variable_indices, n_vars, sort=True)
+    expected_matrix, expected_rhs = build_equation_system(var_dict, n_vars, cb_indices, img_dims)
+
+    cb_mask = get_matching_pixel_mask(np_img, cb_color)
+    label_img = pixel_label_image(get_neighbor_pixel_mask(cb_mask, radius))
+    sparse_matrix, right_hand_side = build_equation_system_from_labels(label_img, cb_mask)
+
+    assert n_vars > 0
+    assert sparse_matrix.format == expected_matrix.format
+    assert sparse_matrix.shape == expected_matrix.shape
+    # the original matrix holds its coefficients as ints, which are exact in the float matrix
+    for name in ("indptr", "indices", "data"):
+        assert np.array_equal(getattr(sparse_matrix, name), getattr(expected_matrix, name)), name
+    assert right_hand_side.dtype == expected_rhs.dtype
+    assert np.array_equal(right_hand_side, expected_rhs)
@@ -0,0 +1,61 @@
+"""
+autor: Valentina Garrido
+
+Tests of the reports and options of the iterative solver backends.
+"""
+
+import numpy as np
+import pytest
+
+from imgIndices import get_neighbor_pixel_mask, pixel_label_image
+from imgLaplaceSolver import build_equation_system_from_labels
+from imgSolverBackends import make_solver, variable_positions, VariablePositions
+
+
+def square_system():
+    """
+    :return: matrix, right hand side and label image of the bloom of a small square
+    """
+    cb_mask = np.zeros((40, 40), dtype=bool)
+    cb_mask[18:21, 18:21] = True
+    label_img = pixel_label_image(get_neighbor_pixel_mask(cb_mask, 10))
+    sparse_matrix, right_hand_side = build_equation_system_from_labels(label_img, cb_mask)
+    return sparse_matrix, right_hand_side, label_img
+
+
+@pytest.mark.parametrize("backend", ["cg", "minres", "matrix-free"])
+def test_unconverged_solve_is_reported(backend):
+    sparse_matrix, right_hand_side, label_img = square_system()
+    solver = make_solver(sparse_matrix, label_img, backend, max_iter=2)
+    with pytest.warns(RuntimeWarning, match="not converged"):
+        solver.solve(right_hand_side)
+    assert not solver.report.converged
+    assert "not converged" in str(solver.report)
+
+
+def test_converged_solve_is_reported():
+    sparse_matrix, right_hand_side, label_img = square_system()
+    solver = make_solver(sparse_matrix, label_img, "cg")
+    solver.solve(right_hand_side)
+    assert solver.report.converged
+    assert solver.report.as_dict()["converged"]
+
+
+@pytest.mark.parametrize("backend", ["cg", "minres"])
+def test_warm_start_without_first_variable(backend):
+    # the system of the variables after the first one, like the ones of imgComponents, keeps all its variables
+    sparse_matrix, right_hand_side, label_img = square_system()
+    positions = variable_positions(label_img)
+    sub_matrix = sparse_matrix[1:, 1:]
+    sub_positions = VariablePositions(positions.rows[1:], positions.cols[1:], positions.img_dims)
+    solver = make_solver(sub_matrix, sub_positions, backend)
+    assert solver.symmetric.first == 0
+    solution = solver.solve(right_hand_side[1:])
+    warm_solution = solver.solve(right_hand_side[1:], initial_guess=solution)
+    assert np.allclose(warm_solution, solution)
+
+
+def test_multigrid_rejects_other_preconditioners():
+    sparse_matrix, _, label_img = square_system()
+    with pytest.raises(ValueError):
+        make_solver(sparse_matrix, label_img, "multigrid", preconditioner="jacobi")